@@ -1,6 +1,10 @@
+import datetime
 from functools import wraps
+import json
 
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import get_connection
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
 
@@ -11,8 +15,11 @@ from localtv.admin.approve_reject_views import (
     feature_video as _feature_video,
     approve_all as _approve_all,
     get_video_paginator)
+from notification import models as notification
 
 from mirocommunity_saas.models import Tier
+from mirocommunity_saas.utils.mail import send_mail
+from mirocommunity_saas.utils.tiers import invalidate_active_video_count
 
 
 OVER_LIMIT_ERROR = ("You've hit your video limit ({limit} videos). You will "
@@ -68,9 +75,84 @@ approve_video = require_site_admin(_video_limit_wrapper(_approve_video))
 feature_video = require_site_admin(_video_limit_wrapper(_feature_video))
 
 
+def _notify_submitters(videos):
+    """
+    Emails the submitters of the given (just approved) videos who want to
+    hear about approvals, over a single mail connection.
+
+    """
+    try:
+        notice_type = notification.NoticeType.objects.get(
+                                                    label='video_approved')
+    except notification.NoticeType.DoesNotExist:
+        return
+    user_ids = set(video.user_id for video in videos if video.user_id)
+    if not user_ids:
+        return
+    users = User.objects.exclude(email='').in_bulk(user_ids)
+    connection = get_connection(fail_silently=True)
+    connection.open()
+    try:
+        for video in videos:
+            user = users.get(video.user_id)
+            if (user is None or
+                not notification.should_send(user, notice_type, '1')):
+                continue
+            send_mail('mirocommunity_saas/mail/video_approved/subject.txt',
+                      'mirocommunity_saas/mail/video_approved/body.md',
+                      [user], extra_context={'video': video},
+                      connection=connection)
+    finally:
+        connection.close()
+
+
+def _bulk_approve(videos, limit=None):
+    """
+    Approves up to ``limit`` of the given videos (or all of them if
+    ``limit`` is ``None``), oldest submissions first, with a single UPDATE.
+    Returns a tuple of the lists of approved and skipped video ids.
+
+    The UPDATE doesn't call :meth:`Video.save` or send any model signals, so
+    what they would have done is done here instead: the approved videos
+    get their new ``status`` and ``when_approved``, the cached active video
+    count is cleared, one search index update is queued for all of them and
+    their submitters are emailed.
+
+    """
+    videos = sorted(videos, key=lambda video: (video.when_submitted,
+                                               video.pk))
+    if limit is not None:
+        limit = max(limit, 0)
+    approved_videos = videos[:limit]
+    approved = [video.pk for video in approved_videos]
+    skipped = [video.pk for video in videos[len(approved):]]
+    if approved:
+        from localtv.tasks import haystack_update
+        when_approved = datetime.datetime.now()
+        Video.objects.filter(pk__in=approved, site=settings.SITE_ID
+                    ).update(status=Video.ACTIVE,
+                             when_approved=when_approved)
+        for video in approved_videos:
+            video.status = Video.ACTIVE
+            video.when_approved = when_approved
+        invalidate_active_video_count()
+        haystack_update.delay(Video._meta.app_label,
+                              Video._meta.module_name,
+                              approved)
+        _notify_submitters(approved_videos)
+    return approved, skipped
+
+
 @require_site_admin
 def approve_all(request):
-    # This view approves all the videos on the current page.
+    """
+    Approves all the videos on the current page, or refuses with a 402 if
+    that would put the site over its video limit. With ``partial=1``, it
+    instead approves as many as the limit allows and responds with a JSON
+    object listing the ``approved`` and ``skipped`` video ids and the number
+    of videos ``remaining`` under the limit (``null`` if unlimited).
+
+    """
     site_settings = SiteSettings.objects.get_current()
 
     video_paginator = get_video_paginator(site_settings)
@@ -81,10 +163,24 @@ def approve_all(request):
         return _approve_all(request)
 
     tier = get_object_or_404(Tier, sitetierinfo__site=settings.SITE_ID)
+    remaining = None
     if tier.video_limit is not None:
         videos = Video.objects.filter(status=Video.ACTIVE,
                                       site=settings.SITE_ID)
         remaining = tier.video_limit - videos.count()
+
+    if request.GET.get('partial'):
+        approved, skipped = _bulk_approve(page.object_list, remaining)
+        summary = {
+            'approved': approved,
+            'skipped': skipped,
+            'remaining': (None if remaining is None
+                          else max(remaining - len(approved), 0)),
+        }
+        return HttpResponse(json.dumps(summary),
+                            content_type='application/json')
+
+    if remaining is not None:
         need = len(page.object_list)
 
         if need > remaining:
@@ -1,15 +1,8 @@
-from django.http import Http404
 from localtv.admin.flatpages_views import index
 
-from mirocommunity_saas.models import SiteTierInfo
+from mirocommunity_saas.utils.entitlements import (CUSTOM_THEMES,
+                                                   require_entitlement)
 
 
-def flatpages_admin(request):
-	"""
-	Flatpages should only be editable if custom theming is allowed.
-
-	"""
-	tier = SiteTierInfo.objects.get_current().tier
-	if not tier.custom_themes:
-		raise Http404
-	return index(request)
+# Flatpages should only be editable if custom theming is allowed.
+flatpages_admin = require_entitlement(CUSTOM_THEMES)(index)
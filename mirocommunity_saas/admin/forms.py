@@ -7,13 +7,15 @@ from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.forms.models import modelformset_factory
+from django.core.paginator import InvalidPage, Paginator
+from django.forms.formsets import DELETION_FIELD_NAME
+from django.forms.models import BaseModelFormSet, modelformset_factory
 from django.template.defaultfilters import pluralize
 from localtv.admin.forms import (EditSettingsForm as _EditSettingsForm,
                                  AuthorForm as _AuthorForm,
                                  BulkEditVideoFormSet as _BulkEditVideoFormSet,
                                  BulkEditVideoForm)
-from localtv.models import Video
+from localtv.models import SiteSettings, Video
 from paypal.standard.conf import (POSTBACK_ENDPOINT,
                                   SANDBOX_POSTBACK_ENDPOINT,
                                   RECEIVER_EMAIL,
@@ -21,8 +23,13 @@ from paypal.standard.conf import (POSTBACK_ENDPOINT,
 from paypal.standard.forms import PayPalPaymentsForm
 
 from mirocommunity_saas.models import SiteTierInfo, Tier
+from mirocommunity_saas.routers import pin_to_primary
+from mirocommunity_saas.utils.entitlements import CUSTOM_CSS
+from mirocommunity_saas.utils.functional import cached_property
 from mirocommunity_saas.utils.mail import send_welcome_email
-from mirocommunity_saas.utils.tiers import (make_tier_change_token,
+from mirocommunity_saas.utils.tiers import (active_video_count,
+                                            invalidate_active_video_count,
+                                            make_tier_change_token,
                                             check_tier_change_token)
 
 
@@ -30,7 +37,8 @@ class EditSettingsForm(_EditSettingsForm):
     def __init__(self, *args, **kwargs):
         _EditSettingsForm.__init__(self, *args, **kwargs)
         self.tier = SiteTierInfo.objects.get_current().tier
-        if not self.tier.custom_css:
+        self.custom_css = bool(self.tier.entitlements & CUSTOM_CSS)
+        if not self.custom_css:
             # Uh-oh: custom CSS is not permitted!
             #
             # To handle only letting certain paid users edit CSS,
@@ -51,7 +59,7 @@ class EditSettingsForm(_EditSettingsForm):
         css = self.cleaned_data.get('css')
         # Does the current tier permit custom CSS? If so, return the data the
         # user submitted.
-        if self.tier.custom_css:
+        if self.custom_css:
             return css # no questions asked
 
         # We permit the value if it's the same as self.instance has:
@@ -66,7 +74,28 @@ class EditSettingsForm(_EditSettingsForm):
         raise ValidationError(
             "To edit CSS for your site, you have to upgrade.")
 
+def _admin_limit_error(tier, promotions=1, admin_count=None):
+    # For backwards-compatibility, pretend the site owner (a superuser)
+    # counts toward the limit.
+    limit = tier.admin_limit + 1
+    if admin_count is None or admin_count >= tier.admin_limit:
+        return ValidationError("You already have {limit} admin{s} in your "
+                               "site. Upgrade to have access to more.".format(
+                                        limit=limit, s=pluralize(limit)))
+    remaining = tier.admin_limit - admin_count
+    return ValidationError("You can only add {remaining} more admin{s}, but "
+                           "tried to add {promotions}. Upgrade to have "
+                           "access to more.".format(remaining=remaining,
+                                                    s=pluralize(remaining),
+                                                    promotions=promotions))
+
+
 class AuthorForm(_AuthorForm):
+    #: Whether :meth:`clean_role` checks the tier's admin limit. Forms in an
+    #: :data:`AuthorFormSet` leave that to the formset, which checks all
+    #: the promotions together.
+    check_admin_limit = True
+
     def __init__(self, *args, **kwargs):
         _AuthorForm.__init__(self, *args, **kwargs)
         ## Add a note to the 'role' help text indicating how many admins
@@ -82,6 +111,15 @@ class AuthorForm(_AuthorForm):
                                                    s=pluralize(limit))
             self.fields['role'].help_text = message
 
+    def is_promotion(self):
+        """
+        Returns ``True`` if the (cleaned) form makes someone an admin who
+        wasn't one before.
+
+        """
+        return (self.cleaned_data.get('role') == 'admin' and
+                'role' in self.changed_data)
+
     def clean_role(self):
         role = self.cleaned_data['role']
 
@@ -97,6 +135,9 @@ class AuthorForm(_AuthorForm):
         if 'role' not in self.changed_data:
             return role
 
+        if not self.check_admin_limit:
+            return role
+
         # And finally, we're good if there's room for another admin.
         admin_count = self.site_settings.admins.exclude(is_superuser=True
                                               ).exclude(is_active=False
@@ -104,48 +145,133 @@ class AuthorForm(_AuthorForm):
         if (admin_count + 1) <= self.tier.admin_limit:
             return role
 
-        # For backwards-compatibility, pretend the site owner (a
-        # superuser) counts toward the limit.
-        limit = self.tier.admin_limit + 1
-        raise ValidationError("You already have {limit} admin{s} in your "
-                              "site. Upgrade to have access to more.".format(
-                                        limit=limit, s=pluralize(limit)))
+        raise _admin_limit_error(self.tier)
+
+
+class BaseAuthorFormSet(BaseModelFormSet):
+    """
+    Checks the tier's admin limit once for all of the formset's promotions,
+    rather than once per form against the same count. Can also show one
+    page of users at a time; see :meth:`for_page`.
+
+    """
+    #: Number of users per page, or ``None`` for all users on one page.
+    per_page = None
+    #: The (1-based) page to show.
+    page_number = 1
+
+    @classmethod
+    def for_page(cls, page_number, per_page):
+        """
+        Returns a subclass which shows the ``page_number``th page of
+        ``per_page`` users. Its :attr:`paginator` and :attr:`page` are
+        available to templates.
+
+        """
+        return type(cls.__name__, (cls,), {'page_number': page_number,
+                                           'per_page': per_page})
+
+    def get_queryset(self):
+        if not hasattr(self, '_page'):
+            queryset = super(BaseAuthorFormSet, self).get_queryset()
+            self._paginator = self._page = None
+            if self.per_page:
+                self._paginator = Paginator(queryset, self.per_page)
+                try:
+                    self._page = self._paginator.page(self.page_number)
+                except InvalidPage:
+                    self._page = self._paginator.page(
+                                                self._paginator.num_pages)
+                self._queryset = self._page.object_list
+        return self._queryset
+
+    @property
+    def paginator(self):
+        self.get_queryset()
+        return self._paginator
+
+    @property
+    def page(self):
+        self.get_queryset()
+        return self._page
+
+    def _construct_form(self, i, **kwargs):
+        form = super(BaseAuthorFormSet, self)._construct_form(i, **kwargs)
+        form.check_admin_limit = False
+        return form
+
+    def clean(self):
+        super(BaseAuthorFormSet, self).clean()
+        if any(self.errors):
+            return
+        tier = SiteTierInfo.objects.get_current().tier
+        if tier.admin_limit is None:
+            return
+        promotions = len([form for form in self.forms
+                          if form.has_changed() and
+                          not form.cleaned_data.get(DELETION_FIELD_NAME) and
+                          form.is_promotion()])
+        if not promotions:
+            return
+        site_settings = SiteSettings.objects.get_current()
+        admin_count = site_settings.admins.exclude(is_superuser=True
+                                         ).exclude(is_active=False
+                                         ).count()
+        if admin_count + promotions > tier.admin_limit:
+            raise _admin_limit_error(tier, promotions, admin_count)
 
 
 AuthorFormSet = modelformset_factory(User,
                                      form=AuthorForm,
+                                     formset=BaseAuthorFormSet,
                                      can_delete=True,
                                      extra=0)
 
 class BulkEditVideoFormSet(_BulkEditVideoFormSet):
+    """
+    Enforces the tier's video limit on bulk approvals. The approve and
+    feature actions only note which videos they're approving; once every
+    form has been handled, the current statuses of those videos are looked
+    up together and checked against a freshly counted number of active
+    videos, so validation takes the same number of queries however many
+    forms are submitted.
+
+    """
     def clean(self):
         tier = SiteTierInfo.objects.get_current().tier
+        self.pending_approvals = []
         self.approval_count = 0
         _BulkEditVideoFormSet.clean(self)
-        if tier.video_limit is not None:
-            video_count = Video.objects.filter(status=Video.ACTIVE,
-                                               site=settings.SITE_ID
-                                      ).count()
-            remaining = tier.video_limit - video_count
-            if remaining < 0:
-                raise ValidationError('You already have {0} videos over your '
-                                      'limit ({1}). Upgrade to approve '
-                                      'more.'.format(-1 * remaining,
-                                                     tier.video_limit))
-            elif self.approval_count > remaining:
-                raise ValidationError('You can only approve {0} videos, '
-                                      'but tried to approve {1} instead. '
-                                      'Upgrade to approve more.'.format(
-                                      remaining, self.approval_count))
+        if tier.video_limit is None or not self.pending_approvals:
+            return
+        self.approval_count = len(Video.objects.filter(
+                                      pk__in=self.pending_approvals,
+                                      site=settings.SITE_ID
+                                  ).exclude(status=Video.ACTIVE
+                                  ).values_list('pk', flat=True))
+        if not self.approval_count:
+            return
+        # The cached count can be stale after bulk updates which bypass the
+        # model signals, so approvals are checked against a fresh one.
+        invalidate_active_video_count()
+        remaining = tier.video_limit - active_video_count()
+        if remaining < 0:
+            raise ValidationError('You already have {0} videos over your '
+                                  'limit ({1}). Upgrade to approve '
+                                  'more.'.format(-1 * remaining,
+                                                 tier.video_limit))
+        elif self.approval_count > remaining:
+            raise ValidationError('You can only approve {0} videos, '
+                                  'but tried to approve {1} instead. '
+                                  'Upgrade to approve more.'.format(
+                                  remaining, self.approval_count))
 
     def action_approve(self, form):
-        if form.instance.status != Video.ACTIVE:
-            self.approval_count += 1
+        self.pending_approvals.append(form.instance.pk)
         _BulkEditVideoFormSet.action_approve(self, form)
 
     def action_feature(self, form):
-        if form.instance.status != Video.ACTIVE:
-            self.approval_count += 1
+        self.pending_approvals.append(form.instance.pk)
         _BulkEditVideoFormSet.action_feature(self, form)
 
 VideoFormSet = modelformset_factory(
@@ -172,6 +298,34 @@ class DowngradeConfirmationForm(forms.Form):
         self.initial['tier'] = tier.slug
 
 
+class TierPageContext(object):
+    """
+    The site and tier state which the tier forms are built from. The tier
+    pages create one and pass it (as ``page``) to each of their forms, so
+    that it's looked up once per page rather than once per form.
+
+    """
+    def __init__(self, site=None, tier_info=None):
+        self.site = site or Site.objects.get_current()
+        self.tier_info = tier_info or SiteTierInfo.objects.get_current()
+
+    @cached_property
+    def tier(self):
+        return self.tier_info.tier
+
+    @cached_property
+    def subscription(self):
+        return self.tier_info.subscription
+
+    @cached_property
+    def had_subscription(self):
+        return self.tier_info.had_subscription
+
+    def tier_change_token(self, tier):
+        return make_tier_change_token(tier, site=self.site,
+                                      tier_info=self.tier_info)
+
+
 class TierChangeForm(forms.Form):
     """
     This form can be used to change a tier without going through paypal.
@@ -186,11 +340,12 @@ class TierChangeForm(forms.Form):
     token = forms.CharField(widget=forms.HiddenInput)
 
     def __init__(self, *args, **kwargs):
+        self.page = kwargs.pop('page', None) or TierPageContext()
         super(TierChangeForm, self).__init__(*args, **kwargs)
-        self.tier_info = SiteTierInfo.objects.get_current()
+        self.tier_info = self.page.tier_info
         self.fields['tier'].queryset = self.tier_info.available_tiers.all()
         if 'tier' in self.initial:
-            self.initial['token'] = make_tier_change_token(
+            self.initial['token'] = self.page.tier_change_token(
                                                          self.initial['tier'])
 
     def clean_tier(self):
@@ -214,6 +369,7 @@ class TierChangeForm(forms.Form):
         self.tier_info.tier = self.cleaned_data['tier']
         self.tier_info.tier_changed = datetime.datetime.now()
         self.tier_info.save()
+        pin_to_primary()
         # Run send_welcome_email to get it out of the way if they're
         # arriving after paying on paypal. It won't do anything if it was
         # already sent, and the overhead is minimal.
@@ -243,20 +399,21 @@ class PayPalSubscriptionForm(PayPalPaymentsForm):
     notify_url = 'paypal-ipn'
 
     def __init__(self, tier, *args, **kwargs):
+        page = kwargs.pop('page', None) or TierPageContext()
         super(PayPalSubscriptionForm, self).__init__(*args, **kwargs)
         self.tier = tier
-        site = Site.objects.get_current()
-        tier_info = SiteTierInfo.objects.get_current()
+        site = page.site
         # Downgrades are delayed until the subscription expires, so we should
         # only use the return_url (which would immediately change the tier) if
         # this is an upgrade.
         cancel_return = 'http://{domain}{url}'.format(
                                     domain=site.domain,
                                     url=reverse(self.cancel_return))
-        if tier.price < tier_info.tier.price:
+        if tier.price < page.tier.price:
             return_url = cancel_return
         else:
-            return_params = TierChangeForm(initial={'tier': tier}).initial
+            return_params = TierChangeForm(initial={'tier': tier},
+                                           page=page).initial
             return_url = 'http://{domain}{url}?{query}'.format(
                                     domain=site.domain,
                                     url=reverse(self.return_url),
@@ -291,7 +448,7 @@ class PayPalSubscriptionForm(PayPalPaymentsForm):
                                    name=tier.name,
                                    domain=site.domain),
         }
-        if not tier_info.had_subscription:
+        if not page.had_subscription:
             # If they've never had a subscription before, we add a thirty-day
             # free trial.
             self.initial.update({
@@ -299,16 +456,16 @@ class PayPalSubscriptionForm(PayPalPaymentsForm):
                 'p1': '30',
                 't1': 'D'
             })
-        elif tier_info.subscription is not None:
-            if (not tier_info.subscription.is_cancelled and
-                tier.price < tier_info.tier.price):
+        elif page.subscription is not None:
+            if (not page.subscription.is_cancelled and
+                tier.price < page.tier.price):
                 # If the current subscription is uncancelled and this is
                 # a downgrade, do this as a subscription modification.
                 self.initial['modify'] = '2'
             # Any time they are currently subscribed, delay payment
             # until the end of their current subscription by giving a
             # "free trial" until then.
-            next_due_date = tier_info.subscription.next_due_date
+            next_due_date = page.subscription.next_due_date
             self.initial.update({
                 'a1': '0',
                 'p1': str((next_due_date - datetime.datetime.now()).days),
@@ -1,31 +1,146 @@
+import json
+
 from django.conf import settings
-from django.http import HttpResponse, Http404
+from django.db import transaction
+from django.http import HttpRequest, HttpResponse, Http404, QueryDict
 
 from localtv.admin.livesearch.views import LiveSearchApproveVideoView
 from localtv.decorators import require_site_admin, referrer_redirect
 from localtv.models import Video
 
 from mirocommunity_saas.models import SiteTierInfo
+from mirocommunity_saas.routers import write_database
 
-class TierLiveSearchApproveVideoView(LiveSearchApproveVideoView):
 
-    def get(self, request, **kwargs):
-        if not request.GET.get('queue'):
-            try:
-                tier = SiteTierInfo.objects.get_current().tier
-            except SiteTierInfo.DoesNotExist:
+class TierLiveSearchApproveMixin(object):
+    """
+    Approves (or queues) live search results within the site's video quota.
+    Single and batch approvals both go through :meth:`approve_videos`,
+    which counts the site's videos once however many results it's given.
+
+    """
+    def approve_video(self, request, video_id, **kwargs):
+        """
+        Runs localtv's approval for the single result ``video_id``, as the
+        given user and session and with the given query. Returns localtv's
+        response.
+
+        """
+        query = request.GET.copy()
+        query.setlist('video_id', [video_id])
+        video_request = HttpRequest()
+        video_request.method = request.method
+        video_request.path = request.path
+        video_request.path_info = request.path_info
+        video_request.META = request.META
+        video_request.COOKIES = request.COOKIES
+        video_request.GET = query
+        video_request.POST = QueryDict('')
+        video_request.user = request.user
+        video_request.session = request.session
+        return LiveSearchApproveVideoView.get(self, video_request, **kwargs)
+
+    @transaction.commit_on_success
+    def approve_videos(self, request, video_ids, **kwargs):
+        """
+        Approves the given results in order until the quota runs out, or
+        queues them if the ``queue`` query parameter is set. Returns the
+        number of videos remaining under the limit afterwards (``None`` if
+        unlimited or unknown) and a list of ``(video_id, status, response)``
+        tuples, where ``status`` is one of ``approved``, ``queued``,
+        ``over_limit``, ``not_found`` or ``failed`` and ``response`` is
+        localtv's response (``None`` if it wasn't asked).
+
+        Approvals lock the site's tier info until they're committed, so
+        that concurrent approvals take turns: each counts the active videos
+        once, after the others' approvals, and reserves its share of the
+        quota from that count.
+
+        """
+        queue = bool(request.GET.get('queue'))
+        using = write_database()
+        tier_infos = SiteTierInfo.objects.using(using).select_related('tier')
+        if not queue:
+            tier_infos = tier_infos.select_for_update()
+        try:
+            tier_info = tier_infos.get(site=settings.SITE_ID)
+        except SiteTierInfo.DoesNotExist:
+            # Queueing doesn't use up the quota, so it doesn't need a tier.
+            if not queue:
                 raise Http404
-            if tier.video_limit is not None:
-                video_count = Video.objects.filter(status=Video.ACTIVE,
-                                                   site=settings.SITE_ID
-                                          ).count()
-                if video_count + 1 > tier.video_limit:
-                    return HttpResponse(
-                        content="You are over the video limit. You "
-                        "will need to upgrade to approve "
-                        "that video.", status=402)
-
-        return LiveSearchApproveVideoView.get(self, request, **kwargs)
+            tier_info = None
+        remaining = None
+        if tier_info is not None and tier_info.tier.video_limit is not None:
+            remaining = tier_info.tier.video_limit - Video.objects.using(
+                                    using).filter(status=Video.ACTIVE,
+                                                  site=settings.SITE_ID
+                                    ).count()
+        results = []
+        for video_id in video_ids:
+            if not queue and remaining is not None and remaining < 1:
+                results.append((video_id, 'over_limit', None))
+                continue
+            try:
+                response = self.approve_video(request, video_id, **kwargs)
+            except Http404:
+                results.append((video_id, 'not_found', None))
+                continue
+            if response.status_code >= 400:
+                status = 'failed'
+            elif queue:
+                status = 'queued'
+            else:
+                status = 'approved'
+                if remaining is not None:
+                    remaining -= 1
+            results.append((video_id, status, response))
+        if remaining is not None:
+            remaining = max(remaining, 0)
+        return remaining, results
+
+
+class TierLiveSearchApproveVideoView(TierLiveSearchApproveMixin,
+                                     LiveSearchApproveVideoView):
+
+    def get(self, request, **kwargs):
+        remaining, results = self.approve_videos(
+                                request, [request.GET.get('video_id')],
+                                **kwargs)
+        video_id, status, response = results[0]
+        if status == 'over_limit':
+            return HttpResponse(
+                content="You are over the video limit. You "
+                "will need to upgrade to approve "
+                "that video.", status=402)
+        if status == 'not_found':
+            raise Http404
+        return response
+
+
+class TierLiveSearchBatchApproveView(TierLiveSearchApproveMixin,
+                                     LiveSearchApproveVideoView):
+    """
+    Approves (or queues) several live search results in one request. Each
+    result is passed as a ``video_id`` parameter. Results are approved in
+    the order given until the site's video quota runs out, and the rest are
+    skipped. The response is a JSON object with a ``results`` list of
+    ``{"video_id": ..., "status": ...}`` objects (see
+    :meth:`~TierLiveSearchApproveMixin.approve_videos`) and the number of
+    videos ``remaining`` under the limit afterwards (``null`` if unlimited).
+
+    """
+    def get(self, request, **kwargs):
+        remaining, results = self.approve_videos(
+                                request, request.GET.getlist('video_id'),
+                                **kwargs)
+        summary = {
+            'results': [{'video_id': video_id, 'status': status}
+                        for video_id, status, response in results],
+            'remaining': remaining,
+        }
+        return HttpResponse(json.dumps(summary),
+                            content_type='application/json')
 
 approve = referrer_redirect(require_site_admin(
         TierLiveSearchApproveVideoView.as_view()))
+approve_batch = require_site_admin(TierLiveSearchBatchApproveView.as_view())
@@ -1,29 +1,20 @@
-from functools import wraps
-
-from django.http import Http404
 from localtv.admin import upload_views
 from localtv.decorators import require_site_admin
 from uploadtemplate.models import Theme
 from uploadtemplate.views import ThemeIndexView
 
-from mirocommunity_saas.models import SiteTierInfo
+from mirocommunity_saas.utils.entitlements import (CUSTOM_THEMES,
+                                                   has_entitlements,
+                                                   require_entitlement)
 
 
-def require_custom_themes(view_func):
-    @wraps(view_func)
-    def wrapper(*args, **kwargs):
-        tier = SiteTierInfo.objects.get_current().tier
-        if not tier.custom_themes:
-            raise Http404
-        return view_func(*args, **kwargs)
-    return wrapper
+require_custom_themes = require_entitlement(CUSTOM_THEMES)
 
 
 class UploadtemplateAdmin(ThemeIndexView):
     def get_context_data(self, **kwargs):
         context = super(UploadtemplateAdmin, self).get_context_data(**kwargs)
-        tier = SiteTierInfo.objects.get_current().tier
-        if not tier.custom_themes:
+        if not has_entitlements(self.request, CUSTOM_THEMES):
             context['themes'] = Theme.objects.none()
         return context
 
@@ -4,7 +4,8 @@ from localtv.decorators import require_site_admin
 from mirocommunity_saas.admin.forms import (EditSettingsForm, AuthorForm,
                                             AuthorFormSet, VideoFormSet)
 from mirocommunity_saas.admin.views import (index, TierView, TierChangeView,
-                                            DowngradeConfirmationView)
+                                            DowngradeConfirmationView,
+                                            quota_status)
 
 
 # Tier urls
@@ -19,6 +20,7 @@ urlpatterns = patterns('',
     url(r'^upgrade/complete/$',
         require_site_admin(TierChangeView.as_view()),
         name='localtv_admin_tier_change'),
+    url(r'^quota/$', quota_status, name='localtv_admin_quota'),
     url(r'^paypal/', include('paypal.standard.ipn.urls')),
 )
 
@@ -35,20 +37,26 @@ urlpatterns += patterns('mirocommunity_saas.admin.approve_reject_views',
 # Live search overrides
 urlpatterns += patterns('mirocommunity_saas.admin.livesearch_views',
     url(r'^add/approve/$', 'approve',
-        name='localtv_admin_search_video_approve')
+        name='localtv_admin_search_video_approve'),
+    url(r'^add/approve/batch/$', 'approve_batch',
+        name='localtv_admin_search_video_approve_batch'),
 )
 
-# Overrides for settings, users, and videos.
+# Overrides for settings and videos.
 urlpatterns += patterns('localtv.admin',
     url(r'^settings/$', 'design_views.edit_settings',
         {'form_class': EditSettingsForm}, 'localtv_admin_settings'),
-    url(r'^users/$', 'user_views.users',
-        {'formset_class': AuthorFormSet, 'form_class': AuthorForm},
-        'localtv_admin_users'),
     url(r'^bulk_edit/$', 'bulk_edit_views.bulk_edit',
         {'formset_class': VideoFormSet}, 'localtv_admin_bulk_edit')
 )
 
+# Users admin, one page at a time.
+urlpatterns += patterns('mirocommunity_saas.admin.user_views',
+    url(r'^users/$', 'users',
+        {'formset_class': AuthorFormSet, 'form_class': AuthorForm},
+        'localtv_admin_users'),
+)
+
 # Theming overrides
 urlpatterns += patterns(
     'mirocommunity_saas.admin.upload_views',
@@ -67,5 +75,5 @@ urlpatterns += patterns(
 
 # Flatpages overrides
 urlpatterns += patterns('mirocommunity_saas.admin.flatpages_views',
-    url(r'flatpages/$', 'flatpages_admin', name='localtv_admin_flatpages'),
+    url(r'^flatpages/$', 'flatpages_admin', name='localtv_admin_flatpages'),
 )
@@ -0,0 +1,31 @@
+import urlparse
+
+from localtv.admin.user_views import users as _users
+
+
+#: Number of users shown (and given forms) per page of the users admin.
+USERS_PER_PAGE = 100
+
+
+def users(request, formset_class, form_class):
+    """
+    Wraps localtv's users admin view so that its formset only covers the
+    page of users given by the ``page`` query parameter, and so that saving
+    the page returns to it.
+
+    """
+    try:
+        page_number = int(request.GET.get('page', 1))
+    except ValueError:
+        page_number = 1
+    response = _users(request,
+                      formset_class=formset_class.for_page(page_number,
+                                                           USERS_PER_PAGE),
+                      form_class=form_class)
+    if response.status_code == 302 and page_number != 1:
+        # localtv redirects back to the bare path after a POST.
+        location = urlparse.urlsplit(response['Location'])
+        if location.path == request.path and not location.query:
+            response['Location'] = '{0}?page={1}'.format(
+                                            response['Location'], page_number)
+    return response
@@ -1,9 +1,18 @@
-import logging
+import datetime
+import hashlib
+import json
 import math
 
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, Http404
+from django.db.models import Count, Max
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.utils.datastructures import SortedDict
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic import TemplateView, View
 from localtv.admin.views import IndexView
 from localtv.decorators import require_site_admin
@@ -12,11 +21,16 @@ from uploadtemplate.models import Theme
 from mirocommunity_saas.admin.forms import (TierChangeForm,
                                             DowngradeConfirmationForm,
                                             PayPalCancellationForm,
-                                            PayPalSubscriptionForm)
+                                            PayPalSubscriptionForm,
+                                            TierPageContext)
 from mirocommunity_saas.models import SiteTierInfo, Tier
-from mirocommunity_saas.utils.tiers import (admins_to_demote,
+from mirocommunity_saas.routers import write_database
+from mirocommunity_saas.utils.tiers import (active_video_count,
+                                            admins_to_demote,
                                             videos_to_deactivate,
-                                            set_tier)
+                                            queue_tier_reconciliation,
+                                            tier_needs_reconciliation,
+                                            tier_usage)
 
 
 class TierIndexView(IndexView):
@@ -40,6 +54,105 @@ class TierIndexView(IndexView):
 index = require_site_admin(TierIndexView.as_view())
 
 
+def quota_status_etag(request, *args, **kwargs):
+    """
+    Builds the ETag from the cached tier info and active video count only,
+    so that a 304 costs no queries. The admin counts in the body are
+    refreshed whenever the tier or the video count changes.
+
+    """
+    tier_info = SiteTierInfo.objects.get_current()
+    tier = tier_info.tier
+    version = repr((tier.pk, tier.slug, tier.video_limit, tier.admin_limit,
+                    tier.custom_css, tier.custom_themes, tier.custom_domain,
+                    tier.ads_allowed, tier_info.tier_changed,
+                    active_video_count()))
+    return hashlib.md5(version).hexdigest()
+
+
+@require_site_admin
+@cache_control(private=True, max_age=0, must_revalidate=True)
+@condition(etag_func=quota_status_etag)
+def quota_status(request):
+    """
+    Returns the current site's tier limits, usage and entitlements as JSON,
+    so that the moderation pages can check the video limit before sending
+    an approval.
+
+    """
+    tier = SiteTierInfo.objects.get_current().tier
+    return HttpResponse(json.dumps(tier_usage(tier), sort_keys=True),
+                        content_type='application/json')
+
+
+def _tier_page_state(request):
+    """
+    Returns an (etag, last_modified) tuple for the upgrade page, or
+    ``(None, None)`` if it shouldn't be served conditionally. The page only
+    changes with the site's tier info, its IPNs, whether its tier is waiting
+    to be reconciled, its available tiers, its active video count (shown in
+    the admin nav's quota) and the date (PayPal trial periods are counted in
+    days), plus the user and their CSRF token.
+    The result is kept on the request since the ETag and Last-Modified are
+    asked for separately.
+
+    The state is read from the primary, so that a lagging replica can't
+    answer a 304 for a tier change that's just been made.
+
+    """
+    if hasattr(request, '_tier_page_state'):
+        return request._tier_page_state
+    request._tier_page_state = (None, None)
+
+    # Pending messages have to be rendered (and so consumed).
+    if len(get_messages(request)):
+        return request._tier_page_state
+
+    using = write_database()
+    tier_infos = SiteTierInfo.objects.using(using).filter(
+                                    site=settings.SITE_ID
+                                    ).annotate(ipn_count=Count('ipn_set'),
+                                               ipn_updated=Max(
+                                                    'ipn_set__updated_at'))
+    try:
+        tier_info = tier_infos.select_related('tier').get()
+    except SiteTierInfo.DoesNotExist:
+        return request._tier_page_state
+
+    # A 304 doesn't build the page, so a drifted tier has to be queued for
+    # reconciliation (and the notice about it kept current) here.
+    reconciliation_pending = tier_needs_reconciliation(tier_info)
+    if reconciliation_pending:
+        queue_tier_reconciliation()
+
+    catalog = list(Tier.objects.using(using).filter(
+                                site_available_set__site=settings.SITE_ID
+                              ).order_by('pk').values_list())
+    today = datetime.date.today()
+    version = repr((tier_info.tier_id, tier_info.tier_changed,
+                    tier_info.enforce_payments, tier_info.ipn_count,
+                    tier_info.ipn_updated, reconciliation_pending, catalog,
+                    today, active_video_count(),
+                    Site.objects.get_current().domain, request.user.pk,
+                    request.COOKIES.get(settings.CSRF_COOKIE_NAME)))
+    last_modified = max(value for value in (
+                            tier_info.tier_changed,
+                            tier_info.ipn_updated,
+                            datetime.datetime.combine(today, datetime.time()))
+                        if value is not None)
+    request._tier_page_state = (hashlib.md5(version).hexdigest(),
+                                last_modified)
+    return request._tier_page_state
+
+
+def tier_page_etag(request, *args, **kwargs):
+    return _tier_page_state(request)[0]
+
+
+def tier_page_last_modified(request, *args, **kwargs):
+    return _tier_page_state(request)[1]
+
+
 class TierView(TemplateView):
     """
     Base class for views for changing tiers and confirming any Bad Things that
@@ -48,32 +161,40 @@ class TierView(TemplateView):
     """
     template_name = 'localtv/admin/upgrade.html'
 
+    # Repeat visits get a 304 without any forms being built; see
+    # _tier_page_state.
+    @method_decorator(cache_control(private=True, max_age=0,
+                                    must_revalidate=True))
+    @method_decorator(condition(etag_func=tier_page_etag,
+                                last_modified_func=tier_page_last_modified))
+    def get(self, request, *args, **kwargs):
+        return super(TierView, self).get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super(TierView, self).get_context_data(**kwargs)
         tier_info = SiteTierInfo.objects.get_current()
 
-        if tier_info.enforce_payments:
-            price = (0 if tier_info.subscription is None
-                     else tier_info.subscription.signup_or_modify.amount3)
-            try:
-                set_tier(price)
-            except Tier.DoesNotExist:
-                logging.error('No tier matching current subscription.',
-                              exc_info=True)
-            except Tier.MultipleObjectsReturned:
-                logging.error('Multiple tiers found matching current'
-                              'subscription.', exc_info=True)
+        # Tier changes are made when IPNs arrive and by the periodic sweep,
+        # never while rendering this page. If the tier has drifted from the
+        # subscription anyway, ask for it to be fixed and say so.
+        reconciliation_pending = tier_needs_reconciliation(tier_info)
+        if reconciliation_pending:
+            queue_tier_reconciliation()
 
+        # Everything the forms need is looked up once, however many tiers
+        # there are.
+        page = TierPageContext(tier_info=tier_info)
         forms = SortedDict()
         tiers = tier_info.available_tiers.order_by('price')
         for tier in tiers:
-            if tier.price < tier_info.tier.price:
+            if tier.price < page.tier.price:
                 forms[tier] = DowngradeConfirmationForm(tier)
             else:
                 if tier_info.enforce_payments:
-                    forms[tier] = PayPalSubscriptionForm(tier)
+                    forms[tier] = PayPalSubscriptionForm(tier, page=page)
                 else:
-                    forms[tier] = TierChangeForm(initial={'tier': tier})
+                    forms[tier] = TierChangeForm(initial={'tier': tier},
+                                                 page=page)
 
         # Here we build a list of prices of current subscriptions, sorted
         # by the date the subscription started. This lets us check in the
@@ -89,6 +210,7 @@ class TierView(TemplateView):
             'cancellation_form': PayPalCancellationForm(),
             'forms': forms,
             'tier_info': tier_info,
+            'reconciliation_pending': reconciliation_pending,
         })
         return context
 
@@ -107,18 +229,19 @@ class DowngradeConfirmationView(TemplateView):
             raise Http404
         if tier.price >= tier_info.tier.price:
             raise Http404
+        page = TierPageContext(tier_info=tier_info)
         if tier_info.enforce_payments:
             if tier.price == 0:
-                if tier_info.subscription:
+                if page.subscription:
                     form = PayPalCancellationForm()
                 else:
                     # If they don't have an active subscription, we can't very
                     # well cancel it.
-                    form = TierChangeForm(initial={'tier': tier})
+                    form = TierChangeForm(initial={'tier': tier}, page=page)
             else:
-                form = PayPalSubscriptionForm(tier)
+                form = PayPalSubscriptionForm(tier, page=page)
         else:
-            form = TierChangeForm(initial={'tier': tier})
+            form = TierChangeForm(initial={'tier': tier}, page=page)
         context.update({
             'form': form,
             'tier': tier,
@@ -0,0 +1,96 @@
+import logging
+from optparse import make_option
+import time
+
+from django.core.management import (call_command, get_commands,
+                                    load_command_class)
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from mirocommunity_saas.utils.sites import current_site, saas_site_ids
+
+
+class Command(BaseCommand):
+    args = '<command> [<arg> ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--sites',
+                    help=('Comma-separated list of site ids to run the '
+                          'command for. Defaults to every site with tier '
+                          'info.')),
+    )
+    help = ("Runs a management command once for each of several sites in a "
+            "single process, instead of booting once per site. Everything "
+            "after the command's name, including options, is passed on to "
+            "it.")
+
+    def create_parser(self, prog_name, subcommand):
+        parser = super(Command, self).create_parser(prog_name, subcommand)
+        # Options after the command's name are the command's own.
+        parser.disable_interspersed_args()
+        return parser
+
+    def parse_command_args(self, command_name, args):
+        """
+        Parses ``args`` with the given command's own option parser, and
+        returns its positional arguments and options.
+
+        """
+        try:
+            app_name = get_commands()[command_name]
+        except KeyError:
+            raise CommandError('Unknown command: {0}'.format(command_name))
+        if isinstance(app_name, BaseCommand):
+            command = app_name
+        else:
+            command = load_command_class(app_name, command_name)
+        parser = command.create_parser('manage.py', command_name)
+        command_options, command_args = parser.parse_args(list(args))
+        command_options = vars(command_options)
+        command_options.update(stdout=self.stdout, stderr=self.stderr)
+        return command_args, command_options
+
+    def handle(self, command_name=None, *args, **options):
+        if command_name is None:
+            raise CommandError('No command given.')
+        command_args, command_options = self.parse_command_args(command_name,
+                                                                args)
+
+        if options['sites']:
+            try:
+                site_ids = [int(site_id)
+                            for site_id in options['sites'].split(',')]
+            except ValueError:
+                raise CommandError('Site ids must be integers.')
+        else:
+            site_ids = saas_site_ids()
+
+        failures = []
+        start = time.time()
+        for site_id in site_ids:
+            site_start = time.time()
+            try:
+                with current_site(site_id):
+                    call_command(command_name, *command_args,
+                                 **command_options)
+            except (Exception, SystemExit):
+                # Keep going; one broken site shouldn't stop the others.
+                # Commands which raise a CommandError report it and exit.
+                logging.error('{0} failed for site {1}'.format(command_name,
+                                                               site_id),
+                              exc_info=True)
+                transaction.rollback_unless_managed()
+                failures.append(site_id)
+                status = 'failed'
+            else:
+                status = 'ok'
+            self.stdout.write('Site {0}: {1} ({2:.2f}s)\n'.format(
+                                    site_id, status, time.time() - site_start))
+
+        self.stdout.write('Ran {0} for {1} site(s) in {2:.2f}s; {3} '
+                          'failed.\n'.format(command_name, len(site_ids),
+                                             time.time() - start,
+                                             len(failures)))
+        if failures:
+            raise CommandError('Failed for site(s): {0}'.format(
+                               ', '.join(str(site_id)
+                                         for site_id in failures)))
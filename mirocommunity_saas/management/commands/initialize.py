@@ -1,36 +1,87 @@
+import csv
 import datetime
+import json
 from optparse import make_option
+import sys
 import urllib
 
-from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
-from django.core.management.base import BaseCommand
-from localtv.models import SiteSettings
-from localtv.tasks import CELERY_USING
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
 
-from mirocommunity_saas.admin.forms import PayPalSubscriptionForm
-from mirocommunity_saas.models import Tier, SiteTierInfo
-from mirocommunity_saas.tasks import welcome_email_task
-from mirocommunity_saas.utils.mail import send_welcome_email
+from mirocommunity_saas.utils.sites import current_site
+
+# localtv, paypal, celery and the mail utilities are imported where they are
+# used, so that loading this command stays cheap.
+
+
+TIER_SLUGS = ('basic', 'plus', 'premium', 'max')
+
+
+def read_manifest(manifest_file, format=None):
+    """
+    Reads a site manifest and returns a list of dictionaries with the keys
+    ``site_name``, ``domain``, ``tier``, ``username``, ``email``,
+    ``password`` and (optionally) ``site_id``. The manifest can be either
+    JSON lines (one object per line) or CSV with a header row.
+
+    """
+    if format is None:
+        name = getattr(manifest_file, 'name', '')
+        format = 'csv' if name.endswith('.csv') else 'jsonl'
+    if format == 'csv':
+        rows = list(csv.DictReader(manifest_file))
+    elif format == 'jsonl':
+        rows = [json.loads(line) for line in manifest_file if line.strip()]
+    else:
+        raise CommandError('Unknown manifest format: {0}'.format(format))
+
+    for row in rows:
+        if not row.get('site_name') or not row.get('domain'):
+            raise CommandError('Each site needs a site_name and a domain.')
+        row.setdefault('tier', 'basic')
+        if row['tier'] not in TIER_SLUGS:
+            raise CommandError('Unknown tier: {0}'.format(row['tier']))
+        if row.get('site_id'):
+            row['site_id'] = int(row['site_id'])
+    return rows
 
 
 class Command(BaseCommand):
+    args = '<site_name> <domain>'
     option_list = BaseCommand.option_list + (
         make_option('--username'),
         make_option('--email'),
         make_option('--password'),
         make_option('--tier', default='basic', type='choice',
-                    choices=['basic', 'plus', 'premium', 'max']),
+                    choices=list(TIER_SLUGS)),
+        make_option('--manifest',
+                    help=('Provision every site listed in this file (or - '
+                          'for stdin) instead of the current site.')),
+        make_option('--format', type='choice', choices=['jsonl', 'csv'],
+                    help=('Manifest format. Guessed from the file extension '
+                          'if not given.')),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=100,
+                    help='Number of sites provisioned per transaction.'),
     )
     help = ("Initializes the database objects for the site, sends the site's "
             "welcome email, and prints a url to stdout which the site owner "
-            "should be redirected to in order to complete registration.")
+            "should be redirected to in order to complete registration. With "
+            "--manifest, does the same for many sites at once and prints "
+            "one '<domain> <url>' line per site.")
 
-    def handle(self, site_name, domain, **options):
-        available_tiers = Tier.objects.filter(slug__in=('basic',
-                                                        'plus',
-                                                        'premium',
-                                                        'max'))
+    def handle(self, site_name=None, domain=None, **options):
+        if options['manifest']:
+            return self.handle_manifest(**options)
+        if site_name is None or domain is None:
+            raise CommandError('A site name and domain are required.')
+
+        from localtv.models import SiteSettings
+        from mirocommunity_saas.models import Tier, SiteTierInfo
+
+        available_tiers = Tier.objects.filter(slug__in=TIER_SLUGS)
         tier = available_tiers.get(slug=options['tier'])
         site = Site.objects.get_current()
         # Make sure this site hasn't already been set up.
@@ -54,24 +105,133 @@ class Command(BaseCommand):
         SiteSettings.objects.get_or_create(site=site)
 
         if options['username']:
-            user = User.objects.create_user(options['username'],
-                                            options['email'],
-                                            options['password'])
-            user.is_superuser = True
-            user.save()
+            self.create_owner(options['username'], options['email'],
+                              options['password'])
+
+        self.stdout.write(self.finish_signup(tier))
 
+    def create_owner(self, username, email, password):
+        from django.contrib.auth.models import User
+        user = User.objects.create_user(username, email, password)
+        user.is_superuser = True
+        user.save()
+        return user
+
+    def finish_signup(self, tier):
+        """
+        Sends the welcome email for the current site if it doesn't need to
+        go through paypal, and returns the url the site owner should be sent
+        to.
+
+        """
+        site = Site.objects.get_current()
         if tier.slug == 'basic':
+            from mirocommunity_saas.utils.mail import send_welcome_email
             send_welcome_email()
-            self.stdout.write('http://{0}/'.format(site.domain))
+            return 'http://{0}/'.format(site.domain)
+
+        from mirocommunity_saas.admin.forms import PayPalSubscriptionForm
+        # If they haven't gotten back from paypal after a while, the welcome
+        # email will be sent by the periodic welcome email sweep.
+        form = PayPalSubscriptionForm(tier)
+        data = form.initial
+
+        # Here we make use of the fact that paypal subscriptions can use
+        # GET as well as POST. A bit hackish.
+        return "{0}?{1}".format(form.action, urllib.urlencode(data))
+
+    def handle_manifest(self, manifest, format=None, chunk_size=100,
+                        **options):
+        if manifest == '-':
+            rows = read_manifest(sys.stdin, format)
         else:
-            # Send the welcome email in ~30 minutes if they haven't gotten
-            # back from paypal by then.
-            welcome_email_task.apply_async(countdown=30*60,
-                                           kwargs={'using': CELERY_USING})
-            form = PayPalSubscriptionForm(tier)
-            data = form.initial
-
-            # Here we make use of the fact that paypal subscriptions can use
-            # GET as well as POST. A bit hackish.
-            self.stdout.write("{0}?{1}".format(form.action,
-                                               urllib.urlencode(data)))
+            with open(manifest) as manifest_file:
+                rows = read_manifest(manifest_file, format)
+
+        from mirocommunity_saas.models import Tier
+        available_tiers = list(Tier.objects.filter(slug__in=TIER_SLUGS))
+        tiers = dict((tier.slug, tier) for tier in available_tiers)
+
+        for i in xrange(0, len(rows), chunk_size):
+            provisioned = self.provision_chunk(rows[i:i + chunk_size], tiers,
+                                               available_tiers)
+            # Emails and payment urls are only dealt with once the chunk has
+            # been committed.
+            for site_id, tier in provisioned:
+                with current_site(site_id):
+                    url = self.finish_signup(tier)
+                    self.stdout.write('{0} {1}\n'.format(
+                                      Site.objects.get_current().domain, url))
+
+    @transaction.commit_on_success
+    def provision_chunk(self, rows, tiers, available_tiers):
+        """
+        Creates the sites, tier info, site settings and owners for a chunk of
+        manifest rows in one transaction. Returns a list of (site_id, tier)
+        tuples for the sites which were provisioned.
+
+        """
+        from localtv.models import SiteSettings
+        from mirocommunity_saas.models import SiteTierInfo
+        now = datetime.datetime.now()
+
+        # Sites which are already initialized are skipped without saving
+        # anything, so that running a manifest again can't touch live
+        # sites. Rows without a site_id are matched by domain.
+        site_ids = [row['site_id'] for row in rows if row.get('site_id')]
+        domains = [row['domain'] for row in rows if not row.get('site_id')]
+        initialized = SiteTierInfo.objects.filter(
+                                Q(site__in=site_ids) |
+                                Q(site__domain__in=domains)
+                            ).values_list('site', 'site__domain')
+        initialized_ids = set(site_id for site_id, domain in initialized)
+        initialized_domains = set(domain for site_id, domain in initialized)
+
+        new_rows = []
+        for row in rows:
+            if row.get('site_id'):
+                skip = row['site_id'] in initialized_ids
+            else:
+                skip = row['domain'] in initialized_domains
+            if skip:
+                self.stderr.write('Site {0} already initialized.\n'.format(
+                                                                row['domain']))
+                continue
+            if row.get('site_id'):
+                site = Site(pk=row['site_id'])
+            else:
+                site = Site()
+            site.name = row['site_name']
+            site.domain = row['domain']
+            site.save()
+            new_rows.append((site, row))
+        new_site_ids = [site.pk for site, row in new_rows]
+
+        SiteTierInfo.objects.bulk_create([
+            SiteTierInfo(site=site,
+                         tier=tiers[row['tier']],
+                         tier_changed=now,
+                         enforce_payments=True,
+                         site_name=row['site_name'])
+            for site, row in new_rows])
+        tier_info_ids = SiteTierInfo.objects.filter(site__in=new_site_ids
+                                           ).values_list('pk', flat=True)
+        through = SiteTierInfo.available_tiers.through
+        through.objects.bulk_create([
+            through(sitetierinfo_id=tier_info_id, tier_id=tier.pk)
+            for tier_info_id in tier_info_ids
+            for tier in available_tiers])
+
+        have_settings = set(SiteSettings.objects.filter(site__in=new_site_ids
+                                               ).values_list('site',
+                                                             flat=True))
+        SiteSettings.objects.bulk_create([
+            SiteSettings(site_id=site_id) for site_id in new_site_ids
+            if site_id not in have_settings])
+
+        for site, row in new_rows:
+            if row.get('username'):
+                self.create_owner(row['username'], row.get('email'),
+                                  row.get('password'))
+
+        return [(site.pk, tiers[row['tier']]) for site, row in new_rows]
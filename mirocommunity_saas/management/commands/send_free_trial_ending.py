@@ -8,5 +8,9 @@ class Command(NoArgsCommand):
     Command line interface for the send_welcome_email utility function.
 
     """
+    # Model validation imports every installed app's models, which dwarfs
+    # the cost of the command itself when run from cron.
+    requires_model_validation = False
+
     def handle_noargs(self, **options):
         send_free_trial_ending()
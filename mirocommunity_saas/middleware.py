@@ -1,6 +1,108 @@
+from django.conf import settings
 from django.contrib.flatpages.middleware import FlatpageFallbackMiddleware
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import get_resolver
+from django.http import Http404, HttpResponseNotFound
 
-from mirocommunity_saas.models import SiteTierInfo
+from mirocommunity_saas.routers import unpin
+from mirocommunity_saas.utils.entitlements import (CUSTOM_THEMES,
+                                                   RESTRICTED_URLS,
+                                                   has_entitlements,
+                                                   request_entitlements)
+from mirocommunity_saas.utils.sites import (clear_manager_caches,
+                                            domain_site_map)
+
+
+class SiteDomainMiddleware(object):
+	"""
+	Serves each request as the site whose domain matches its Host header,
+	so that one process can serve many sites. Domains are resolved with
+	:data:`.domain_site_map`; unknown hosts get a 404.
+
+	``settings.SITE_ID`` is switched for the duration of the request, so
+	this is only safe with workers which handle one request at a time; it
+	refuses to serve requests from a multithreaded WSGI server. It should
+	come before any middleware which uses the current site. In-process
+	per-site caches are cleared when a worker switches sites.
+
+	"""
+	def __init__(self):
+		self.cached_site_id = settings.SITE_ID
+
+	def process_request(self, request):
+		if request.META.get('wsgi.multithread'):
+			raise ImproperlyConfigured('SiteDomainMiddleware changes '
+									   'settings.SITE_ID for each request, '
+									   'so it can only be used with '
+									   'single-threaded workers.')
+		site_id = domain_site_map.resolve(request.get_host())
+		if site_id is None:
+			return HttpResponseNotFound('Unknown site.')
+		if site_id != self.cached_site_id:
+			clear_manager_caches()
+			self.cached_site_id = site_id
+		request._default_site_id = settings.SITE_ID
+		settings.SITE_ID = site_id
+
+	def process_response(self, request, response):
+		if hasattr(request, '_default_site_id'):
+			settings.SITE_ID = request._default_site_id
+			del request._default_site_id
+		return response
+
+
+class EntitlementMiddleware(object):
+	"""
+	Raises a 404 before any view code runs for requests to urls which the
+	current site's tier isn't entitled to (see :data:`.RESTRICTED_URLS`).
+	Urls are matched by name, so this doesn't depend on where the admin is
+	mounted. Django has already resolved the url by the time
+	:meth:`process_view` runs, so the names are mapped to their views once
+	per urlconf and each request only looks its view up in that map; the
+	tier is only looked up for restricted views. The views check their
+	entitlements themselves as well, so this is optional.
+
+	"""
+	def __init__(self):
+		self.restricted_urls = getattr(settings,
+									   'MIROCOMMUNITY_SAAS_RESTRICTED_URLS',
+									   RESTRICTED_URLS)
+		self._restricted_views = {}
+
+	def restricted_views(self, urlconf=None):
+		"""
+		Returns a dictionary mapping the views behind the restricted urls in
+		the given urlconf to the entitlements they require.
+
+		"""
+		try:
+			return self._restricted_views[urlconf]
+		except KeyError:
+			pass
+		# The reverse dictionary lists each pattern under both its name and
+		# its view, so views are matched to names through their patterns.
+		reverse_dict = get_resolver(urlconf).reverse_dict
+		restricted_patterns = []
+		for name, required in self.restricted_urls.items():
+			patterns = reverse_dict.getlist(name)
+			restricted_patterns.extend((pattern, required)
+									   for pattern in patterns)
+		views = {}
+		for key in reverse_dict.keys():
+			if not callable(key):
+				continue
+			patterns = reverse_dict.getlist(key)
+			for pattern, required in restricted_patterns:
+				if pattern in patterns:
+					views[key] = views.get(key, 0) | required
+		self._restricted_views[urlconf] = views
+		return views
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		views = self.restricted_views(getattr(request, 'urlconf', None))
+		required = views.get(view_func, 0)
+		if required and not has_entitlements(request, required):
+			raise Http404
 
 
 class TierFlatpageMiddleware(FlatpageFallbackMiddleware):
@@ -10,8 +112,24 @@ class TierFlatpageMiddleware(FlatpageFallbackMiddleware):
 
 	"""
 	def process_response(self, request, response):
-		tier = SiteTierInfo.objects.get_current().tier
-		if not tier.custom_themes:
+		# Flatpages only replace 404s, so the tier can wait until then.
+		if (response.status_code != 404 or
+			not request_entitlements(request) & CUSTOM_THEMES):
 			return response
 		return super(TierFlatpageMiddleware, self).process_response(request,
 															        response)
+
+
+class ReadReplicaMiddleware(object):
+	"""
+	Makes sure that each request starts reading from the read replica, no
+	matter what the previous request handled by the thread wrote. See
+	:class:`.ReadReplicaRouter`.
+
+	"""
+	def process_request(self, request):
+		unpin()
+
+	def process_response(self, request, response):
+		unpin()
+		return response
@@ -5,6 +5,8 @@ from django.db import models
 from localtv.managers import SiteRelatedManager
 from paypal.standard.ipn.models import PayPalIPN
 
+from mirocommunity_saas.routers import write_database
+from mirocommunity_saas.utils.entitlements import entitlement_mask
 from mirocommunity_saas.utils.functional import cached_property
 from mirocommunity_saas.utils.subscriptions import (get_subscriptions,
                                                     get_current_subscription)
@@ -41,6 +43,15 @@ class Tier(models.Model):
     def __unicode__(self):
         return u"{name}: {price}".format(name=self.name, price=self.price)
 
+    @property
+    def entitlements(self):
+        """
+        A bitmask of what the tier allows; see
+        :mod:`mirocommunity_saas.utils.entitlements`.
+
+        """
+        return entitlement_mask(self)
+
 
 class SiteTierInfoManager(SiteRelatedManager):
     def _new_entry(self, site, using):
@@ -50,8 +61,13 @@ class SiteTierInfoManager(SiteRelatedManager):
             tier = Tier.objects.get(price=0)
         except Tier.DoesNotExist:
             raise self.model.DoesNotExist
+        now = datetime.datetime.now()
+        # The lookup may have gone to the read replica; the new entry has to
+        # be written to the primary.
+        using = write_database(using)
         return self.db_manager(using).create(site=site, tier=tier,
-                                         tier_changed=datetime.datetime.now())
+                                             tier_changed=now,
+                                             created=now)
 
 
 class SiteTierInfo(models.Model):
@@ -77,8 +93,13 @@ class SiteTierInfo(models.Model):
     #: payments are coming in.
     enforce_payments = models.BooleanField(default=False)
 
+    #: Date and time when the site signed up.
+    created = models.DateTimeField(default=datetime.datetime.now,
+                                   db_index=True)
+
     #: The datetime when the welcome email was sent to this site's owner.
-    welcome_email_sent = models.DateTimeField(blank=True, null=True)
+    welcome_email_sent = models.DateTimeField(blank=True, null=True,
+                                              db_index=True)
 
     #: The datetime when a "free trial ending" email was sent to the site's
     #: owner.
@@ -116,3 +137,29 @@ class SiteTierInfo(models.Model):
                                           txn_type__in=('subscr_signup',
                                                         'subscr_modify'))
         return self.subscriptions or subscr_ipns.exists()
+
+
+class FleetJob(models.Model):
+    """
+    A summary of one run of a job across many sites. See
+    :func:`mirocommunity_saas.tasks.run_fleet_job`.
+
+    """
+    #: The name of the job, as registered in ``tasks.FLEET_JOBS``.
+    name = models.CharField(max_length=50)
+
+    #: When the run started and finished.
+    started = models.DateTimeField(default=datetime.datetime.now)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    #: Number of sites the job was run for, and for how many it succeeded.
+    site_count = models.PositiveIntegerField(default=0)
+    success_count = models.PositiveIntegerField(default=0)
+
+    #: JSON object mapping the id of each site where the job failed to a
+    #: description of the error.
+    failures = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return u"{name} ({started})".format(name=self.name,
+                                             started=self.started)
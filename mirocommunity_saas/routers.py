@@ -0,0 +1,92 @@
+import threading
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+_state = threading.local()
+
+
+def replica_alias():
+    """
+    Returns the alias of the read replica: the
+    ``MIROCOMMUNITY_SAAS_READ_DATABASE`` setting, or ``'replica'``.
+
+    """
+    return getattr(settings, 'MIROCOMMUNITY_SAAS_READ_DATABASE', 'replica')
+
+
+def pin_to_primary():
+    """
+    Sends every read for the rest of the current request or task to the
+    primary, so that it sees what's just been written.
+
+    """
+    _state.pinned = True
+
+
+def unpin():
+    _state.pinned = False
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+def read_database():
+    """
+    Returns the alias to use for pure reads: the read replica if one is
+    configured and nothing has been written in the current request or task,
+    or the primary otherwise.
+
+    """
+    alias = replica_alias()
+    if is_pinned() or alias not in connections.databases:
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+def write_database(using=None):
+    """
+    Returns the alias to write to, given the alias an object was read from
+    (or ``None``): the primary in place of the read replica.
+
+    """
+    if using is None or using == replica_alias():
+        return DEFAULT_DB_ALIAS
+    return using
+
+
+class ReadReplicaRouter(object):
+    """
+    Sends reads of ``mirocommunity_saas`` models to the read replica (see
+    :func:`read_database`) and writes to the primary. Any write pins the
+    rest of the request or task to the primary. Models from other apps are
+    left to the other routers; code which only reads them can ask for
+    :func:`read_database` explicitly.
+
+    """
+    app_label = 'mirocommunity_saas'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return read_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            pin_to_primary()
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica has the same rows as the primary.
+        aliases = (DEFAULT_DB_ALIAS, replica_alias())
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db == replica_alias():
+            return False
+        return None
@@ -0,0 +1,98 @@
+/*
+ * Keeps the moderation pages' approve links in step with the site's video
+ * quota. The admin nav renders the remaining quota as data-videos-remaining
+ * (empty if the site has no limit), along with the url of the quota status
+ * endpoint and the approve urls to watch. Once the quota is used up,
+ * approve links are disabled instead of being sent off to fail with a 402.
+ * Bulk approvals report how many videos are left, which is used directly;
+ * after any other moderation request the quota is checked again (the
+ * endpoint sends an ETag, so that's usually a 304).
+ */
+(function ($) {
+    $(function () {
+        var $nav = $('#new_admin_nav'),
+            remaining = $nav.data('videos-remaining'),
+            quotaUrl = $nav.data('quota-url'),
+            approveUrls = String($nav.data('approve-urls') || '').split(' '),
+            selector,
+            message = 'You have reached your video limit. Upgrade to ' +
+                      'approve more videos.';
+
+        if (remaining === undefined || remaining === '' || !quotaUrl) {
+            return;
+        }
+        selector = $.map(approveUrls, function (url) {
+            return 'a[href^="' + url + '"]';
+        }).join(', ');
+
+        function isQueue(link) {
+            return /[?&]queue=/.test(link.href);
+        }
+
+        function update() {
+            $(selector).filter(function () {
+                return !isQueue(this);
+            }).toggleClass('disabled', remaining < 1)
+              .attr('title', remaining < 1 ? message : null);
+        }
+
+        function setRemaining(count) {
+            remaining = count === null ? Infinity : count;
+            update();
+        }
+
+        function refresh() {
+            $.ajax({
+                url: quotaUrl,
+                dataType: 'json',
+                global: false,
+                success: function (status) {
+                    if (status && status.videos) {
+                        setRemaining(status.videos.remaining);
+                    }
+                }
+            });
+        }
+
+        // Returns the remaining count reported by a bulk approval's JSON
+        // response, or undefined if the response doesn't have one.
+        function reportedRemaining(xhr) {
+            var data;
+            if (!/json/.test(xhr.getResponseHeader('Content-Type') || '')) {
+                return undefined;
+            }
+            try {
+                data = $.parseJSON(xhr.responseText);
+            } catch (e) {
+                return undefined;
+            }
+            return data && data.hasOwnProperty('remaining') ?
+                   data.remaining : undefined;
+        }
+
+        // Listen in the capture phase so that a doomed approval is stopped
+        // before the page's own handlers send it.
+        document.addEventListener('click', function (event) {
+            var link = $(event.target).closest(selector)[0];
+            if (!link || isQueue(link)) {
+                return;
+            }
+            if (remaining < 1) {
+                event.preventDefault();
+                event.stopPropagation();
+                update();
+            }
+        }, true);
+        // Moderation requests and search results are loaded over ajax.
+        $(document).ajaxComplete(function (event, xhr) {
+            var count = reportedRemaining(xhr);
+            if (count !== undefined) {
+                setRemaining(count);
+            } else {
+                update();
+                refresh();
+            }
+        });
+        update();
+    });
+}(jQuery));
@@ -1,26 +1,774 @@
 from __future__ import absolute_import
+from bisect import bisect
+from contextlib import contextmanager
+import datetime
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
 import random
+import threading
+import time
+from StringIO import StringIO
 
 from boto.s3.connection import OrdinaryCallingFormat
+from boto.utils import parse_ts
+from django.core.files import File
 from storages.backends.s3boto import S3BotoStorage
 
+from mirocommunity_saas.utils.functional import LRUCache
+
+
+def _hash(value):
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
 
 class MultiCallingFormat(OrdinaryCallingFormat):
     """
     Calling formats generate URLs; by using multiple calling formats, it's
     possible to get browsers to download with higher concurrency.
 
+    By default, a format is picked at random for every URL. If
+    ``deterministic`` is ``True``, each key is instead always given the same
+    format (so browsers and CDNs can cache it) by placing the formats on a
+    consistent hash ring. Formats are identified by their position, so new
+    formats should be appended to the list; each one added then only takes
+    over roughly its share of the keys.
+
     """
-    def __init__(self, formats):
+    #: Number of points each format gets on the hash ring.
+    replicas = 100
+
+    def __init__(self, formats, deterministic=False):
         self.formats = formats
+        self.deterministic = deterministic
+        ring = sorted((_hash('{0}-{1}'.format(index, replica)), index)
+                      for index in xrange(len(formats))
+                      for replica in xrange(self.replicas))
+        self._ring_hashes = [point for point, index in ring]
+        self._ring_formats = [formats[index] for point, index in ring]
+
+    def get_format(self, key):
+        """Returns the calling format which should be used for ``key``."""
+        if not self.deterministic:
+            return random.choice(self.formats)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        position = bisect(self._ring_hashes, _hash(key))
+        return self._ring_formats[position % len(self._ring_formats)]
 
     def build_url_base(self, connection, protocol, server, bucket, key=''):
-        format = random.choice(self.formats)
+        format = self.get_format(key)
         return format.build_url_base(connection, protocol, server, bucket,
                                      key)
 
 
-class StaticBotoStorage(S3BotoStorage):
+class CachedURLMixin(object):
+    """
+    Remembers the URLs generated by :meth:`url`, since building them goes
+    through boto's key and calling format machinery and templates ask for
+    the same static URLs on every page. Unsigned URLs are kept until they
+    fall out of the cache; signed (querystring auth) URLs are regenerated
+    shortly before they expire.
+
+    """
+    #: Maximum number of URLs to remember.
+    url_cache_size = 2048
+    #: Number of seconds before a signed URL expires that it stops being
+    #: served from the cache.
+    url_expiry_margin = 60
+
+    def __init__(self, *args, **kwargs):
+        super(CachedURLMixin, self).__init__(*args, **kwargs)
+        self._url_cache = LRUCache(self.url_cache_size)
+
+    def _url_expires(self):
+        if self.custom_domain or not self.querystring_auth:
+            return None
+        margin = min(self.url_expiry_margin, self.querystring_expire / 10)
+        return time.time() + self.querystring_expire - margin
+
+    def url(self, name):
+        key = (name, self.calling_format)
+        cached = self._url_cache.get(key)
+        if cached is not None:
+            url, expires = cached
+            if expires is None or time.time() < expires:
+                return url
+        url = self._generate_url(name)
+        self._url_cache.set(key, (url, self._url_expires()))
+        return url
+
+    def _generate_url(self, name):
+        """Builds the URL for ``name`` when it isn't cached."""
+        return super(CachedURLMixin, self).url(name)
+
+
+MANIFEST_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class ManifestMixin(object):
+    """
+    Answers :meth:`exists`, :meth:`size` and :meth:`modified_time` from an
+    in-memory index of the storage's files instead of asking S3 each time,
+    which matters for ``collectstatic`` and django-compressor.
+
+    The mode is controlled by the ``manifest`` keyword argument, which
+    defaults to the ``MIROCOMMUNITY_SAAS_STORAGE_MANIFEST`` setting:
+
+    * ``False``: disabled; every call goes to S3.
+    * ``True``: the bucket is listed (under this storage's location) once, the
+      first time the index is needed.
+    * A path: the index is loaded from that JSON file if it exists (or
+      listed otherwise) and can be written back with :meth:`save_manifest`.
+
+    The index is kept up to date by :meth:`_save` and :meth:`delete`.
+
+    """
+    def __init__(self, *args, **kwargs):
+        from django.conf import settings
+        manifest = kwargs.pop('manifest',
+                              getattr(settings,
+                                      'MIROCOMMUNITY_SAAS_STORAGE_MANIFEST',
+                                      False))
+        super(ManifestMixin, self).__init__(*args, **kwargs)
+        self.manifest = bool(manifest)
+        self.manifest_path = (manifest if isinstance(manifest, basestring)
+                              else None)
+        self._manifest_lock = threading.RLock()
+        self._index = None
+
+    def _manifest_name(self, name):
+        return self._normalize_name(self._clean_name(name))
+
+    def _manifest_prefix(self):
+        prefix = self._normalize_name('')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return prefix
+
+    def _list_index(self):
+        index = {}
+        for key in self.bucket.list(prefix=self._manifest_prefix()):
+            modified = parse_ts(key.last_modified)
+            index[key.name] = {
+                'size': key.size,
+                'modified': modified.strftime(MANIFEST_TIME_FORMAT),
+                'etag': key.etag,
+            }
+        return index
+
+    def _load_index(self):
+        if self.manifest_path and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        return self._list_index()
+
+    @property
+    def index(self):
+        """A dictionary mapping S3 key names to their metadata."""
+        if self._index is None:
+            index = self._load_index()
+            with self._manifest_lock:
+                if self._index is None:
+                    self._index = index
+        return self._index
+
+    def save_manifest(self):
+        """
+        Writes this storage's part of the index to the manifest file, keeping
+        entries that belong to other locations.
+
+        """
+        if not self.manifest_path:
+            raise ValueError('No manifest path configured.')
+        prefix = self._manifest_prefix()
+        data = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                data = dict((name, entry)
+                            for name, entry in json.load(manifest_file).items()
+                            if not name.startswith(prefix))
+        with self._manifest_lock:
+            data.update(self.index)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(data, manifest_file, sort_keys=True)
+        os.rename(tmp_path, self.manifest_path)
+
+    def exists(self, name):
+        if not self.manifest:
+            return super(ManifestMixin, self).exists(name)
+        return self._manifest_name(name) in self.index
+
+    def size(self, name):
+        if self.manifest:
+            entry = self.index.get(self._manifest_name(name))
+            if entry is not None:
+                return entry['size']
+        return super(ManifestMixin, self).size(name)
+
+    def modified_time(self, name):
+        if self.manifest:
+            entry = self.index.get(self._manifest_name(name))
+            if entry is not None:
+                # Times are kept in UTC, and S3BotoStorage returns them as
+                # naive UTC datetimes too.
+                return datetime.datetime.strptime(entry['modified'],
+                                                  MANIFEST_TIME_FORMAT)
+        return super(ManifestMixin, self).modified_time(name)
+
+    def _record(self, name, size, etag=None):
+        if self.manifest:
+            entry = {
+                'size': size,
+                'modified': datetime.datetime.utcnow().strftime(
+                                                    MANIFEST_TIME_FORMAT),
+                'etag': etag,
+            }
+            with self._manifest_lock:
+                self.index[self._manifest_name(name)] = entry
+
+    def _save(self, name, content):
+        cleaned_name = super(ManifestMixin, self)._save(name, content)
+        self._record(cleaned_name, content.size)
+        return cleaned_name
+
+    def delete(self, name):
+        super(ManifestMixin, self).delete(name)
+        if self.manifest:
+            with self._manifest_lock:
+                self.index.pop(self._manifest_name(name), None)
+
+
+class SyncResult(object):
+    """The outcome of :meth:`SyncMixin.sync`."""
+    def __init__(self):
+        #: Names of the files which were uploaded or skipped.
+        self.uploaded = []
+        self.skipped = []
+        self.bytes_uploaded = 0
+        self.bytes_skipped = 0
+        #: Wall time the sync took, in seconds.
+        self.seconds = 0
+
+    @property
+    def seconds_saved(self):
+        """
+        An estimate of the upload time saved by skipping unchanged files,
+        based on the throughput of the files which were uploaded.
+
+        """
+        if not self.bytes_uploaded:
+            return None
+        return self.bytes_skipped * self.seconds / self.bytes_uploaded
+
+    def __repr__(self):
+        return ('<SyncResult: {0} uploaded ({1} bytes), {2} skipped ({3} '
+                'bytes) in {4:.2f}s>').format(len(self.uploaded),
+                                              self.bytes_uploaded,
+                                              len(self.skipped),
+                                              self.bytes_skipped,
+                                              self.seconds)
+
+
+def _file_etag(path, part_size, multipart_threshold):
+    """
+    Returns the ETag S3 would give the file at ``path``: its MD5 digest, or
+    for multipart uploads, the digest of the parts' digests followed by the
+    number of parts.
+
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < multipart_threshold:
+            return hashlib.md5(f.read()).hexdigest()
+        digests = [hashlib.md5(chunk).digest()
+                   for chunk in iter(lambda: f.read(part_size), '')]
+    return '{0}-{1}'.format(hashlib.md5(''.join(digests)).hexdigest(),
+                            len(digests))
+
+
+class SyncMixin(object):
+    """
+    Adds :meth:`sync`, which uploads a set of local files concurrently,
+    skipping any whose content already matches what is stored. Remote
+    ETags come from the manifest index if there is one (see
+    :class:`ManifestMixin`, which this must come before) or from a listing
+    of the bucket otherwise.
+
+    """
+    #: Files at least this large are uploaded in parts of ``sync_part_size``.
+    sync_multipart_threshold = 16 * 1024 * 1024
+    sync_part_size = 8 * 1024 * 1024
+    #: Default number of upload threads.
+    sync_workers = 8
+
+    def _remote_etags(self):
+        index = self.index if self.manifest else self._list_index()
+        return dict((name, (entry['etag'] or '').strip('"'))
+                    for name, entry in index.items())
+
+    def _upload_multipart(self, name, path):
+        key_name = self._encode_name(self._manifest_name(name))
+        content_type = (mimetypes.guess_type(name)[0] or
+                        'application/octet-stream')
+        headers = dict(self.headers)
+        headers['Content-Type'] = content_type
+        upload = self.bucket.initiate_multipart_upload(
+                                    key_name, headers=headers,
+                                    reduced_redundancy=self.reduced_redundancy,
+                                    policy=self.default_acl)
+        try:
+            with open(path, 'rb') as f:
+                part_num = 1
+                while True:
+                    chunk = f.read(self.sync_part_size)
+                    if not chunk:
+                        break
+                    upload.upload_part_from_file(StringIO(chunk), part_num)
+                    part_num += 1
+            upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
+
+    def _upload(self, name, path, size, etag):
+        if size >= self.sync_multipart_threshold:
+            self._upload_multipart(name, path)
+        else:
+            with open(path, 'rb') as f:
+                super(SyncMixin, self)._save(name, File(f))
+        self._record(name, size, etag)
+
+    def sync(self, files, workers=None):
+        """
+        Uploads the given files, which should be an iterable of (name,
+        local path) tuples, using up to ``workers`` threads. Files whose
+        digest matches the stored ETag are skipped. Returns a
+        :class:`SyncResult`.
+
+        """
+        from multiprocessing.pool import ThreadPool
+        start = time.time()
+        result = SyncResult()
+        remote = self._remote_etags()
+        to_upload = []
+        for name, path in files:
+            size = os.path.getsize(path)
+            etag = _file_etag(path, self.sync_part_size,
+                              self.sync_multipart_threshold)
+            if remote.get(self._manifest_name(name)) == etag:
+                result.skipped.append(name)
+                result.bytes_skipped += size
+            else:
+                to_upload.append((name, path, size, etag))
+
+        if to_upload:
+            pool = ThreadPool(min(workers or self.sync_workers,
+                                  len(to_upload)))
+            try:
+                pool.map(lambda args: self._upload(*args), to_upload)
+            finally:
+                pool.close()
+                pool.join()
+        for name, path, size, etag in to_upload:
+            result.uploaded.append(name)
+            result.bytes_uploaded += size
+        result.seconds = time.time() - start
+        return result
+
+
+class PrecompressMixin(object):
+    """
+    Writes a gzip-encoded, content-hashed copy alongside each CSS and JS
+    file that is saved, with ``Content-Encoding`` and far-future
+    ``Cache-Control`` headers, and makes :meth:`url` point at that copy. S3
+    can't negotiate encodings, so this assumes every client accepts gzip.
+
+    The mode is controlled by the ``precompress`` keyword argument, which
+    defaults to the ``MIROCOMMUNITY_SAAS_STORAGE_PRECOMPRESS`` setting. With a
+    manifest (see :class:`ManifestMixin`, which this must come before),
+    copies saved by earlier processes are found through the original's
+    ETag; otherwise only copies saved by this storage instance are used.
+
+    """
+    #: Extensions of the files which get a gzipped copy.
+    precompress_extensions = ('.css', '.js')
+    #: Cache-Control header for the gzipped copies. Their names change with
+    #: their content, so they can be cached forever.
+    precompress_cache_control = 'public, max-age=31536000'
+    #: Number of digest characters used in the copies' names.
+    precompress_hash_length = 12
+
+    def __init__(self, *args, **kwargs):
+        from django.conf import settings
+        precompress = kwargs.pop('precompress', getattr(settings,
+                                'MIROCOMMUNITY_SAAS_STORAGE_PRECOMPRESS',
+                                False))
+        super(PrecompressMixin, self).__init__(*args, **kwargs)
+        self.precompress = precompress
+        self._precompressed = {}
+
+    def _should_precompress(self, name):
+        return (self.precompress and
+                os.path.splitext(name)[1] in self.precompress_extensions)
+
+    def precompressed_name(self, name, digest):
+        """
+        Returns the name of the gzipped copy of ``name`` for content with the
+        given MD5 hex digest, e.g. ``css/base.0123456789ab.css.gz``.
+
+        """
+        root, ext = os.path.splitext(name)
+        return '{0}.{1}{2}.gz'.format(root,
+                                      digest[:self.precompress_hash_length],
+                                      ext)
+
+    def _find_precompressed(self, name):
+        cleaned_name = self._clean_name(name)
+        if cleaned_name in self._precompressed:
+            return self._precompressed[cleaned_name]
+        if not getattr(self, 'manifest', False):
+            return None
+        entry = self.index.get(self._manifest_name(cleaned_name))
+        etag = ((entry or {}).get('etag') or '').strip('"')
+        # Multipart ETags aren't digests of the content.
+        if not etag or '-' in etag:
+            return None
+        gzip_name = self.precompressed_name(cleaned_name, etag)
+        if self._manifest_name(gzip_name) not in self.index:
+            return None
+        self._precompressed[cleaned_name] = gzip_name
+        return gzip_name
+
+    def _save_precompressed(self, name, data, digest):
+        gzip_name = self.precompressed_name(name, digest)
+        if not (getattr(self, 'manifest', False) and
+                self._manifest_name(gzip_name) in self.index):
+            buf = StringIO()
+            gzip_file = gzip.GzipFile(filename=os.path.basename(name),
+                                      mode='wb', compresslevel=9,
+                                      fileobj=buf)
+            try:
+                gzip_file.write(data)
+            finally:
+                gzip_file.close()
+            compressed = buf.getvalue()
+            headers = dict(self.headers)
+            headers.update({
+                'Content-Type': (mimetypes.guess_type(name)[0] or
+                                 'application/octet-stream'),
+                'Content-Encoding': 'gzip',
+                'Cache-Control': self.precompress_cache_control,
+            })
+            key = self.bucket.new_key(self._encode_name(
+                            self._normalize_name(self._clean_name(gzip_name))))
+            key.set_contents_from_string(
+                            compressed, headers=headers,
+                            policy=self.default_acl,
+                            reduced_redundancy=self.reduced_redundancy)
+            if hasattr(self, '_record'):
+                self._record(gzip_name, len(compressed),
+                             hashlib.md5(compressed).hexdigest())
+        self._precompressed[name] = gzip_name
+
+    def _save(self, name, content):
+        if not self._should_precompress(name):
+            return super(PrecompressMixin, self)._save(name, content)
+        content.seek(0)
+        data = content.read()
+        content.seek(0)
+        cleaned_name = super(PrecompressMixin, self)._save(name, content)
+        digest = hashlib.md5(data).hexdigest()
+        if hasattr(self, '_record'):
+            # Keep the digest so that the copy can be found again later.
+            self._record(cleaned_name, len(data), digest)
+        self._save_precompressed(cleaned_name, data, digest)
+        return cleaned_name
+
+    def delete(self, name):
+        gzip_name = None
+        if self._should_precompress(name):
+            gzip_name = self._find_precompressed(name)
+        super(PrecompressMixin, self).delete(name)
+        if gzip_name is not None:
+            super(PrecompressMixin, self).delete(gzip_name)
+            self._precompressed.pop(self._clean_name(name), None)
+
+    def url(self, name):
+        if self._should_precompress(name):
+            gzip_name = self._find_precompressed(name)
+            if gzip_name is not None:
+                name = gzip_name
+        return super(PrecompressMixin, self).url(name)
+
+
+class S3ConnectionPool(object):
+    """
+    A bounded pool of boto S3 connections, created by calling ``factory``.
+    Connections are handed out most recently used first, so that their
+    keep-alive HTTP connections stay warm, and ones which have been idle for
+    more than ``idle_timeout`` seconds are closed rather than reused. When
+    ``max_size`` connections are in use, :meth:`acquire` waits for one to be
+    released.
+
+    """
+    def __init__(self, factory, max_size=10, idle_timeout=60):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._condition = threading.Condition()
+        #: (connection, time released) tuples, oldest first.
+        self._idle = []
+        #: Number of connections which exist, in use or idle.
+        self._size = 0
+        self.hits = 0
+        self.creations = 0
+        self.evictions = 0
+        #: Number of acquisitions which had to wait, and the total seconds
+        #: spent waiting.
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _close(self, connection):
+        self._size -= 1
+        self._condition.notify()
+        connection.close()
+
+    def _evict(self):
+        cutoff = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][1] < cutoff:
+            connection, released = self._idle.pop(0)
+            self.evictions += 1
+            self._close(connection)
+
+    def acquire(self):
+        start = None
+        with self._condition:
+            while True:
+                self._evict()
+                if self._idle:
+                    connection, released = self._idle.pop()
+                    self.hits += 1
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    connection = None
+                    break
+                if start is None:
+                    start = time.time()
+                    self.waits += 1
+                self._condition.wait()
+            if start is not None:
+                self.wait_time += time.time() - start
+
+        if connection is None:
+            try:
+                connection = self.factory()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+            with self._condition:
+                self.creations += 1
+        return connection
+
+    def release(self, connection):
+        with self._condition:
+            self._idle.append((connection, time.time()))
+            self._condition.notify()
+
+    def close(self):
+        """Closes all the idle connections."""
+        with self._condition:
+            while self._idle:
+                connection, released = self._idle.pop()
+                self._close(connection)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'hits': self.hits,
+                'creations': self.creations,
+                'evictions': self.evictions,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'size': self._size,
+                'idle': len(self._idle),
+            }
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(key, factory, max_size, idle_timeout):
+    """
+    Returns the :class:`S3ConnectionPool` for ``key``, creating it if
+    necessary, so that storages with the same credentials and bucket share
+    their connections.
+
+    """
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = S3ConnectionPool(factory, max_size,
+                                                      idle_timeout)
+        return _connection_pools[key]
+
+
+def close_connection_pools():
+    """
+    Closes and forgets all the connection pools. Worker processes should
+    call this after forking so that they don't share sockets with their
+    parent; celery workers do so (see :mod:`mirocommunity_saas.tasks`).
+
+    """
+    with _connection_pools_lock:
+        for pool in _connection_pools.values():
+            pool.close()
+        _connection_pools.clear()
+
+
+class PooledConnectionMixin(object):
+    """
+    Replaces S3BotoStorage's single lazily created connection, which isn't
+    safe to share between threads, with connections from a shared
+    :class:`S3ConnectionPool`. Each storage operation binds a connection to
+    the calling thread for its duration (nested operations reuse it), and
+    :attr:`connection` and :attr:`bucket` return the bound connection and a
+    bucket on it. This must come before the other mixins so that their S3
+    calls happen inside the operation. URLs only borrow a connection when
+    :class:`CachedURLMixin` has to build one which isn't cached and isn't on
+    a custom domain.
+
+    Files returned by :meth:`open` keep using the connection their key was
+    fetched with, so they're opened outside of any operation. There, as
+    anywhere else outside of one, :attr:`connection` makes a new connection
+    which isn't pooled or kept by the storage; it's closed once whatever
+    uses it is garbage collected.
+
+    """
+    #: Maximum number of connections per credentials and bucket.
+    connection_pool_size = 10
+    #: Seconds after which an idle connection is closed.
+    connection_idle_timeout = 60
+
+    def __init__(self, *args, **kwargs):
+        super(PooledConnectionMixin, self).__init__(*args, **kwargs)
+        self._local = threading.local()
+        self._connection_lock = threading.Lock()
+        self._bucket_checked = False
+        self.connection_pool = get_connection_pool(
+                            (self.access_key, self.bucket_name,
+                             self.calling_format),
+                            self._new_connection, self.connection_pool_size,
+                            self.connection_idle_timeout)
+
+    def _new_connection(self):
+        # Let S3BotoStorage build the connection (its arguments vary between
+        # versions of django-storages), then detach it from the instance.
+        with self._connection_lock:
+            self._connection = None
+            connection = super(PooledConnectionMixin, self).connection
+            self._connection = None
+        return connection
+
+    @contextmanager
+    def borrow_connection(self):
+        """Binds a pooled connection to the current thread."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            yield connection
+            return
+        connection = self.connection_pool.acquire()
+        self._local.connection = connection
+        self._local.bucket = None
+        try:
+            yield connection
+        finally:
+            self._local.connection = self._local.bucket = None
+            self.connection_pool.release(connection)
+
+    def connection_stats(self):
+        """Returns a dictionary of statistics about the connection pool."""
+        return self.connection_pool.stats()
+
+    def _is_borrowing(self):
+        return getattr(self._local, 'connection', None) is not None
+
+    @property
+    def connection(self):
+        if self._is_borrowing():
+            return self._local.connection
+        return self._new_connection()
+
+    def _get_bucket(self):
+        if not self._bucket_checked:
+            # Let S3BotoStorage check for (or create) the bucket once.
+            bucket = self._get_or_create_bucket(self.bucket_name)
+            self._bucket_checked = True
+            return bucket
+        return self.connection.get_bucket(self.bucket_name, validate=False)
+
+    @property
+    def bucket(self):
+        if not self._is_borrowing():
+            return self._get_bucket()
+        if self._local.bucket is None:
+            self._local.bucket = self._get_bucket()
+        return self._local.bucket
+
+    def _save(self, name, content):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self)._save(name, content)
+
+    def delete(self, name):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self).delete(name)
+
+    def exists(self, name):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self).exists(name)
+
+    def listdir(self, path):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self).listdir(path)
+
+    def size(self, name):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self).size(name)
+
+    def modified_time(self, name):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self).modified_time(name)
+
+    def _generate_url(self, name):
+        if self.custom_domain:
+            return super(PooledConnectionMixin, self)._generate_url(name)
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self)._generate_url(name)
+
+    def _load_index(self):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self)._load_index()
+
+    def save_manifest(self):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self).save_manifest()
+
+    def _remote_etags(self):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self)._remote_etags()
+
+    def _upload(self, *args, **kwargs):
+        with self.borrow_connection():
+            return super(PooledConnectionMixin, self)._upload(*args, **kwargs)
+
+
+class StaticBotoStorage(PooledConnectionMixin, SyncMixin, ManifestMixin,
+                        CachedURLMixin, S3BotoStorage):
     """
     By default, uses 'static' as the location for this storage's instances.
 
@@ -32,9 +780,12 @@ class StaticBotoStorage(S3BotoStorage):
         super(StaticBotoStorage, self).__init__(**kwargs)
 
 
-class CompressedBotoStorage(S3BotoStorage):
+class CompressedBotoStorage(PooledConnectionMixin, SyncMixin,
+                            PrecompressMixin, ManifestMixin, CachedURLMixin,
+                            S3BotoStorage):
     """
-    Adds 'compressed' to the location for this storage's instances.
+    Adds 'compressed' to the location for this storage's instances, and can
+    serve its CSS and JS gzipped (see :class:`PrecompressMixin`).
 
     """
     def __init__(self, *args, **kwargs):
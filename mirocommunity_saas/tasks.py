@@ -1,13 +1,216 @@
-from celery.task import task
+import datetime
+import json
+import logging
+import sys
 
-from mirocommunity_saas.utils.mail import send_welcome_email
+from celery.signals import task_postrun, task_prerun, worker_process_init
+from celery.task import periodic_task, task
+from django.db import transaction
+
+from mirocommunity_saas.models import FleetJob, SiteTierInfo
+from mirocommunity_saas.routers import unpin, write_database
+from mirocommunity_saas.utils.mail import (send_welcome_email,
+                                           send_pending_welcome_emails,
+                                           send_video_limit_warning,
+                                           send_free_trial_ending)
+from mirocommunity_saas.utils.sites import current_site, saas_site_ids
+
+
+#: Default number of sites handled by each chunk task of a fleet job.
+FLEET_CHUNK_SIZE = 50
+#: Default maximum number of chunk tasks of a fleet job running at once. Each
+#: running chunk holds one database connection.
+FLEET_CONCURRENCY = 4
+
+
+def _unpin(**kwargs):
+	# Each task starts reading from the read replica, whatever the last task
+	# run by this worker wrote.
+	unpin()
+task_prerun.connect(_unpin)
+task_postrun.connect(_unpin)
+
+
+def _close_connection_pools(**kwargs):
+	# Pooled S3 connections inherited from the parent process would share its
+	# sockets. The storages are only checked if they've been imported, since
+	# they need boto.
+	storages = sys.modules.get('mirocommunity_saas.storages')
+	if storages is not None:
+		storages.close_connection_pools()
+worker_process_init.connect(_close_connection_pools)
+
+
+def _enforce_current_tier():
+	from mirocommunity_saas.utils.tiers import enforce_tier
+	enforce_tier(SiteTierInfo.objects.get_current().tier)
+
+
+def _reconcile_tier():
+	from mirocommunity_saas.utils.tiers import reconcile_tier
+	reconcile_tier()
+
+
+#: Jobs which can be run across the fleet with :func:`run_fleet_job`. Each
+#: is called with no arguments while its site is the current site.
+FLEET_JOBS = {
+	'video_limit_warning': send_video_limit_warning,
+	'free_trial_ending': send_free_trial_ending,
+	'welcome_email': send_welcome_email,
+	'enforce_tier': _enforce_current_tier,
+	'reconcile_tier': _reconcile_tier,
+}
+
+
+@task(ignore_result=True)
+def welcome_email_task(using='default', site_id=None):
+	"""
+	Deprecated: welcome emails are now sent by
+	:func:`welcome_email_sweep_task`. This is only kept so that tasks
+	queued before the sweep was introduced still run, and will be removed
+	in the next release.
+
+	"""
+	if site_id is None:
+		send_welcome_email()
+	else:
+		with current_site(site_id):
+			send_welcome_email()
+
+
+@periodic_task(run_every=datetime.timedelta(minutes=5), ignore_result=True)
+def welcome_email_sweep_task():
+	"""
+	Sends welcome emails to every site that signed up more than the grace
+	period ago and hasn't received one yet. This replaces scheduling a
+	delayed task per signup.
+
+	"""
+	send_pending_welcome_emails()
+
+
+@task(ignore_result=True)
+def reconcile_tier_task(using='default', site_id=None):
+	"""
+	Brings the site's tier in line with its subscription. The 'using' kwarg
+	is only here as part of the settings hack. If ``site_id`` is given, the
+	site is reconciled instead of the current one.
+
+	"""
+	if site_id is None:
+		_reconcile_tier()
+	else:
+		with current_site(site_id):
+			_reconcile_tier()
+
+
+@periodic_task(run_every=datetime.timedelta(hours=1), ignore_result=True)
+def reconcile_tiers_sweep_task():
+	"""
+	Reconciles the tiers of every site whose payments are enforced, to catch
+	any drift that IPNs didn't (for example, a subscription running out).
+
+	"""
+	site_ids = list(SiteTierInfo.objects.filter(enforce_payments=True
+										).values_list('site', flat=True))
+	if site_ids:
+		fleet_job_task.delay('reconcile_tier', site_ids=site_ids)
+
+
+@transaction.commit_on_success
+def _record_chunk(fleet_job_id, succeeded, failures):
+	"""
+	Adds the outcome of one chunk to the fleet job, and marks the job as
+	finished if that was the last one. The job's row is locked, since its
+	chunks finish concurrently.
+
+	"""
+	fleet_job = FleetJob.objects.using(write_database()).select_for_update(
+												).get(pk=fleet_job_id)
+	fleet_job.success_count += len(succeeded)
+	all_failures = json.loads(fleet_job.failures or '{}')
+	all_failures.update((unicode(site_id), error)
+						for site_id, error in failures.items())
+	fleet_job.failures = json.dumps(all_failures) if all_failures else ''
+	if fleet_job.success_count + len(all_failures) >= fleet_job.site_count:
+		fleet_job.finished = datetime.datetime.now()
+	fleet_job.save()
+
+
+@task(ignore_result=True)
+def fleet_chunk_task(fleet_job_id, job_name, site_ids, next_chunks=()):
+	"""
+	Runs a fleet job for each of the given sites in turn, on a single
+	database connection, and records the outcome on the :class:`FleetJob`.
+	Failures are isolated per site. Once the chunk is done, the first of
+	``next_chunks`` is dispatched with the rest, so that each chunk in
+	flight starts the next one instead of anything waiting on it.
+
+	"""
+	job = FLEET_JOBS[job_name]
+	succeeded = []
+	failures = {}
+	try:
+		for site_id in site_ids:
+			try:
+				with current_site(site_id):
+					job()
+			except Exception as e:
+				logging.error('Fleet job {0} failed for site {1}'.format(
+													job_name, site_id),
+							  exc_info=True)
+				transaction.rollback_unless_managed()
+				failures[site_id] = repr(e)
+			else:
+				succeeded.append(site_id)
+		_record_chunk(fleet_job_id, succeeded, failures)
+	finally:
+		if next_chunks:
+			fleet_chunk_task.delay(fleet_job_id, job_name, next_chunks[0],
+								   next_chunks[1:])
+
+
+def run_fleet_job(job_name, site_ids=None, chunk_size=FLEET_CHUNK_SIZE,
+				  concurrency=FLEET_CONCURRENCY):
+	"""
+	Starts the named job from :data:`FLEET_JOBS` for the given sites (or
+	every site with tier info) by splitting them into chunks of
+	``chunk_size`` sites for :func:`fleet_chunk_task`. The chunks are dealt
+	out to ``concurrency`` lanes, each of which runs its chunks one after
+	the other, so no more than that many are in flight at once.
+
+	Nothing waits for the chunks: this returns the :class:`FleetJob`
+	summarizing the run, which is filled in as they finish and marked as
+	finished by the last one.
+
+	"""
+	if job_name not in FLEET_JOBS:
+		raise ValueError('Unknown fleet job: {0}'.format(job_name))
+	if site_ids is None:
+		site_ids = saas_site_ids()
+
+	fleet_job = FleetJob.objects.create(name=job_name,
+										site_count=len(site_ids))
+	if not site_ids:
+		fleet_job.finished = datetime.datetime.now()
+		fleet_job.save()
+		return fleet_job
+
+	chunks = [site_ids[i:i + chunk_size]
+			  for i in xrange(0, len(site_ids), chunk_size)]
+	for lane in xrange(min(concurrency, len(chunks))):
+		lane_chunks = chunks[lane::concurrency]
+		fleet_chunk_task.delay(fleet_job.pk, job_name, lane_chunks[0],
+							   lane_chunks[1:])
+	# With CELERY_ALWAYS_EAGER, the chunks have already run.
+	return FleetJob.objects.using(write_database()).get(pk=fleet_job.pk)
 
 
 @task(ignore_result=True)
-def welcome_email_task(using='default'):
+def fleet_job_task(job_name, **kwargs):
 	"""
-	Sends the welcome email for this site. The 'using' kwarg is only here
-	as part of the settings hack.
+	Starts :func:`run_fleet_job` from a worker, so that looking up and
+	chunking the sites doesn't hold up the caller.
 
 	"""
-	send_welcome_email()
+	run_fleet_job(job_name, **kwargs)
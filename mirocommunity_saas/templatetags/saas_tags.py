@@ -0,0 +1,39 @@
+from django import template
+from django.utils.html import escape
+
+from mirocommunity_saas.models import SiteTierInfo
+from mirocommunity_saas.utils.tiers import videos_remaining as _remaining
+
+
+register = template.Library()
+
+
+@register.assignment_tag
+def videos_remaining():
+    """
+    Returns the number of videos the current site can still approve, or
+    ``None`` if its tier has no limit (or it has no tier info). Usage::
+
+        {% videos_remaining as video_quota %}
+
+    """
+    try:
+        tier = SiteTierInfo.objects.get_current().tier
+    except SiteTierInfo.DoesNotExist:
+        return None
+    return _remaining(tier)
+
+
+@register.simple_tag
+def page_query(query, page_number):
+    """
+    Returns the given query parameters (usually ``request.GET``) as a query
+    string for the given page, keeping all the other parameters. The result
+    is escaped for use in an attribute. Usage::
+
+        <a href="{% page_query request.GET page.next_page_number %}">
+
+    """
+    query = query.copy()
+    query['page'] = page_number
+    return escape('?{0}'.format(query.urlencode()))
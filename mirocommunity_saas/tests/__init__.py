@@ -6,6 +6,8 @@ from paypal.standard.ipn.models import PayPalIPN
 from uploadtemplate.models import Theme
 
 from mirocommunity_saas.models import Tier, SiteTierInfo
+from mirocommunity_saas.utils.mail import mail_templates
+from mirocommunity_saas.utils.tiers import invalidate_active_video_count
 
 
 class BaseTestCase(MCBaseTestCase):
@@ -25,6 +27,8 @@ class BaseTestCase(MCBaseTestCase):
         super(BaseTestCase, self).setUp()
         SiteTierInfo.objects.clear_cache()
         Theme.objects.clear_cache()
+        invalidate_active_video_count()
+        mail_templates.clear()
 
     def create_tier(self, name='Tier', slug='tier', **kwargs):
         return Tier.objects.create(name=name, slug=slug, **kwargs)
@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+import unittest
+
+from mirocommunity_saas.tests import BaseTestCase
+
+
+class BenchmarkTestCase(BaseTestCase):
+    """
+    Base class for benchmarks. These are skipped unless the ``BENCHMARK``
+    environment variable is set, since they are slow and their results are
+    meant to be read rather than asserted::
+
+        BENCHMARK=yes ./manage.py test mirocommunity_saas.tests.benchmarks
+
+    """
+    def setUp(self):
+        if not os.environ.get('BENCHMARK'):
+            raise unittest.SkipTest('Set BENCHMARK to run benchmarks.')
+        super(BenchmarkTestCase, self).setUp()
+
+    def timed(self, func, *args, **kwargs):
+        """
+        Calls ``func`` with the given arguments and returns the number of
+        seconds it took.
+
+        """
+        start = time.time()
+        func(*args, **kwargs)
+        return time.time() - start
+
+    def report(self, label, count, seconds, unit='ops'):
+        """Writes a throughput line for ``count`` operations to stderr."""
+        rate = count / seconds if seconds else float('inf')
+        sys.stderr.write('\n{0}: {1} {2} in {3:.3f}s ({4:.1f} {2}/s)'.format(
+                         label, count, unit, seconds, rate))
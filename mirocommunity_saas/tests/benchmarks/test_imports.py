@@ -0,0 +1,23 @@
+from mirocommunity_saas.tests.benchmarks import BenchmarkTestCase
+from mirocommunity_saas.tests.imports import import_report
+
+
+#: Maximum acceptable cold import time, in seconds, for each command module.
+IMPORT_BUDGETS = {
+    'for_sites': 0.5,
+    'initialize': 0.5,
+    'send_free_trial_ending': 0.5,
+    'send_video_limit_warning': 0.5,
+    'send_welcome_email': 0.5,
+}
+
+
+class CommandImportBenchmark(BenchmarkTestCase):
+    def test_import_time(self):
+        for command, budget in sorted(IMPORT_BUDGETS.items()):
+            seconds, modules = import_report(
+                    'mirocommunity_saas.management.commands.' + command)
+            self.report('import {0} ({1} modules)'.format(command,
+                                                          len(modules)),
+                        1, seconds, 'imports')
+            self.assertLess(seconds, budget)
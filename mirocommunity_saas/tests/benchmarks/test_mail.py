@@ -0,0 +1,31 @@
+from django.core import mail
+
+from mirocommunity_saas.tests.benchmarks import BenchmarkTestCase
+from mirocommunity_saas.utils.mail import send_mail
+
+
+class SendMailBenchmark(BenchmarkTestCase):
+    recipient_count = 500
+
+    def setUp(self):
+        super(SendMailBenchmark, self).setUp()
+        self.create_tier_info(self.create_tier())
+        self.recipients = [('User {0}'.format(i), 'user{0}@localhost'.format(i))
+                           for i in xrange(self.recipient_count)]
+
+    def _send(self, **kwargs):
+        mail.outbox = []
+        send_mail('mirocommunity_saas/mail/welcome/subject.txt',
+                  'mirocommunity_saas/mail/welcome/body.md',
+                  self.recipients, **kwargs)
+        self.assertEqual(len(mail.outbox), self.recipient_count)
+
+    def test_messages_per_second(self):
+        seconds = self.timed(self._send)
+        self.report('send_mail (serial)', self.recipient_count, seconds,
+                    'messages')
+        for processes in (2, 4):
+            seconds = self.timed(self._send, processes=processes,
+                                 chunk_size=50, connections=2)
+            self.report('send_mail ({0} processes)'.format(processes),
+                        self.recipient_count, seconds, 'messages')
@@ -0,0 +1,30 @@
+import unittest
+
+from mirocommunity_saas.tests.benchmarks import BenchmarkTestCase
+
+try:
+    from boto.s3.connection import OrdinaryCallingFormat
+    from mirocommunity_saas.storages import MultiCallingFormat
+except ImportError:
+    MultiCallingFormat = None
+
+
+@unittest.skipIf(MultiCallingFormat is None, 'boto is not installed.')
+class MultiCallingFormatBenchmark(BenchmarkTestCase):
+    url_count = 100000
+
+    def _build(self, calling_format):
+        for i in xrange(self.url_count):
+            calling_format.build_url_base(None, 'http', 's3.amazonaws.com',
+                                          'bucket',
+                                          'static/file{0}.css'.format(i))
+
+    def test_url_throughput(self):
+        formats = [OrdinaryCallingFormat() for i in xrange(4)]
+        for deterministic in (False, True):
+            calling_format = MultiCallingFormat(formats,
+                                                deterministic=deterministic)
+            seconds = self.timed(self._build, calling_format)
+            self.report('build_url_base (deterministic={0})'.format(
+                                                            deterministic),
+                        self.url_count, seconds, 'urls')
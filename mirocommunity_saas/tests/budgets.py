@@ -0,0 +1,146 @@
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+
+from django.conf import settings
+from django.db import connection
+
+from mirocommunity_saas.tests import BaseTestCase
+from mirocommunity_saas.utils.sites import clear_site_caches
+
+
+#: The checked-in baselines: a JSON object mapping view names to objects
+#: which map data scales to the ``status``, ``queries`` and ``seconds``
+#: recorded for that view.
+BUDGETS_PATH = os.path.join(os.path.dirname(__file__), 'budgets.json')
+
+_budgets_lock = threading.Lock()
+
+
+def load_budgets(path=BUDGETS_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as budgets_file:
+        return json.load(budgets_file)
+
+
+def record_budget(name, scale, measurement, path=BUDGETS_PATH):
+    """Writes ``measurement`` to the baselines for ``name`` at ``scale``."""
+    with _budgets_lock:
+        budgets = load_budgets(path)
+        budgets.setdefault(name, {})[str(scale)] = measurement
+        with open(path, 'w') as budgets_file:
+            json.dump(budgets, budgets_file, indent=4, sort_keys=True)
+            budgets_file.write('\n')
+
+
+class ViewBudgetTestCase(BaseTestCase):
+    """
+    Base class for checking views against the query counts and wall times
+    recorded in :data:`BUDGETS_PATH`. Subclasses set :attr:`scale` (the
+    number of videos the site is populated with) and call
+    :meth:`assertWithinBudget` for each view.
+
+    Scales above :attr:`benchmark_threshold` take a while to populate, so
+    they're skipped unless the ``BENCHMARK`` environment variable is set.
+    Views without a recorded baseline fail. To record new baselines instead
+    of checking them, set ``UPDATE_VIEW_BUDGETS``::
+
+        UPDATE_VIEW_BUDGETS=yes BENCHMARK=yes ./manage.py test \\
+            mirocommunity_saas.tests.functional.test_view_budgets
+
+    """
+    #: Number of videos the site is populated with.
+    scale = 10
+    #: Scales larger than this are only run as benchmarks.
+    benchmark_threshold = 1000
+    #: How many times its recorded wall time a view may take. Wall times
+    #: vary between machines, so this only catches gross regressions.
+    time_tolerance = 5.0
+    #: Number of videos created per INSERT.
+    batch_size = 500
+
+    def setUp(self):
+        if self.scale > self.benchmark_threshold and not os.environ.get(
+                                                                'BENCHMARK'):
+            raise unittest.SkipTest('Set BENCHMARK to run views at scale '
+                                    '{0}.'.format(self.scale))
+        super(ViewBudgetTestCase, self).setUp()
+
+    def create_videos(self, count, status, **kwargs):
+        """
+        Creates ``count`` videos for the current site with bulk inserts,
+        bypassing ``save()`` and its signals.
+
+        """
+        from localtv.models import Video
+        now = datetime.datetime.now()
+        for start in xrange(0, count, self.batch_size):
+            Video.objects.bulk_create([
+                Video(site_id=settings.SITE_ID,
+                      name='Video {0}'.format(i),
+                      status=status,
+                      when_submitted=now,
+                      when_approved=(now if status == Video.ACTIVE else None),
+                      **kwargs)
+                for i in xrange(start, min(start + self.batch_size, count))])
+
+    def measure(self, url, data=None, method='get'):
+        """
+        Requests ``url`` with every per-site cache cleared and returns the
+        response, the number of queries it took and the wall time in
+        seconds.
+
+        """
+        clear_site_caches()
+        connection.use_debug_cursor = True
+        start_queries = len(connection.queries)
+        start = time.time()
+        try:
+            response = getattr(self.client, method)(url, data or {})
+        finally:
+            seconds = time.time() - start
+            connection.use_debug_cursor = None
+        return response, len(connection.queries) - start_queries, seconds
+
+    def assertWithinBudget(self, name, url, data=None, method='get'):
+        """
+        Checks that requesting ``url`` returns the recorded status code
+        without using more queries than recorded for ``name`` at this scale,
+        or much more time.
+
+        """
+        response, queries, seconds = self.measure(url, data, method)
+        measurement = {
+            'status': response.status_code,
+            'queries': queries,
+            'seconds': round(seconds, 3),
+        }
+        sys.stderr.write('\n{0} @ {1}: {2} queries in {3:.3f}s'.format(
+                         name, self.scale, queries, seconds))
+        if os.environ.get('UPDATE_VIEW_BUDGETS'):
+            record_budget(name, self.scale, measurement)
+            return response
+
+        budget = load_budgets().get(name, {}).get(str(self.scale))
+        # A missing budget fails rather than skips, so that views added
+        # without one (or an empty budgets file) can't pass unchecked.
+        self.assertTrue(budget is not None,
+                        'No budget recorded for {0} at scale {1}; run with '
+                        'UPDATE_VIEW_BUDGETS set to record one.'.format(
+                                                            name, self.scale))
+        self.assertEqual(response.status_code, budget['status'])
+        self.assertTrue(queries <= budget['queries'],
+                        '{0} took {1} queries at scale {2}; its budget is '
+                        '{3}.'.format(name, queries, self.scale,
+                                      budget['queries']))
+        max_seconds = budget['seconds'] * self.time_tolerance
+        self.assertTrue(seconds <= max_seconds,
+                        '{0} took {1:.3f}s at scale {2}; its budget is '
+                        '{3:.3f}s.'.format(name, seconds, self.scale,
+                                           max_seconds))
+        return response
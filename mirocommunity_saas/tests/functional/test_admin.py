@@ -1,14 +1,25 @@
+import datetime
+import json
+import re
 
+from django.contrib.sites.models import Site
+from django.core import mail
 from django.core.urlresolvers import reverse
-from django.http import Http404
+from django.db import connection
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+                         QueryDict)
 from localtv.models import SiteSettings, Video
 import mock
+from notification.models import NoticeType
 from uploadtemplate.models import Theme
 
 from mirocommunity_saas.admin.approve_reject_views import (_video_limit_wrapper,
                                                            approve_all)
-from mirocommunity_saas.admin.livesearch_views import approve
+from mirocommunity_saas.admin.livesearch_views import (approve,
+                                                       approve_batch)
+from mirocommunity_saas.models import SiteTierInfo
 from mirocommunity_saas.tests import BaseTestCase
+from mirocommunity_saas.utils.tiers import active_video_count
 
 
 class VideoLimitWrapperTestCase(BaseTestCase):
@@ -197,6 +208,86 @@ class ApproveAllTestCase(BaseTestCase):
             approve_all(request)
         self.approve_all.assert_called_with(request)
 
+    def _approve_partial(self):
+        request = self.factory.get('/', {'partial': '1'}, user=self.user)
+        with mock.patch('localtv.tasks.haystack_update.delay') as delay:
+            response = approve_all(request)
+        self.assertFalse(self.approve_all.called)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(response.content), delay
+
+    def test_partial(self):
+        """
+        With partial=1, as many videos as the limit allows should be
+        approved, oldest first, and the rest reported as skipped.
+
+        """
+        tier = self.create_tier(video_limit=2)
+        self.create_tier_info(tier)
+        expected = list(Video.objects.filter(status=Video.UNAPPROVED
+                                    ).order_by('when_submitted', 'pk'
+                                    ).values_list('pk', flat=True))
+
+        summary, delay = self._approve_partial()
+        self.assertEqual(summary, {'approved': expected[:2],
+                                   'skipped': expected[2:],
+                                   'remaining': 0})
+        self.assertEqual(list(Video.objects.filter(status=Video.ACTIVE
+                                          ).order_by('pk'
+                                          ).values_list('pk', flat=True)),
+                         sorted(expected[:2]))
+        # The search index is updated once, for all the approved videos.
+        delay.assert_called_once_with(Video._meta.app_label,
+                                      Video._meta.module_name,
+                                      expected[:2])
+
+    def test_partial__no_limit(self):
+        tier = self.create_tier(video_limit=None)
+        self.create_tier_info(tier)
+        summary, delay = self._approve_partial()
+        self.assertEqual(len(summary['approved']), 3)
+        self.assertEqual(summary['skipped'], [])
+        self.assertEqual(summary['remaining'], None)
+
+    def test_partial__full(self):
+        tier = self.create_tier(video_limit=0)
+        self.create_tier_info(tier)
+        summary, delay = self._approve_partial()
+        self.assertEqual(summary['approved'], [])
+        self.assertEqual(len(summary['skipped']), 3)
+        self.assertFalse(delay.called)
+        self.assertEqual(Video.objects.filter(status=Video.UNAPPROVED
+                                     ).count(), 3)
+
+    def test_partial__side_effects(self):
+        """
+        The single UPDATE skips Video.save() and the model signals, so the
+        quota cache should be cleared and the submitters emailed directly.
+
+        """
+        tier = self.create_tier(video_limit=None)
+        self.create_tier_info(tier)
+        NoticeType.objects.create(label='video_approved',
+                                  display='Video approved',
+                                  description='', default=2)
+        submitter = self.create_user(username='submitter',
+                                     email='submitter@localhost')
+        video = self.create_video(name='Submitted', status=Video.UNAPPROVED,
+                                  user=submitter)
+        self.create_video(status=Video.UNAPPROVED,
+                          user=self.create_user(username='no_email',
+                                                 email=''))
+        self.assertEqual(active_video_count(), 0)
+        with mock.patch.object(Video, 'save') as save:
+            summary, delay = self._approve_partial()
+        self.assertFalse(save.called)
+        self.assertEqual(len(summary['approved']), 5)
+        self.assertEqual(active_video_count(), 5)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['submitter@localhost'])
+        self.assertIn(video.name, mail.outbox[0].subject)
+
 
 class LiveSearchTestCase(BaseTestCase):
     def setUp(self):
@@ -282,6 +373,135 @@ class LiveSearchTestCase(BaseTestCase):
             self.assertFalse(get.called)
 
 
+class LiveSearchBatchTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.user = self.create_user(username='admin')
+        settings = SiteSettings.objects.get_current()
+        settings.admins.add(self.user)
+
+    def _approve_batch(self, video_ids, response=None, **data):
+        data['video_id'] = video_ids
+        request = self.factory.get('/', data, user=self.user)
+        with mock.patch('mirocommunity_saas.admin.livesearch_views.'
+                        'LiveSearchApproveVideoView.get') as get:
+            if response is None:
+                get.return_value = HttpResponse('SUCCESS')
+            else:
+                get.side_effect = response
+            summary = json.loads(approve_batch(request).content)
+        # The request's own query is left alone.
+        self.assertEqual(request.GET.getlist('video_id'), video_ids)
+        return summary, get
+
+    def test_no_tier(self):
+        """
+        If there's no tier object, we should get a 404.
+
+        """
+        request = self.factory.get('/', {'video_id': ['1', '2']},
+                                   user=self.user)
+        with self.assertRaises(Http404):
+            approve_batch(request)
+
+    def test_no_limit(self):
+        """
+        If there's no limit, every result should be approved.
+
+        """
+        tier = self.create_tier(video_limit=None)
+        self.create_tier_info(tier)
+        summary, get = self._approve_batch(['1', '2', '3'])
+        self.assertEqual([r['status'] for r in summary['results']],
+                         ['approved'] * 3)
+        self.assertEqual(summary['remaining'], None)
+        self.assertEqual(get.call_count, 3)
+
+    def test_partial(self):
+        """
+        Results past the remaining quota should be skipped without calling
+        the underlying view; the quota is only counted once.
+
+        """
+        tier = self.create_tier(video_limit=3)
+        self.create_tier_info(tier)
+        self.create_video(status=Video.ACTIVE)
+        seen = []
+        def response(view, request):
+            seen.append(request.GET.getlist('video_id'))
+            return HttpResponse('SUCCESS')
+        connection.use_debug_cursor = True
+        try:
+            summary, get = self._approve_batch(['1', '2', '3'],
+                                               response=response)
+            counts = [q for q in connection.queries
+                      if 'COUNT' in q['sql'] and 'localtv_video' in q['sql']]
+        finally:
+            connection.use_debug_cursor = None
+        self.assertEqual(summary['results'], [
+            {'video_id': '1', 'status': 'approved'},
+            {'video_id': '2', 'status': 'approved'},
+            {'video_id': '3', 'status': 'over_limit'}])
+        self.assertEqual(summary['remaining'], 0)
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(len(counts), 1)
+        # Each call only sees its own result.
+        self.assertEqual(seen, [['1'], ['2']])
+
+    def test_queue(self):
+        """
+        Queued results don't use up the quota.
+
+        """
+        tier = self.create_tier(video_limit=0)
+        self.create_tier_info(tier)
+        summary, get = self._approve_batch(['1', '2'], queue='1')
+        self.assertEqual([r['status'] for r in summary['results']],
+                         ['queued', 'queued'])
+        self.assertEqual(summary['remaining'], 0)
+
+    def test_failures(self):
+        """
+        Missing or failed results are reported and don't use up the quota.
+
+        """
+        tier = self.create_tier(video_limit=1)
+        self.create_tier_info(tier)
+        def response(view, request):
+            video_id = request.GET['video_id']
+            if video_id == '1':
+                raise Http404
+            elif video_id == '2':
+                return HttpResponse(status=500)
+            return HttpResponse('SUCCESS')
+        summary, get = self._approve_batch(['1', '2', '3'], response=response)
+        self.assertEqual([r['status'] for r in summary['results']],
+                         ['not_found', 'failed', 'approved'])
+        self.assertEqual(summary['remaining'], 0)
+
+    def test_fresh_count(self):
+        """
+        The quota should be reserved against a fresh count of the active
+        videos, taken with the site's tier info locked, rather than the
+        cached count.
+
+        """
+        tier = self.create_tier(video_limit=1)
+        self.create_tier_info(tier)
+        video = self.create_video(status=Video.UNAPPROVED)
+        self.assertEqual(active_video_count(), 0)
+        Video.objects.filter(pk=video.pk).update(status=Video.ACTIVE)
+        with mock.patch('django.db.models.query.QuerySet.'
+                        'select_for_update',
+                        autospec=True,
+                        side_effect=lambda qs, **kwargs: qs) as lock:
+            summary, get = self._approve_batch(['1'])
+        self.assertTrue(lock.called)
+        self.assertEqual(summary['results'],
+                         [{'video_id': '1', 'status': 'over_limit'}])
+        self.assertFalse(get.called)
+
+
 class ThemeTestCase(BaseTestCase):
     def test_get(self):
         """
@@ -449,3 +669,246 @@ class FlatPagesTestCase(BaseTestCase):
         self.client.login(username='admin', password='admin')
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
+
+
+class UsersTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.create_tier_info(self.create_tier())
+        self.create_user(username='admin', password='admin',
+                         is_superuser=True)
+        for i in xrange(3):
+            self.create_user(username='user{0}'.format(i))
+        self.client.login(username='admin', password='admin')
+
+    def test_page_links(self):
+        """Each page of users should link to the pages around it."""
+        url = reverse('localtv_admin_users')
+        with mock.patch('mirocommunity_saas.admin.user_views.USERS_PER_PAGE',
+                        2):
+            response = self.client.get(url, {'page': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Page 2 of 2')
+        self.assertContains(response, 'href="?page=1"')
+        self.assertNotContains(response, 'href="?page=3"')
+
+        # The links are on the users page, not in the admin header.
+        response = self.client.get(reverse('localtv_admin_tier'))
+        self.assertNotContains(response, 'class="pagination"')
+
+    def test_page_links__query(self):
+        """The page links should keep the other query parameters."""
+        url = reverse('localtv_admin_users')
+        with mock.patch('mirocommunity_saas.admin.user_views.USERS_PER_PAGE',
+                        2):
+            response = self.client.get(url, {'page': 2, 'sort': 'email'})
+        query = re.search(r'class="previous" href="\?([^"]*)"',
+                          response.content).group(1)
+        self.assertEqual(QueryDict(query.replace('&amp;', '&')),
+                         QueryDict('page=1&sort=email'))
+
+    def test_redirect(self):
+        """Saving a page of users should return to that page."""
+        url = reverse('localtv_admin_users')
+        with mock.patch('mirocommunity_saas.admin.user_views._users',
+                        lambda request, **kwargs: HttpResponseRedirect(
+                                                            request.path)):
+            response = self.client.post('{0}?page=2'.format(url))
+            self.assertEqual(response['Location'],
+                             'http://testserver{0}?page=2'.format(url))
+            response = self.client.post(url)
+            self.assertEqual(response['Location'],
+                             'http://testserver{0}'.format(url))
+
+
+class TierViewConditionalTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.tier1 = self.create_tier(name='Tier1', slug='tier1', price=0)
+        self.tier2 = self.create_tier(name='Tier2', slug='tier2', price=20)
+        self.tier_info = self.create_tier_info(self.tier1,
+                                               available_tiers=[self.tier2])
+        self.create_user(username='admin', password='admin',
+                         is_superuser=True)
+        self.client.login(username='admin', password='admin')
+        self.url = reverse('localtv_admin_tier')
+
+    def assertNotModified(self, etag):
+        with mock.patch('mirocommunity_saas.admin.views.TierView.'
+                        'get_context_data') as get_context_data:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(get_context_data.called)
+
+    def assertModified(self, etag):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_conditional_get(self):
+        """
+        Repeat visits should get a 304 without building the page until the
+        tier info, its IPNs or the available tiers change.
+
+        """
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertIn('private', response['Cache-Control'])
+        etag = response['ETag']
+        self.assertNotModified(etag)
+
+        SiteTierInfo.objects.filter(pk=self.tier_info.pk).update(
+                    tier_changed=datetime.datetime.now() +
+                                 datetime.timedelta(seconds=1))
+        etag = self.assertModified(etag)
+        self.assertNotModified(etag)
+
+        self.tier_info.ipn_set.add(self.create_ipn(txn_type='subscr_payment'))
+        etag = self.assertModified(etag)
+
+        self.tier2.price = 25
+        self.tier2.save()
+        etag = self.assertModified(etag)
+        self.assertNotModified(etag)
+
+        # The admin nav shows the video quota.
+        self.create_video(status=Video.ACTIVE)
+        etag = self.assertModified(etag)
+        self.assertNotModified(etag)
+
+    def test_conditional_get__reconciliation_pending(self):
+        """
+        A tier that drifts from the subscription should change the ETag, and
+        a 304 should still queue the reconciliation.
+
+        """
+        SiteTierInfo.objects.filter(pk=self.tier_info.pk).update(
+                                                    enforce_payments=True)
+        etag = self.client.get(self.url)['ETag']
+        self.assertNotModified(etag)
+
+        # The current tier isn't in the catalog, so only the drift changes.
+        self.tier1.price = 10
+        self.tier1.save()
+        etag = self.assertModified(etag)
+        with mock.patch('mirocommunity_saas.admin.views.'
+                        'queue_tier_reconciliation') as queue:
+            self.assertNotModified(etag)
+        queue.assert_called_once_with()
+
+
+class TierViewQueryCountTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.tier = self.create_tier(name='Tier0', slug='tier0', price=10)
+        self.tier_info = self.create_tier_info(self.tier,
+                                               enforce_payments=True)
+        self.create_user(username='admin', password='admin',
+                         is_superuser=True)
+        self.client.login(username='admin', password='admin')
+        self.url = reverse('localtv_admin_tier')
+
+    def _add_tiers(self, count):
+        for i in xrange(self.tier_info.available_tiers.count(), count):
+            tier = self.create_tier(name='Tier{0}'.format(i),
+                                    slug='tier{0}'.format(i),
+                                    price=i * 10)
+            self.tier_info.available_tiers.add(tier)
+
+    def _count_queries(self):
+        SiteTierInfo.objects.clear_cache()
+        Site.objects.clear_cache()
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            response = self.client.get(self.url)
+        finally:
+            connection.use_debug_cursor = None
+        self.assertEqual(response.status_code, 200)
+        return len(connection.queries) - start
+
+    def test_query_count(self):
+        """
+        The number of queries for the upgrade page shouldn't depend on the
+        number of tiers.
+
+        """
+        self._add_tiers(2)
+        two_tiers = self._count_queries()
+        self._add_tiers(20)
+        self.assertEqual(self._count_queries(), two_tiers)
+
+
+class QuotaStatusTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.tier = self.create_tier(video_limit=3, admin_limit=2,
+                                     custom_css=True)
+        self.create_tier_info(self.tier)
+        self.create_user(username='admin', password='admin',
+                         is_superuser=True)
+        self.client.login(username='admin', password='admin')
+        self.url = reverse('localtv_admin_quota')
+
+    def test_get(self):
+        """
+        The limits, usage and entitlements should be returned as JSON.
+
+        """
+        self.create_video(status=Video.ACTIVE)
+        self.create_video(status=Video.UNAPPROVED)
+        admin = self.create_user(username='staff')
+        SiteSettings.objects.get_current().admins.add(admin)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content), {
+            'tier': 'tier',
+            'videos': {'limit': 3, 'used': 1, 'remaining': 2},
+            'admins': {'limit': 2, 'used': 1, 'remaining': 1},
+            'entitlements': {'custom_css': True, 'custom_themes': False,
+                             'custom_domain': False, 'ads_allowed': False},
+        })
+
+    def test_conditional_get(self):
+        """
+        Unchanged quotas should get a 304; approving a video changes the
+        ETag.
+
+        """
+        video = self.create_video(status=Video.UNAPPROVED)
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        video.status = Video.ACTIVE
+        video.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content)['videos']['used'], 1)
+
+    def test_conditional_get__no_usage(self):
+        """
+        A 304 shouldn't work out the usage (which counts the admins).
+
+        """
+        etag = self.client.get(self.url)['ETag']
+        with mock.patch('mirocommunity_saas.admin.views.'
+                        'tier_usage') as tier_usage:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(tier_usage.called)
+
+    def test_unlimited(self):
+        """
+        Unlimited quotas have no limit and nothing remaining.
+
+        """
+        self.tier.video_limit = None
+        self.tier.save()
+        status = json.loads(self.client.get(self.url).content)
+        self.assertEqual(status['videos'],
+                         {'limit': None, 'used': 0, 'remaining': None})
@@ -0,0 +1,87 @@
+from django.core.urlresolvers import reverse
+from localtv.models import Video
+
+from mirocommunity_saas.tests.budgets import ViewBudgetTestCase
+
+
+class AdminViewBudgetTestCase(ViewBudgetTestCase):
+    """
+    Checks each of the SaaS admin views against its recorded query and time
+    budget, on a site with :attr:`scale` videos, half of them unapproved.
+
+    """
+    scale = 10
+
+    def setUp(self):
+        super(AdminViewBudgetTestCase, self).setUp()
+        self.free_tier = self.create_tier(name='Free', slug='free', price=0,
+                                          video_limit=self.scale * 2)
+        self.tier = self.create_tier(name='Max', slug='max', price=20,
+                                     video_limit=self.scale * 2,
+                                     custom_themes=True, custom_css=True)
+        self.create_tier_info(self.tier, available_tiers=[self.free_tier],
+                              enforce_payments=True)
+        self.create_videos(self.scale // 2, Video.ACTIVE)
+        self.create_videos(self.scale - self.scale // 2, Video.UNAPPROVED)
+        self.create_theme(default=True)
+        self.create_user(username='admin', password='admin',
+                         is_superuser=True)
+        self.client.login(username='admin', password='admin')
+
+    def _unapproved_video(self):
+        return Video.objects.filter(status=Video.UNAPPROVED)[0]
+
+    def test_index(self):
+        self.assertWithinBudget('index', reverse('localtv_admin_index'))
+
+    def test_upgrade(self):
+        self.assertWithinBudget('upgrade', reverse('localtv_admin_tier'))
+
+    def test_confirm_downgrade(self):
+        self.assertWithinBudget('confirm_downgrade',
+                                reverse('localtv_admin_tier_confirm'),
+                                {'tier': self.free_tier.slug})
+
+    def test_approve_video(self):
+        self.assertWithinBudget('approve_video',
+                                reverse('localtv_admin_approve_video'),
+                                {'video_id': self._unapproved_video().pk})
+
+    def test_approve_all(self):
+        self.assertWithinBudget('approve_all',
+                                reverse('localtv_admin_approve_all'),
+                                {'page': 1})
+
+    def test_livesearch_approve(self):
+        # A real approval needs a live search result, so this measures the
+        # quota check in front of it by filling the site up first.
+        Video.objects.update(status=Video.ACTIVE)
+        self.create_videos(self.scale, Video.ACTIVE)
+        self.assertWithinBudget('livesearch_approve',
+                                reverse('localtv_admin_search_video_approve'),
+                                {'video': 0})
+
+    def test_settings(self):
+        self.assertWithinBudget('settings', reverse('localtv_admin_settings'))
+
+    def test_users(self):
+        self.assertWithinBudget('users', reverse('localtv_admin_users'))
+
+    def test_bulk_edit(self):
+        self.assertWithinBudget('bulk_edit',
+                                reverse('localtv_admin_bulk_edit'))
+
+    def test_themes(self):
+        self.assertWithinBudget('themes', reverse('uploadtemplate-index'))
+
+    def test_flatpages(self):
+        self.assertWithinBudget('flatpages',
+                                reverse('localtv_admin_flatpages'))
+
+
+class AdminViewBudget1kTestCase(AdminViewBudgetTestCase):
+    scale = 1000
+
+
+class AdminViewBudget100kTestCase(AdminViewBudgetTestCase):
+    scale = 100000
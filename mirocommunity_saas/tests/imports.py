@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+
+
+#: Modules which are expensive to import and which cron-driven commands
+#: should only load when they actually need them.
+HEAVY_MODULES = ('localtv.models', 'localtv.tasks', 'paypal.standard.forms',
+                 'celery', 'boto', 'markdown')
+
+_SCRIPT = """
+import json, sys, time
+from django.conf import settings
+settings.INSTALLED_APPS
+before = set(name for name, module in sys.modules.items() if module)
+start = time.time()
+__import__(sys.argv[1])
+seconds = time.time() - start
+after = set(name for name, module in sys.modules.items() if module)
+sys.stdout.write(json.dumps({'seconds': seconds,
+                             'modules': sorted(after - before)}))
+"""
+
+
+def import_report(module_name):
+    """
+    Imports ``module_name`` in a fresh interpreter (with settings already
+    configured) and returns a tuple of the number of seconds the import took
+    and the list of modules it loaded, in the spirit of
+    ``python -X importtime``.
+
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    output = subprocess.Popen([sys.executable, '-c', _SCRIPT, module_name],
+                              stdout=subprocess.PIPE,
+                              env=env).communicate()[0]
+    report = json.loads(output)
+    return report['seconds'], report['modules']
+
+
+def heavy_imports(modules):
+    """
+    Returns the modules from the given list which are, or are inside, one of
+    the :data:`HEAVY_MODULES`.
+
+    """
+    return [name for name in modules
+            if any(name == heavy or name.startswith(heavy + '.')
+                   for heavy in HEAVY_MODULES)]
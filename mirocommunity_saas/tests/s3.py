@@ -0,0 +1,230 @@
+import datetime
+import hashlib
+import os
+import posixpath
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+
+
+S3_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+
+class LocalKey(object):
+    """Enough of a boto ``Key`` for the SaaS storages' purposes."""
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        path = bucket.path(name)
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.last_modified = datetime.datetime.utcfromtimestamp(
+                                    stat.st_mtime).strftime(S3_TIME_FORMAT)
+        etag = bucket.etags.get(name)
+        if etag is None:
+            with open(path, 'rb') as f:
+                etag = hashlib.md5(f.read()).hexdigest()
+        self.etag = '"{0}"'.format(etag)
+        self.headers = bucket.headers.get(name, {})
+
+
+class LocalNewKey(object):
+    """A key which hasn't been uploaded yet."""
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def set_contents_from_string(self, content, headers=None, **kwargs):
+        self.bucket.set_contents(self.name, content, headers)
+
+
+class LocalMultiPartUpload(object):
+    def __init__(self, bucket, key_name, headers):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.headers = headers
+        self.parts = {}
+
+    def upload_part_from_file(self, fp, part_num):
+        self.bucket.requests += 1
+        self.parts[part_num] = fp.read()
+
+    def complete_upload(self):
+        parts = [self.parts[num] for num in sorted(self.parts)]
+        self.bucket.set_contents(self.key_name, ''.join(parts), self.headers)
+        digests = ''.join(hashlib.md5(part).digest() for part in parts)
+        self.bucket.etags[self.key_name] = '{0}-{1}'.format(
+                                    hashlib.md5(digests).hexdigest(),
+                                    len(parts))
+        self.bucket.multipart_uploads.append(self.key_name)
+
+    def cancel_upload(self):
+        self.parts = {}
+
+
+class LocalBucket(object):
+    """
+    A stand-in for a boto S3 bucket which keeps its keys as files under
+    ``root``. Every method which would be a network round trip increments
+    :attr:`requests`, and the headers and canned ACL each key was uploaded
+    with are recorded in :attr:`headers` and :attr:`policies`.
+
+    """
+    def __init__(self, root, name='bucket'):
+        self.root = root
+        self.name = name
+        self.requests = 0
+        self.headers = {}
+        self.policies = {}
+        #: ETags of keys which were uploaded in several parts.
+        self.etags = {}
+        #: Names of keys which were uploaded in several parts.
+        self.multipart_uploads = []
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def list(self, prefix=''):
+        self.requests += 1
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    keys.append(LocalKey(self, name))
+        return keys
+
+    def get_key(self, name):
+        self.requests += 1
+        if os.path.exists(self.path(name)):
+            return LocalKey(self, name)
+        return None
+
+    def new_key(self, name):
+        return LocalNewKey(self, name)
+
+    def set_contents(self, name, content, headers=None):
+        self.requests += 1
+        path = self.path(name)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Already exists, possibly created by another thread.
+            pass
+        with open(path, 'wb') as f:
+            f.write(content)
+        self.headers[name] = dict(headers or {})
+        self.etags.pop(name, None)
+
+    def initiate_multipart_upload(self, key_name, headers=None, policy=None,
+                                  **kwargs):
+        self.requests += 1
+        self.policies[key_name] = policy
+        return LocalMultiPartUpload(self, key_name, headers or {})
+
+    def delete_key(self, name):
+        self.requests += 1
+        self.headers.pop(name, None)
+        self.etags.pop(name, None)
+        if os.path.exists(self.path(name)):
+            os.remove(self.path(name))
+
+
+class LocalConnection(object):
+    """A stand-in for a boto ``S3Connection`` to a :class:`LocalBucket`."""
+    def __init__(self, bucket):
+        self._bucket = bucket
+        self.closed = False
+
+    def get_bucket(self, name, validate=True):
+        return self._bucket
+
+    def close(self):
+        self.closed = True
+
+
+class LocalS3Storage(Storage):
+    """
+    A stand-in for ``S3BotoStorage`` backed by a :class:`LocalBucket`, which
+    the SaaS storage mixins can be combined with in tests.
+
+    """
+    custom_domain = None
+    querystring_auth = False
+    querystring_expire = 3600
+    calling_format = None
+    default_acl = 'public-read'
+    reduced_redundancy = False
+
+    def __init__(self, bucket, location='', headers=None):
+        self.local_bucket = bucket
+        self.bucket_name = bucket.name
+        self.access_key = 'local'
+        self.location = location
+        self.headers = headers or {}
+        self._connection = None
+        self._bucket = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = LocalConnection(self.local_bucket)
+        return self._connection
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = self._get_or_create_bucket(self.bucket_name)
+        return self._bucket
+
+    def _get_or_create_bucket(self, name):
+        return self.connection.get_bucket(name)
+
+    def _clean_name(self, name):
+        return posixpath.normpath(name) if name else ''
+
+    def _normalize_name(self, name):
+        return posixpath.join(self.location, name).lstrip('/')
+
+    def get_available_name(self, name):
+        # Like S3BotoStorage with AWS_S3_FILE_OVERWRITE, the default.
+        return self._clean_name(name)
+
+    def _encode_name(self, name):
+        return name
+
+    def _open(self, name, mode='rb'):
+        key = self.bucket.get_key(self._normalize_name(self._clean_name(name)))
+        with open(self.bucket.path(key.name), 'rb') as f:
+            return ContentFile(f.read())
+
+    def _save(self, name, content):
+        cleaned_name = self._clean_name(name)
+        content.seek(0)
+        self.bucket.set_contents(self._normalize_name(cleaned_name),
+                                 content.read(), self.headers)
+        return cleaned_name
+
+    def delete(self, name):
+        self.bucket.delete_key(self._normalize_name(self._clean_name(name)))
+
+    def exists(self, name):
+        name = self._normalize_name(self._clean_name(name))
+        return self.bucket.get_key(name) is not None
+
+    def size(self, name):
+        name = self._normalize_name(self._clean_name(name))
+        return self.bucket.get_key(name).size
+
+    def modified_time(self, name):
+        # Like S3BotoStorage, this returns a naive UTC datetime.
+        name = self._normalize_name(self._clean_name(name))
+        return datetime.datetime.strptime(
+                        self.bucket.get_key(name).last_modified,
+                        S3_TIME_FORMAT)
+
+    def url(self, name):
+        return 'http://{0}.s3.example.com/{1}'.format(
+                    self.bucket.name,
+                    self._normalize_name(self._clean_name(name)))
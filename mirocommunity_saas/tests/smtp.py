@@ -0,0 +1,76 @@
+import asyncore
+import smtpd
+import threading
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """
+    A stand-in SMTP server which runs on localhost in a background thread and
+    records the messages it receives instead of relaying them. Use it as a
+    context manager::
+
+        with LocalSMTPServer() as server:
+            with override_settings(EMAIL_HOST=server.host,
+                                   EMAIL_PORT=server.port, ...):
+                ...
+        server.messages
+
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        # SMTPServer always registers with asyncore's global socket map; move
+        # to a private one so that other asyncore users aren't affected.
+        self._socket_map = {}
+        self._move_to_private_map(self)
+        self.host, self.port = self.socket.getsockname()[:2]
+        #: A list of (mailfrom, rcpttos, data) tuples.
+        self.messages = []
+        #: The number of connections which have been opened to the server.
+        self.connection_count = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def _move_to_private_map(self, dispatcher):
+        fileno = dispatcher._fileno
+        dispatcher.del_channel()
+        dispatcher._fileno = fileno
+        dispatcher._map = self._socket_map
+        dispatcher.add_channel()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            with self._lock:
+                self.connection_count += 1
+            channel = smtpd.SMTPChannel(self, conn, addr)
+            self._move_to_private_map(channel)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        with self._lock:
+            self.messages.append((mailfrom, rcpttos, data))
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, map=self._socket_map, count=1)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        asyncore.close_all(map=self._socket_map)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -9,6 +9,7 @@ from mirocommunity_saas.admin.forms import (TierChangeForm,
                                             PayPalSubscriptionForm)
 from mirocommunity_saas.admin.views import (TierView, TierChangeView,
                                             DowngradeConfirmationView)
+from mirocommunity_saas.models import SiteTierInfo
 from mirocommunity_saas.tests import BaseTestCase
 from mirocommunity_saas.utils.tiers import make_tier_change_token
 
@@ -141,6 +142,35 @@ class TierViewUnitTestCase(BaseTestCase):
         self.assertIsInstance(forms.values()[1], DowngradeConfirmationForm)
         self.assertIsInstance(forms.values()[2], PayPalSubscriptionForm)
 
+    def test_get_context_data__drifted(self):
+        """
+        If the tier doesn't match the subscription, rendering the page
+        shouldn't change it, but should queue a reconciliation.
+
+        """
+        tier_info = self.create_tier_info(self.tier2,
+                                          available_tiers=[self.tier1,
+                                                           self.tier3],
+                                          enforce_payments=True)
+        tier_info.tier = self.tier3
+        tier_info.save()
+        with mock.patch('mirocommunity_saas.admin.views.'
+                        'queue_tier_reconciliation') as queue:
+            context_data = TierView().get_context_data()
+        self.assertTrue(context_data['reconciliation_pending'])
+        queue.assert_called_once_with()
+        self.assertEqual(SiteTierInfo.objects.get(pk=tier_info.pk).tier,
+                         self.tier3)
+
+    def test_get_context_data__not_drifted(self):
+        self.create_tier_info(self.tier2, available_tiers=[self.tier1],
+                              enforce_payments=True)
+        with mock.patch('mirocommunity_saas.admin.views.'
+                        'queue_tier_reconciliation') as queue:
+            context_data = TierView().get_context_data()
+        self.assertFalse(context_data['reconciliation_pending'])
+        self.assertFalse(queue.called)
+
 
 class DowngradeConfirmationViewUnitTestCase(BaseTestCase):
     def setUp(self):
@@ -0,0 +1,26 @@
+import os
+import shutil
+import tempfile
+
+from mirocommunity_saas.tests import BaseTestCase
+from mirocommunity_saas.tests.budgets import load_budgets, record_budget
+
+
+class BudgetFileTestCase(BaseTestCase):
+    def setUp(self):
+        super(BudgetFileTestCase, self).setUp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.path = os.path.join(root, 'budgets.json')
+
+    def test_record(self):
+        """Recorded budgets should be merged into the file by view and scale."""
+        self.assertEqual(load_budgets(self.path), {})
+        record_budget('index', 10, {'queries': 5}, path=self.path)
+        record_budget('index', 1000, {'queries': 6}, path=self.path)
+        record_budget('users', 10, {'queries': 7}, path=self.path)
+        record_budget('index', 10, {'queries': 4}, path=self.path)
+        self.assertEqual(load_budgets(self.path), {
+            'index': {'10': {'queries': 4}, '1000': {'queries': 6}},
+            'users': {'10': {'queries': 7}},
+        })
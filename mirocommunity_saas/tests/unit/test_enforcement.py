@@ -6,19 +6,24 @@ This file contains tests of tier-based permissions.
 import datetime
 
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core import mail
 from django.core.exceptions import ValidationError
+from django.db import connection
 from django.forms.formsets import TOTAL_FORM_COUNT, INITIAL_FORM_COUNT
-from django.forms.models import model_to_dict
+from django.forms.models import BaseModelFormSet, model_to_dict
 from django.test.utils import override_settings
 from localtv.models import SiteSettings, Video
+import mock
 from uploadtemplate.models import Theme
 
 from mirocommunity_saas.admin.forms import (EditSettingsForm, AuthorForm,
-                                            VideoFormSet)
+                                            AuthorFormSet, VideoFormSet)
+from mirocommunity_saas.models import SiteTierInfo
 from mirocommunity_saas.tests import BaseTestCase
-from mirocommunity_saas.utils.tiers import (admins_to_demote,
+from mirocommunity_saas.utils.tiers import (active_video_count,
+                                            admins_to_demote,
                                             videos_to_deactivate,
                                             enforce_tier,
                                             limit_import_approvals,
@@ -154,6 +159,88 @@ class AuthorFormTestCase(BaseTestCase):
         self.assertEqual(form.clean_role(), 'admin')
 
 
+class AuthorFormSetTestCase(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.user = self.create_user(username='user', is_active=True)
+        self.admin = self.create_user(username='admin', is_active=True)
+        SiteSettings.objects.get_current().admins.add(self.admin)
+
+    def _formset(self, promotions, deletions=0):
+        formset = AuthorFormSet(queryset=User.objects.none())
+        formset.forms = []
+        for i in xrange(promotions + deletions):
+            form = mock.Mock(cleaned_data={'role': 'admin',
+                                           'DELETE': i >= promotions})
+            form.has_changed.return_value = True
+            form.is_promotion.return_value = True
+            formset.forms.append(form)
+        formset._errors = [{} for form in formset.forms]
+        return formset
+
+    def _clean(self, formset):
+        # Warm the per-site caches so that only the admin count is left.
+        SiteTierInfo.objects.get_current().tier
+        SiteSettings.objects.get_current()
+        with mock.patch.object(BaseModelFormSet, 'clean'):
+            with self.assertNumQueries(1):
+                formset.clean()
+
+    def test_below_limit(self):
+        """Promotions which fit in the limit together are allowed."""
+        tier = self.create_tier(admin_limit=3)
+        self.create_tier_info(tier)
+        self._clean(self._formset(2, deletions=3))
+
+    def test_above_limit(self):
+        """
+        Promotions which each fit in the limit but don't fit together should
+        be rejected with a single count.
+
+        """
+        tier = self.create_tier(admin_limit=2)
+        self.create_tier_info(tier)
+        self.assertRaises(ValidationError, self._clean, self._formset(2))
+
+    def test_no_limit(self):
+        tier = self.create_tier(admin_limit=None)
+        self.create_tier_info(tier)
+        formset = self._formset(5)
+        with mock.patch.object(BaseModelFormSet, 'clean'):
+            formset.clean()
+
+    def test_forms_skip_limit(self):
+        """The formset's forms should leave the limit to the formset."""
+        tier = self.create_tier(admin_limit=1)
+        self.create_tier_info(tier)
+        formset = AuthorFormSet(queryset=User.objects.filter(
+                                                        pk=self.user.pk))
+        form = formset.forms[0]
+        self.assertFalse(form.check_admin_limit)
+        form.cleaned_data = {'role': 'admin'}
+        with mock.patch.object(form, 'changed_data', ['role']):
+            self.assertEqual(form.clean_role(), 'admin')
+
+    def test_pagination(self):
+        tier = self.create_tier(admin_limit=None)
+        self.create_tier_info(tier)
+        for i in xrange(3):
+            self.create_user(username='user{0}'.format(i))
+        users = list(User.objects.order_by('pk'))
+        formset = AuthorFormSet.for_page(2, 2)(
+                                    queryset=User.objects.order_by('pk'))
+        self.assertEqual([form.instance for form in formset.forms],
+                         users[2:4])
+        self.assertEqual(formset.page.number, 2)
+        self.assertEqual(formset.paginator.count, len(users))
+
+        # Pages past the end show the last page.
+        formset = AuthorFormSet.for_page(10, 2)(
+                                    queryset=User.objects.order_by('pk'))
+        self.assertEqual([form.instance for form in formset.forms],
+                         users[4:])
+
+
 class VideoFormSetTestCase(BaseTestCase):
     def setUp(self):
         BaseTestCase.setUp(self)
@@ -223,6 +310,115 @@ class VideoFormSetTestCase(BaseTestCase):
                                    prefix=self.prefix)
             self.assertFalse(formset.is_valid())
 
+    def _bulk_data(self, bulk_action):
+        qs = Video.objects.order_by('pk')
+        data = {
+            'bulk_action': bulk_action,
+            '{0}-{1}'.format(self.prefix, TOTAL_FORM_COUNT): qs.count(),
+            '{0}-{1}'.format(self.prefix, INITIAL_FORM_COUNT): qs.count(),
+        }
+        for i, v in enumerate(qs):
+            data.update(dict(('{0}-{1}-{2}'.format(self.prefix, i, k), v)
+                             for k, v in model_to_dict(v).iteritems()))
+            data['{0}-{1}-{2}'.format(self.prefix, i, 'BULK')] = True
+        return data
+
+    def _validation_queries(self, data):
+        formset = VideoFormSet(data, queryset=Video.objects.order_by('pk'),
+                               prefix=self.prefix)
+        # Load the forms first; that's one query however many there are.
+        formset.forms
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            self.assertTrue(formset.is_valid())
+            return len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = None
+
+    def test_constant_queries(self):
+        """
+        Validation should take the same number of queries however many
+        videos are being approved.
+
+        """
+        tier = self.create_tier(video_limit=100)
+        self.create_tier_info(tier)
+        small = self._validation_queries(self._bulk_data('approve'))
+        for i in range(3, 30):
+            self.create_video(status=Video.UNAPPROVED,
+                              name='video{0}'.format(i),
+                              file_url='http://google.com/{0}'.format(i))
+        self.assertEqual(self._validation_queries(self._bulk_data('approve')),
+                         small)
+
+    def test_current_statuses(self):
+        """
+        Videos which were approved after the formset's queryset was loaded
+        shouldn't count against the limit again.
+
+        """
+        tier = self.create_tier(video_limit=3)
+        self.create_tier_info(tier)
+        data = self._bulk_data('approve')
+        formset = VideoFormSet(data, queryset=Video.objects.order_by('pk'),
+                               prefix=self.prefix)
+        formset.forms
+        Video.objects.filter(pk=formset.forms[0].instance.pk
+                    ).update(status=Video.ACTIVE)
+        self.assertTrue(formset.is_valid())
+        self.assertEqual(formset.approval_count, 2)
+
+    def test_stale_count(self):
+        """
+        Videos approved by bulk updates, which don't clear the cached active
+        video count, should still count against the limit.
+
+        """
+        tier = self.create_tier(video_limit=3)
+        self.create_tier_info(tier)
+        video = self.create_video(status=Video.UNAPPROVED, name='video3',
+                                  file_url='http://google.com/3')
+        self.assertEqual(active_video_count(), 0)
+        Video.objects.filter(pk=video.pk).update(status=Video.ACTIVE)
+        formset = VideoFormSet(self._bulk_data('approve'),
+                               queryset=Video.objects.order_by('pk'),
+                               prefix=self.prefix)
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.approval_count, 3)
+
+
+class ActiveVideoCountTestCase(BaseTestCase):
+    def test_cached(self):
+        """
+        The count should be cached until a video is saved or deleted.
+
+        """
+        video = self.create_video(status=Video.ACTIVE)
+        self.assertEqual(active_video_count(), 1)
+        Video.objects.update(status=Video.UNAPPROVED)
+        self.assertEqual(active_video_count(), 1)
+
+        video.status = Video.UNAPPROVED
+        video.save()
+        self.assertEqual(active_video_count(), 0)
+
+        video = self.create_video(status=Video.ACTIVE)
+        self.assertEqual(active_video_count(), 1)
+        video.delete()
+        self.assertEqual(active_video_count(), 0)
+
+    def test_other_models(self):
+        """
+        Saving other models shouldn't clear the count or pin the rest of the
+        request to the primary.
+
+        """
+        with mock.patch('mirocommunity_saas.utils.tiers.'
+                        'pin_to_primary') as pin_to_primary:
+            self.create_user(username='user')
+        self.assertFalse(pin_to_primary.called)
+
 
 class EnforcementTestCase(BaseTestCase):
     """Tests that enforcing a tier DTRT."""
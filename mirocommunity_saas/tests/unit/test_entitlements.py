@@ -0,0 +1,117 @@
+from django.core.urlresolvers import resolve
+from django.http import Http404, HttpResponse
+from django.test.utils import override_settings
+import mock
+
+from mirocommunity_saas.middleware import EntitlementMiddleware
+from mirocommunity_saas.tests import BaseTestCase
+from mirocommunity_saas.utils.entitlements import (ADS_ALLOWED, CUSTOM_CSS,
+                                                   CUSTOM_DOMAIN,
+                                                   CUSTOM_THEMES,
+                                                   request_entitlements,
+                                                   require_entitlement)
+
+
+class EntitlementsTestCase(BaseTestCase):
+    def test_mask(self):
+        """
+        A tier's mask should have a bit set for each of its entitlements.
+
+        """
+        tier = self.create_tier()
+        self.assertEqual(tier.entitlements, 0)
+        tier = self.create_tier(slug='all', custom_css=True,
+                                custom_themes=True, custom_domain=True,
+                                ads_allowed=True)
+        self.assertEqual(tier.entitlements, (CUSTOM_CSS | CUSTOM_THEMES |
+                                             CUSTOM_DOMAIN | ADS_ALLOWED))
+        tier = self.create_tier(slug='themes', custom_themes=True)
+        self.assertEqual(tier.entitlements, CUSTOM_THEMES)
+
+    def test_request_entitlements(self):
+        """
+        The current tier should only be looked up once per request.
+
+        """
+        tier = self.create_tier(custom_css=True)
+        self.create_tier_info(tier)
+        request = self.factory.get('/')
+        self.assertEqual(request_entitlements(request), CUSTOM_CSS)
+        with self.assertNumQueries(0):
+            self.assertEqual(request_entitlements(request), CUSTOM_CSS)
+
+    def test_require_entitlement(self):
+        """
+        Views should 404 unless the tier has all of the entitlements.
+
+        """
+        view = require_entitlement(CUSTOM_CSS | CUSTOM_THEMES)(
+                                        lambda request: HttpResponse('ok'))
+        request = self.factory.get('/')
+        request._entitlements = CUSTOM_CSS
+        with self.assertRaises(Http404):
+            view(request)
+        request._entitlements = CUSTOM_CSS | CUSTOM_THEMES
+        self.assertEqual(view(request).content, 'ok')
+
+
+class EntitlementMiddlewareTestCase(BaseTestCase):
+    def _process(self, middleware, request):
+        match = resolve(request.path_info)
+        return middleware.process_view(request, match.func, match.args,
+                                       match.kwargs)
+
+    def test_restricted(self):
+        """
+        Restricted urls should 404 unless the tier has the entitlement;
+        other urls shouldn't look the tier up at all.
+
+        """
+        tier = self.create_tier(custom_themes=False)
+        self.create_tier_info(tier)
+        middleware = EntitlementMiddleware()
+        for path in ('/admin/themes/', '/admin/themes/add/',
+                     '/admin/flatpages/'):
+            with self.assertRaises(Http404):
+                self._process(middleware, self.factory.get(path))
+        with self.assertNumQueries(0):
+            self.assertEqual(self._process(middleware,
+                                 self.factory.get('/admin/settings/')), None)
+
+        request = self.factory.get('/admin/themes/')
+        request._entitlements = CUSTOM_THEMES
+        self.assertEqual(self._process(middleware, request), None)
+
+    def test_no_resolve(self):
+        """
+        The middleware should use the view Django has already resolved
+        rather than resolving the url again.
+
+        """
+        tier = self.create_tier(custom_themes=False)
+        self.create_tier_info(tier)
+        middleware = EntitlementMiddleware()
+        request = self.factory.get('/admin/themes/')
+        match = resolve(request.path_info)
+        with mock.patch('django.core.urlresolvers.RegexURLResolver.'
+                        'resolve') as resolve_url:
+            with self.assertRaises(Http404):
+                middleware.process_view(request, match.func, match.args,
+                                        match.kwargs)
+        self.assertFalse(resolve_url.called)
+
+    @override_settings(MIROCOMMUNITY_SAAS_RESTRICTED_URLS={
+                        'localtv_admin_settings': CUSTOM_DOMAIN | CUSTOM_CSS})
+    def test_setting(self):
+        """
+        The url table can be replaced by a setting; all of a url's
+        entitlements are required.
+
+        """
+        middleware = EntitlementMiddleware()
+        request = self.factory.get('/admin/settings/')
+        request._entitlements = CUSTOM_DOMAIN
+        with self.assertRaises(Http404):
+            self._process(middleware, request)
+        request._entitlements = CUSTOM_DOMAIN | CUSTOM_CSS | ADS_ALLOWED
+        self.assertEqual(self._process(middleware, request), None)
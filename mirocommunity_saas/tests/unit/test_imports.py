@@ -0,0 +1,20 @@
+from mirocommunity_saas.tests import BaseTestCase
+from mirocommunity_saas.tests.imports import import_report, heavy_imports
+
+
+class CommandImportTestCase(BaseTestCase):
+    """
+    Cron-driven commands shouldn't import heavy dependencies just by being
+    loaded.
+
+    """
+    commands = ('for_sites', 'initialize', 'send_free_trial_ending',
+                'send_video_limit_warning', 'send_welcome_email')
+
+    def test_commands(self):
+        for command in self.commands:
+            seconds, modules = import_report(
+                    'mirocommunity_saas.management.commands.' + command)
+            self.assertEqual(heavy_imports(modules), [],
+                             '{0} imports {1}'.format(command,
+                                                      heavy_imports(modules)))
@@ -0,0 +1,115 @@
+import json
+from StringIO import StringIO
+import tempfile
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core import management
+from localtv.models import SiteSettings
+
+from mirocommunity_saas.models import SiteTierInfo
+from mirocommunity_saas.tests import BaseTestCase
+
+
+class InitializeManifestTestCase(BaseTestCase):
+    def setUp(self):
+        super(InitializeManifestTestCase, self).setUp()
+        for slug, price in (('basic', 0), ('plus', 15), ('premium', 35),
+                            ('max', 75)):
+            self.create_tier(name=slug, slug=slug, price=price)
+
+    def _manifest(self, rows, suffix='.jsonl'):
+        manifest = tempfile.NamedTemporaryFile(suffix=suffix)
+        if suffix == '.csv':
+            manifest.write('site_name,domain,tier,username,email,password\n')
+            for row in rows:
+                manifest.write(','.join([row['site_name'], row['domain'],
+                                         row['tier'], '', '', '']) + '\n')
+        else:
+            for row in rows:
+                manifest.write(json.dumps(row) + '\n')
+        manifest.flush()
+        return manifest
+
+    def _call(self, manifest, **kwargs):
+        stdout = StringIO()
+        management.call_command('initialize', manifest=manifest.name,
+                                stdout=stdout, stderr=StringIO(), **kwargs)
+        return stdout.getvalue()
+
+    def test_provision(self):
+        """
+        Each site in the manifest should get tier info, available tiers and
+        site settings, and one line of output.
+
+        """
+        rows = [{'site_name': 'site{0}'.format(i),
+                 'domain': 'site{0}.mirocommunity.org'.format(i),
+                 'tier': 'basic' if i % 2 else 'plus'}
+                for i in xrange(5)]
+        manifest = self._manifest(rows)
+        output = self._call(manifest, chunk_size=2)
+
+        for row in rows:
+            site = Site.objects.get(domain=row['domain'])
+            tier_info = SiteTierInfo.objects.get(site=site)
+            self.assertEqual(tier_info.tier.slug, row['tier'])
+            self.assertEqual(tier_info.site_name, row['site_name'])
+            self.assertTrue(tier_info.enforce_payments)
+            self.assertEqual(tier_info.available_tiers.count(), 4)
+            self.assertTrue(SiteSettings.objects.filter(site=site).exists())
+        lines = output.splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual([line.split()[0] for line in lines],
+                         [row['domain'] for row in rows])
+        # Only basic sites get their welcome email right away.
+        self.assertEqual(SiteTierInfo.objects.filter(
+                            welcome_email_sent__isnull=False).count(), 2)
+
+    def test_csv(self):
+        rows = [{'site_name': 'csvsite', 'domain': 'csvsite.localhost',
+                 'tier': 'basic'}]
+        manifest = self._manifest(rows, suffix='.csv')
+        self._call(manifest)
+        site = Site.objects.get(domain='csvsite.localhost')
+        self.assertEqual(SiteTierInfo.objects.get(site=site).tier.slug,
+                         'basic')
+
+    def test_already_initialized(self):
+        """
+        Sites which already have tier info should be skipped without being
+        changed, whether they're given by id or by domain.
+
+        """
+        site = Site.objects.create(domain='old.localhost', name='old')
+        tier_info = self.create_tier_info(
+                            self.create_tier(slug='old', price=5),
+                            site_id=site.pk)
+        manifest = self._manifest([{'site_name': 'new', 'site_id': site.pk,
+                                    'domain': 'new.localhost',
+                                    'tier': 'max'},
+                                   {'site_name': 'new',
+                                    'domain': 'old.localhost',
+                                    'tier': 'max'}])
+        output = self._call(manifest)
+        self.assertEqual(SiteTierInfo.objects.get(site=site), tier_info)
+        site = Site.objects.get(pk=site.pk)
+        self.assertEqual(site.domain, 'old.localhost')
+        self.assertEqual(site.name, 'old')
+        self.assertEqual(Site.objects.filter(name='new').count(), 0)
+        self.assertEqual(output, '')
+
+    def test_owner(self):
+        """
+        Owners should be made superusers, as for a single site.
+
+        """
+        manifest = self._manifest([{'site_name': 'owned',
+                                    'domain': 'owned.localhost',
+                                    'tier': 'basic', 'username': 'owner',
+                                    'email': 'owner@localhost',
+                                    'password': 'secret'}])
+        self._call(manifest)
+        owner = User.objects.get(username='owner')
+        self.assertTrue(owner.is_superuser)
+        self.assertTrue(owner.check_password('secret'))
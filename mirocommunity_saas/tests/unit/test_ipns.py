@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.core import mail
 from django.test.utils import override_settings
 from mock import patch
@@ -11,7 +12,9 @@ from paypal.standard.ipn.signals import (payment_was_successful,
 from mirocommunity_saas.models import Tier
 from mirocommunity_saas.tests import BaseTestCase
 from mirocommunity_saas.utils.tiers import (set_tier,
-                                            record_new_ipn)
+                                            record_new_ipn,
+                                            reconcile_tier,
+                                            queue_tier_reconciliation)
 
 
 @override_settings(MANAGERS=(('Manager', 'manager@localhost'),))
@@ -92,6 +95,35 @@ class SetTierByPaymentTestCase(BaseTestCase):
         self.assertFalse(self._enforce_tier.called)
 
 
+class ReconcileTierTestCase(BaseTestCase):
+    def setUp(self):
+        super(ReconcileTierTestCase, self).setUp()
+        self.tier = self.create_tier(price=20, slug='tier20')
+
+    def test_reconcile(self):
+        """The tier should be set to match the subscription's price."""
+        self.create_tier_info(self.tier, enforce_payments=True)
+        with patch('mirocommunity_saas.utils.tiers.set_tier') as set_tier:
+            reconcile_tier()
+        set_tier.assert_called_once_with(20)
+
+    def test_not_enforced(self):
+        self.create_tier_info(self.tier, enforce_payments=False)
+        with patch('mirocommunity_saas.utils.tiers.set_tier') as set_tier:
+            reconcile_tier()
+        self.assertFalse(set_tier.called)
+
+    def test_queue_once(self):
+        """Reconciliation should only be queued once at a time."""
+        with patch('mirocommunity_saas.tasks.reconcile_tier_task.delay'
+                   ) as delay:
+            with patch('mirocommunity_saas.utils.tiers.cache.add',
+                       side_effect=[True, False]):
+                queue_tier_reconciliation()
+                queue_tier_reconciliation()
+        delay.assert_called_once_with(site_id=settings.SITE_ID)
+
+
 class RecordNewIpnTestCase(BaseTestCase):
     def test_receiver(self):
         """
@@ -1,13 +1,24 @@
 import datetime
 
+from django.contrib.sites.models import Site
+from django.contrib.auth.models import User
 from django.core import mail, management
+from django.test.utils import override_settings
 from localtv.models import SiteSettings
 import mock
 
+from mirocommunity_saas.models import SiteTierInfo
 from mirocommunity_saas.tests import BaseTestCase
-from mirocommunity_saas.utils.mail import (send_free_trial_ending,
+from mirocommunity_saas.tests.smtp import LocalSMTPServer
+from mirocommunity_saas.utils import mail as mail_utils
+from mirocommunity_saas.utils.mail import (MailSendError, mail_templates,
+                                           markdown_to_html,
+                                           send_free_trial_ending,
+                                           send_mail,
+                                           send_pending_welcome_emails,
                                            send_video_limit_warning,
                                            send_welcome_email)
+from mirocommunity_saas.utils.sites import current_site
 
 
 class MailTestCase(BaseTestCase):
@@ -128,6 +139,280 @@ class MailTestCase(BaseTestCase):
         self.assertEqual(mail.outbox[0].to, [self.owner.email])
 
 
+class SendMailTestCase(BaseTestCase):
+    subject_template = 'mirocommunity_saas/mail/welcome/subject.txt'
+    body_template = 'mirocommunity_saas/mail/welcome/body.md'
+
+    def setUp(self):
+        super(SendMailTestCase, self).setUp()
+        self.create_tier_info(self.create_tier())
+        self.users = [self.create_user(username='user{0}'.format(i),
+                                       email='user{0}@localhost'.format(i))
+                      for i in xrange(5)]
+        self.users.append(self.create_user(username='noemail'))
+        mail.outbox = []
+
+    def test_serial(self):
+        """
+        Each user with an email address and each (name, email) tuple should
+        get one message.
+
+        """
+        send_mail(self.subject_template, self.body_template,
+                  self.users + [('Manager', 'manager@localhost')])
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual([m.to for m in mail.outbox],
+                         [[u.email] for u in self.users[:5]] +
+                         [['manager@localhost']])
+        self.assertTrue('user0' in mail.outbox[0].body)
+
+    def test_parallel(self):
+        """
+        Rendering on a process pool should produce the same messages as
+        rendering in-process, in the same order.
+
+        """
+        send_mail(self.subject_template, self.body_template, self.users)
+        serial = [(m.to, m.subject, m.body) for m in mail.outbox]
+        mail.outbox = []
+        send_mail(self.subject_template, self.body_template, self.users,
+                  processes=2, chunk_size=2)
+        parallel = [(m.to, m.subject, m.body) for m in mail.outbox]
+        self.assertEqual(parallel, serial)
+
+    def test_parallel__transaction(self):
+        """
+        Rendering on a process pool shouldn't disturb the caller's database
+        connection or throw away its uncommitted work.
+
+        """
+        user = self.create_user(username='uncommitted',
+                                email='uncommitted@localhost')
+        send_mail(self.subject_template, self.body_template, self.users,
+                  processes=2, chunk_size=2)
+        self.assertTrue(User.objects.filter(pk=user.pk).exists())
+
+    def test_connections(self):
+        """
+        Messages should be spread over the requested number of mail server
+        connections.
+
+        """
+        with LocalSMTPServer() as server:
+            with override_settings(
+                    EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                    EMAIL_HOST=server.host,
+                    EMAIL_PORT=server.port,
+                    EMAIL_USE_TLS=False,
+                    EMAIL_HOST_USER='',
+                    EMAIL_HOST_PASSWORD=''):
+                send_mail(self.subject_template, self.body_template,
+                          self.users, processes=2, chunk_size=2,
+                          connections=2)
+        self.assertEqual(server.connection_count, 2)
+        self.assertEqual(sorted(rcpttos for _, rcpttos, _ in server.messages),
+                         [[u.email] for u in self.users[:5]])
+
+    def test_connections__failures(self):
+        """
+        If some connections fail, the others should still send their
+        messages, and every failure should be reported.
+
+        """
+        sent = []
+
+        def send_messages(messages):
+            if messages[0].to == [self.users[0].email]:
+                raise IOError('first')
+            if messages[0].to == [self.users[1].email]:
+                raise IOError('second')
+            sent.extend(messages)
+
+        with mock.patch('mirocommunity_saas.utils.mail.get_connection'
+                        ) as get_connection:
+            get_connection.return_value.send_messages.side_effect = (
+                                                            send_messages)
+            with self.assertRaises(MailSendError) as cm:
+                send_mail(self.subject_template, self.body_template,
+                          self.users, connections=3)
+        self.assertEqual(sorted(str(e) for e in cm.exception.errors),
+                         ['first', 'second'])
+        self.assertEqual([m.to for m in sent],
+                         [[self.users[2].email]])
+
+
+class MailTemplateRegistryTestCase(BaseTestCase):
+    template_name = 'mirocommunity_saas/mail/welcome/subject.txt'
+
+    def test_compiled_once(self):
+        """
+        Templates should only go through the loaders the first time they are
+        requested.
+
+        """
+        with mock.patch('mirocommunity_saas.utils.mail.loader.get_template'
+                        ) as get_template:
+            template = mail_templates.get_template(self.template_name)
+            self.assertEqual(mail_templates.get_template(self.template_name),
+                             template)
+            get_template.assert_called_once_with(self.template_name)
+
+    def test_version_change(self):
+        """
+        Changing the version stamp should invalidate compiled templates.
+
+        """
+        with mock.patch('mirocommunity_saas.utils.mail.loader.get_template'
+                        ) as get_template:
+            with override_settings(MIROCOMMUNITY_SAAS_MAIL_VERSION='1'):
+                mail_templates.get_template(self.template_name)
+            with override_settings(MIROCOMMUNITY_SAAS_MAIL_VERSION='2'):
+                mail_templates.get_template(self.template_name)
+                mail_templates.get_template(self.template_name)
+            self.assertEqual(get_template.call_count, 2)
+
+    def test_theme_change(self):
+        """
+        Saving or deleting a theme should invalidate compiled templates,
+        since themes can override them.
+
+        """
+        with mock.patch('mirocommunity_saas.utils.mail.loader.get_template'
+                        ) as get_template:
+            mail_templates.get_template(self.template_name)
+            theme = self.create_theme()
+            mail_templates.get_template(self.template_name)
+            mail_templates.get_template(self.template_name)
+            theme.delete()
+            mail_templates.get_template(self.template_name)
+            self.assertEqual(get_template.call_count, 3)
+
+    def test_per_site(self):
+        """
+        Each site should get its own compiled templates, since themes can
+        override them.
+
+        """
+        site = Site.objects.create(domain='other.localhost', name='other')
+        with mock.patch('mirocommunity_saas.utils.mail.loader.get_template',
+                        side_effect=lambda name: object()) as get_template:
+            template = mail_templates.get_template(self.template_name)
+            with current_site(site.pk):
+                other = mail_templates.get_template(self.template_name)
+                self.assertTrue(mail_templates.get_template(
+                                            self.template_name) is other)
+            self.assertTrue(mail_templates.get_template(
+                                            self.template_name) is template)
+            self.assertFalse(other is template)
+            self.assertEqual(get_template.call_count, 2)
+
+    def test_markdown_to_html(self):
+        html = markdown_to_html('*Hello*')
+        self.assertEqual(html, '<p><em>Hello</em></p>')
+        self.assertEqual(markdown_to_html('*Hello*'), html)
+        self.assertEqual(markdown_to_html('Bye'), '<p>Bye</p>')
+
+    def test_markdown_cache_size(self):
+        """
+        Only the most recently converted bodies should be remembered.
+
+        """
+        for i in xrange(mail_utils.MARKDOWN_CACHE_SIZE + 10):
+            markdown_to_html('Body {0}'.format(i))
+        self.assertEqual(len(mail_utils._markdown_cache),
+                         mail_utils.MARKDOWN_CACHE_SIZE)
+
+
+class WelcomeEmailSweepTestCase(BaseTestCase):
+    def setUp(self):
+        super(WelcomeEmailSweepTestCase, self).setUp()
+        self.owner = self.create_user(username='superuser',
+                                      email='superuser@localhost',
+                                      is_superuser=True)
+        self.tier = self.create_tier()
+        mail.outbox = []
+
+    def _tier_info(self, domain, minutes_ago, **kwargs):
+        site = Site.objects.create(domain=domain, name=domain)
+        created = datetime.datetime.now() - datetime.timedelta(
+                                                        minutes=minutes_ago)
+        kwargs.setdefault('enforce_payments', True)
+        return self.create_tier_info(self.tier, site_id=site.pk,
+                                     created=created, **kwargs)
+
+    def test_sweep(self):
+        """
+        Only sites past the grace period which haven't been welcomed should
+        be emailed, and they should be marked as welcomed.
+
+        """
+        due = self._tier_info('due.localhost', 45)
+        self._tier_info('recent.localhost', 5)
+        self._tier_info('ancient.localhost', 60 * 24 * 30)
+        self._tier_info('welcomed.localhost', 45,
+                        welcome_email_sent=datetime.datetime.now())
+        # Tier info created on demand, rather than by initialize.
+        self._tier_info('on-demand.localhost', 45, enforce_payments=False)
+
+        with mock.patch('mirocommunity_saas.utils.mail.get_connection'
+                        ) as get_connection:
+            get_connection.return_value = mail.get_connection()
+            self.assertEqual(send_pending_welcome_emails(), [due.site_id])
+            self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue('due.localhost' in mail.outbox[0].body)
+        self.assertEqual(mail.outbox[0].to, [self.owner.email])
+        self.assertTrue(SiteTierInfo.objects.get(pk=due.pk
+                                                 ).welcome_email_sent)
+        self.assertEqual(send_pending_welcome_emails(), [])
+
+    def test_sweep__claimed(self):
+        """
+        Sites claimed by another sweep after they were listed shouldn't be
+        emailed again.
+
+        """
+        due = self._tier_info('due.localhost', 45)
+        claim = mail_utils._claim_welcome_email
+
+        def claim_elsewhere(tier_info_id, now):
+            claim(tier_info_id, now)
+            return claim(tier_info_id, now)
+
+        with mock.patch.object(mail_utils, '_claim_welcome_email',
+                               claim_elsewhere):
+            self.assertEqual(send_pending_welcome_emails(), [])
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertTrue(SiteTierInfo.objects.get(pk=due.pk
+                                                 ).welcome_email_sent)
+
+    def test_sweep__failure(self):
+        """
+        If sending fails for a site, the other sites should still be
+        emailed, and the site's claim should be given up so that the next
+        sweep tries again.
+
+        """
+        broken = self._tier_info('broken.localhost', 50)
+        due = self._tier_info('due.localhost', 45)
+        send_mail = mail_utils.send_mail
+
+        def send_or_fail(*args, **kwargs):
+            if SiteTierInfo.objects.get_current() == broken:
+                raise IOError
+            return send_mail(*args, **kwargs)
+
+        with mock.patch.object(mail_utils, 'send_mail', send_or_fail):
+            with mock.patch.object(mail_utils.logging, 'error') as error:
+                self.assertEqual(send_pending_welcome_emails(),
+                                 [due.site_id])
+        self.assertEqual(error.call_count, 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(SiteTierInfo.objects.get(pk=broken.pk
+                                                  ).welcome_email_sent, None)
+        self.assertEqual(send_pending_welcome_emails(), [broken.site_id])
+
+
 class VideoLimitWarningTestCase(BaseTestCase):
     def setUp(self):
         self.create_user(email='superuser@localhost', is_superuser=True)
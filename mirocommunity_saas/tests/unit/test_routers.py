@@ -0,0 +1,150 @@
+from celery.signals import task_postrun, task_prerun
+from django.core.management.color import no_style
+from django.db import connections, router, DEFAULT_DB_ALIAS
+from django.db.models import get_app, get_models
+from django.http import HttpResponse
+from django.test.utils import override_settings
+from localtv.models import Video
+from mock import patch
+
+from mirocommunity_saas.admin.forms import TierChangeForm
+from mirocommunity_saas.middleware import ReadReplicaMiddleware
+from mirocommunity_saas.models import Tier
+from mirocommunity_saas.routers import (is_pinned, pin_to_primary,
+                                        read_database, ReadReplicaRouter,
+                                        unpin, write_database)
+from mirocommunity_saas.tests import BaseTestCase
+from mirocommunity_saas.utils.tiers import record_new_ipn, set_tier
+
+
+class ReadReplicaRouterTestCase(BaseTestCase):
+    """
+    Runs the router against a second in-memory SQLite database which stands
+    in for the read replica. It starts out empty, so reads which reach it
+    are easy to spot.
+
+    """
+    def setUp(self):
+        super(ReadReplicaRouterTestCase, self).setUp()
+        connections.databases['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+        replica = connections['replica']
+        cursor = replica.cursor()
+        for model in get_models(get_app('mirocommunity_saas'),
+                                include_auto_created=True):
+            for statement in replica.creation.sql_create_model(model,
+                                                              no_style())[0]:
+                cursor.execute(statement)
+        self._routers = router.routers
+        router.routers = [ReadReplicaRouter()]
+        unpin()
+
+    def tearDown(self):
+        router.routers = self._routers
+        unpin()
+        connections['replica'].close()
+        delattr(connections._connections, 'replica')
+        del connections.databases['replica']
+        super(ReadReplicaRouterTestCase, self).tearDown()
+
+    def _slugs(self):
+        return list(Tier.objects.order_by('slug'
+                               ).values_list('slug', flat=True))
+
+    def test_read_your_writes(self):
+        """
+        Reads should go to the replica until something is written, and then
+        to the primary.
+
+        """
+        Tier.objects.using('replica').create(name='Replica', slug='replica')
+        self.assertFalse(is_pinned())
+        self.assertEqual(self._slugs(), ['replica'])
+
+        self.create_tier(slug='primary')
+        self.assertTrue(is_pinned())
+        self.assertEqual(self._slugs(), ['primary'])
+
+        # The next request starts over.
+        middleware = ReadReplicaMiddleware()
+        middleware.process_request(self.factory.get('/'))
+        self.assertEqual(self._slugs(), ['replica'])
+
+    def test_other_apps(self):
+        """
+        Other apps' models should be left to the default routing, but can
+        ask for the read database explicitly. Saving a video pins reads to
+        the primary, so that quota counts see it.
+
+        """
+        self.assertEqual(Video.objects.all().db, DEFAULT_DB_ALIAS)
+        self.assertEqual(read_database(), 'replica')
+        self.create_video()
+        self.assertTrue(is_pinned())
+        self.assertEqual(read_database(), DEFAULT_DB_ALIAS)
+
+    @override_settings(MIROCOMMUNITY_SAAS_READ_DATABASE='missing')
+    def test_no_replica(self):
+        """
+        Reads should go to the primary if the replica isn't configured.
+
+        """
+        self.assertEqual(read_database(), DEFAULT_DB_ALIAS)
+        self.assertEqual(Tier.objects.all().db, DEFAULT_DB_ALIAS)
+
+    def test_relations(self):
+        """
+        Objects from the primary and the replica can be related, and the
+        replica's tables are never synced.
+
+        """
+        replica_router = ReadReplicaRouter()
+        tier = Tier.objects.using('replica').create(name='Replica',
+                                                    slug='replica')
+        tier_info = self.create_tier_info(self.create_tier())
+        self.assertTrue(replica_router.allow_relation(tier, tier_info))
+        self.assertFalse(replica_router.allow_syncdb('replica', Tier))
+        self.assertEqual(replica_router.allow_syncdb(DEFAULT_DB_ALIAS, Tier),
+                         None)
+        self.assertEqual(write_database('replica'), DEFAULT_DB_ALIAS)
+        self.assertEqual(write_database(None), DEFAULT_DB_ALIAS)
+        self.assertEqual(write_database('other'), 'other')
+
+
+class PinningTestCase(BaseTestCase):
+    def setUp(self):
+        super(PinningTestCase, self).setUp()
+        self.tier = self.create_tier(price=0)
+        self.tier2 = self.create_tier(slug='tier2', price=10)
+        self.tier_info = self.create_tier_info(self.tier,
+                                               available_tiers=[self.tier2])
+        unpin()
+        self.addCleanup(unpin)
+
+    def test_set_tier(self):
+        with patch('mirocommunity_saas.utils.tiers.enforce_tier'):
+            set_tier(10)
+        self.assertTrue(is_pinned())
+
+    def test_record_new_ipn(self):
+        record_new_ipn(self.create_ipn(txn_type='subscr_payment'))
+        self.assertTrue(is_pinned())
+
+    def test_tier_change_form(self):
+        form = TierChangeForm()
+        form.cleaned_data = {'tier': self.tier2}
+        form.save()
+        self.assertTrue(is_pinned())
+
+    def test_tasks(self):
+        """
+        Each task should start and end unpinned.
+
+        """
+        for signal in (task_prerun, task_postrun):
+            pin_to_primary()
+            signal.send(sender=None, task_id='1', task=None, args=(),
+                        kwargs={})
+            self.assertFalse(is_pinned())
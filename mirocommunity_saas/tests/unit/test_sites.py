@@ -0,0 +1,222 @@
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core import management
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+import mock
+
+from mirocommunity_saas.middleware import SiteDomainMiddleware
+from mirocommunity_saas.models import SiteTierInfo
+from mirocommunity_saas.tests import BaseTestCase
+from mirocommunity_saas.utils.sites import (current_site, DomainSiteMap,
+                                            domain_site_map)
+from mirocommunity_saas.utils.tiers import enforce_tier
+
+
+class CurrentSiteTestCase(BaseTestCase):
+    def test_switch(self):
+        """
+        Inside the block, the given site should be current, and per-site
+        caches shouldn't leak between sites.
+
+        """
+        site2 = Site.objects.create(domain='site2.localhost', name='site2')
+        tier = self.create_tier()
+        tier_info1 = self.create_tier_info(tier)
+        tier_info2 = self.create_tier_info(tier, site_id=site2.pk)
+        self.assertEqual(SiteTierInfo.objects.get_current(), tier_info1)
+        with current_site(site2.pk):
+            self.assertEqual(settings.SITE_ID, site2.pk)
+            self.assertEqual(Site.objects.get_current(), site2)
+            self.assertEqual(SiteTierInfo.objects.get_current(), tier_info2)
+        self.assertEqual(settings.SITE_ID, 1)
+        self.assertEqual(SiteTierInfo.objects.get_current(), tier_info1)
+
+
+class ForSitesCommandTestCase(BaseTestCase):
+    def setUp(self):
+        super(ForSitesCommandTestCase, self).setUp()
+        tier = self.create_tier()
+        self.site_ids = [1]
+        self.create_tier_info(tier)
+        for i in xrange(2, 4):
+            site = Site.objects.create(domain='site{0}.localhost'.format(i),
+                                       name='site{0}'.format(i))
+            self.create_tier_info(tier, site_id=site.pk)
+            self.site_ids.append(site.pk)
+
+    def test_all_sites(self):
+        """
+        By default, the command should run once per site with tier info, with
+        that site current.
+
+        """
+        seen = []
+        with mock.patch('mirocommunity_saas.management.commands.for_sites.'
+                        'call_command') as call_command:
+            call_command.side_effect = lambda *args, **kwargs: seen.append(
+                                                            settings.SITE_ID)
+            management.call_command('for_sites', 'send_welcome_email')
+            args, kwargs = call_command.call_args
+            self.assertEqual(args, ('send_welcome_email',))
+        self.assertEqual(seen, self.site_ids)
+
+    def test_command_options(self):
+        """
+        Arguments after the command's name should be parsed by the command
+        and passed on to it.
+
+        """
+        with mock.patch('mirocommunity_saas.management.commands.for_sites.'
+                        'call_command') as call_command:
+            management.call_command('for_sites', 'initialize', '--tier=plus',
+                                    'Site', 'site.localhost', sites='1')
+            args, kwargs = call_command.call_args
+        self.assertEqual(args, ('initialize', 'Site', 'site.localhost'))
+        self.assertEqual(kwargs['tier'], 'plus')
+        self.assertEqual(kwargs['chunk_size'], 100)
+
+    def test_site_list(self):
+        seen = []
+        with mock.patch('mirocommunity_saas.management.commands.for_sites.'
+                        'call_command') as call_command:
+            call_command.side_effect = lambda *args, **kwargs: seen.append(
+                                                            settings.SITE_ID)
+            management.call_command('for_sites', 'send_welcome_email',
+                                    sites='{0},1'.format(self.site_ids[2]))
+        self.assertEqual(seen, [self.site_ids[2], 1])
+
+    def test_failure_isolation(self):
+        """
+        A failure for one site shouldn't stop the command from running for
+        the others, but should be reported at the end.
+
+        """
+        seen = []
+
+        def run(*args, **kwargs):
+            seen.append(settings.SITE_ID)
+            if settings.SITE_ID == self.site_ids[0]:
+                raise ValueError
+            if settings.SITE_ID == self.site_ids[1]:
+                # What a command which raises a CommandError does.
+                raise SystemExit(1)
+
+        with mock.patch('mirocommunity_saas.management.commands.for_sites.'
+                        'call_command') as call_command:
+            call_command.side_effect = run
+            # Django reports the CommandError and exits.
+            with self.assertRaises(SystemExit):
+                management.call_command('for_sites', 'send_welcome_email')
+        self.assertEqual(seen, self.site_ids)
+
+
+class DomainSiteMapTestCase(BaseTestCase):
+    def setUp(self):
+        super(DomainSiteMapTestCase, self).setUp()
+        domain_site_map.invalidate()
+        self.site2 = Site.objects.create(domain='Site2.example.com',
+                                         name='site2')
+
+    def test_resolve(self):
+        """
+        Hosts should be matched without their port or case.
+
+        """
+        self.assertEqual(domain_site_map.resolve('site2.example.com:8000'),
+                         self.site2.pk)
+        self.assertEqual(domain_site_map.resolve('SITE2.example.com.'),
+                         self.site2.pk)
+        self.assertEqual(domain_site_map.resolve('nowhere.example.com'),
+                         None)
+        with self.assertNumQueries(0):
+            domain_site_map.resolve('site2.example.com')
+
+    def test_shared(self):
+        """
+        Other processes should pick up the map from the cache.
+
+        """
+        domain_site_map.domains()
+        with self.assertNumQueries(0):
+            self.assertEqual(DomainSiteMap().resolve('site2.example.com'),
+                             self.site2.pk)
+
+    def test_site_saved(self):
+        """
+        Saving a site, including enforce_tier's domain rewrite, should
+        refresh every copy of the map.
+
+        """
+        other = DomainSiteMap()
+        other.domains()
+        tier = self.create_tier(custom_domain=False)
+        self.create_tier_info(tier, site_id=self.site2.pk, site_name='site2')
+        with current_site(self.site2.pk):
+            enforce_tier(tier)
+        self.assertEqual(other.resolve('site2.mirocommunity.org'),
+                         self.site2.pk)
+        self.assertEqual(other.resolve('site2.example.com'), None)
+
+        self.site2.delete()
+        self.assertEqual(other.resolve('site2.mirocommunity.org'), None)
+
+    def test_miss_rebuilds(self):
+        """
+        A map built before a new site was committed should be rebuilt once
+        when the new site's host misses, rather than 404ing until the next
+        invalidation.
+
+        """
+        other = DomainSiteMap()
+        other.domains()
+        # As if the map had been built while the site's transaction was
+        # still open.
+        with mock.patch.object(domain_site_map, 'invalidate'):
+            site3 = Site.objects.create(domain='site3.example.com',
+                                        name='site3')
+        self.assertEqual(other.resolve('site3.example.com'), site3.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(other.resolve('nowhere.example.com'), None)
+
+
+class SiteDomainMiddlewareTestCase(BaseTestCase):
+    def setUp(self):
+        super(SiteDomainMiddlewareTestCase, self).setUp()
+        domain_site_map.invalidate()
+        self.site2 = Site.objects.create(domain='site2.example.com',
+                                         name='site2')
+        self.middleware = SiteDomainMiddleware()
+
+    def test_switch(self):
+        """
+        The request's site should be current until the response goes out.
+
+        """
+        request = self.factory.get('/', HTTP_HOST='site2.example.com')
+        self.assertEqual(self.middleware.process_request(request), None)
+        self.assertEqual(settings.SITE_ID, self.site2.pk)
+        self.assertEqual(Site.objects.get_current(), self.site2)
+        response = HttpResponse()
+        self.assertEqual(self.middleware.process_response(request, response),
+                         response)
+        self.assertEqual(settings.SITE_ID, 1)
+
+    def test_unknown(self):
+        request = self.factory.get('/', HTTP_HOST='nowhere.example.com')
+        response = self.middleware.process_request(request)
+        self.assertEqual(response.status_code, 404)
+        self.middleware.process_response(request, response)
+        self.assertEqual(settings.SITE_ID, 1)
+
+    def test_multithreaded(self):
+        """
+        Requests from threaded servers should be refused, since the current
+        site is process-wide.
+
+        """
+        request = self.factory.get('/', HTTP_HOST='site2.example.com',
+                                   **{'wsgi.multithread': True})
+        with self.assertRaises(ImproperlyConfigured):
+            self.middleware.process_request(request)
+        self.assertEqual(settings.SITE_ID, 1)
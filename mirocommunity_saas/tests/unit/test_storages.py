@@ -0,0 +1,552 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from django.core.files.base import ContentFile
+from django.test.utils import override_settings
+import mock
+
+from mirocommunity_saas.tests.s3 import LocalBucket, LocalS3Storage
+from mirocommunity_saas.utils.functional import LRUCache
+
+try:
+    from mirocommunity_saas.storages import (MultiCallingFormat,
+                                             CachedURLMixin,
+                                             ManifestMixin,
+                                             PrecompressMixin,
+                                             SyncMixin,
+                                             PooledConnectionMixin,
+                                             S3ConnectionPool,
+                                             close_connection_pools)
+except ImportError:
+    # boto and django-storages aren't installed everywhere.
+    MultiCallingFormat = CachedURLMixin = ManifestMixin = None
+    PrecompressMixin = SyncMixin = PooledConnectionMixin = None
+
+
+def _formats(count):
+    formats = []
+    for i in xrange(count):
+        format = mock.Mock()
+        format.build_url_base.return_value = 'http://s{0}.example.com'.format(i)
+        formats.append(format)
+    return formats
+
+
+@unittest.skipIf(MultiCallingFormat is None, 'boto is not installed.')
+class MultiCallingFormatTestCase(unittest.TestCase):
+    keys = ['static/file{0}.css'.format(i) for i in xrange(1000)]
+
+    def _hosts(self, calling_format):
+        return [calling_format.build_url_base(None, 'http', 's3.example.com',
+                                              'bucket', key)
+                for key in self.keys]
+
+    def test_stable(self):
+        """
+        In deterministic mode, a key should always get the same host, even
+        from a separately constructed calling format.
+
+        """
+        formats = _formats(4)
+        hosts = self._hosts(MultiCallingFormat(formats, deterministic=True))
+        self.assertEqual(self._hosts(MultiCallingFormat(formats,
+                                                        deterministic=True)),
+                         hosts)
+        # And all the formats should actually get used.
+        self.assertEqual(len(set(hosts)), 4)
+
+    def test_add_shard(self):
+        """
+        Adding a format should only remap around its share of the keys.
+
+        """
+        formats = _formats(5)
+        before = self._hosts(MultiCallingFormat(formats[:4],
+                                                deterministic=True))
+        after = self._hosts(MultiCallingFormat(formats, deterministic=True))
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        # Every moved key should move to the new format...
+        self.assertTrue(all(a == 'http://s4.example.com' for b, a in moved))
+        # ... and the new format should take roughly a fifth of them.
+        self.assertTrue(100 < len(moved) < 300, len(moved))
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Using 'a' makes 'b' the least recently used.
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class FakeS3Storage(object):
+    custom_domain = None
+    querystring_auth = False
+    querystring_expire = 3600
+    calling_format = None
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.url_calls = 0
+
+    def url(self, name):
+        self.url_calls += 1
+        return 'http://bucket.example.com/{0}?{1}'.format(name,
+                                                           self.url_calls)
+
+
+@unittest.skipIf(CachedURLMixin is None, 'boto is not installed.')
+class CachedURLMixinTestCase(unittest.TestCase):
+    def _storage(self, **kwargs):
+        class Storage(CachedURLMixin, FakeS3Storage):
+            pass
+        return Storage(**kwargs)
+
+    def test_unsigned(self):
+        """Unsigned URLs should only be generated once."""
+        storage = self._storage()
+        url = storage.url('css/base.css')
+        with mock.patch('mirocommunity_saas.storages.time.time',
+                        return_value=10 ** 12):
+            self.assertEqual(storage.url('css/base.css'), url)
+        self.assertEqual(storage.url_calls, 1)
+        storage.url('css/other.css')
+        self.assertEqual(storage.url_calls, 2)
+
+    def test_signed(self):
+        """
+        Signed URLs should be regenerated shortly before they expire.
+
+        """
+        storage = self._storage(querystring_auth=True,
+                                querystring_expire=3600)
+        with mock.patch('mirocommunity_saas.storages.time.time',
+                        return_value=1000):
+            url = storage.url('css/base.css')
+        with mock.patch('mirocommunity_saas.storages.time.time',
+                        return_value=1000 + 3000):
+            self.assertEqual(storage.url('css/base.css'), url)
+        with mock.patch('mirocommunity_saas.storages.time.time',
+                        return_value=1000 + 3550):
+            self.assertNotEqual(storage.url('css/base.css'), url)
+        self.assertEqual(storage.url_calls, 2)
+
+
+@unittest.skipIf(ManifestMixin is None, 'boto is not installed.')
+class ManifestMixinTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.bucket = LocalBucket(os.path.join(self.root, 'bucket'))
+        os.makedirs(self.bucket.root)
+        self.bucket.set_contents('static/css/base.css', 'body {}')
+        self.bucket.set_contents('static/js/base.js', 'var a;')
+        self.bucket.set_contents('other/file.txt', 'other')
+        self.bucket.requests = 0
+
+    def _storage(self, manifest=True):
+        class Storage(ManifestMixin, LocalS3Storage):
+            pass
+        return Storage(bucket=self.bucket, location='static',
+                       manifest=manifest)
+
+    def test_listed_once(self):
+        """
+        Metadata should come from a single listing of the storage's prefix.
+
+        """
+        storage = self._storage()
+        self.assertTrue(storage.exists('css/base.css'))
+        self.assertFalse(storage.exists('css/missing.css'))
+        self.assertFalse(storage.exists('../other/file.txt'))
+        self.assertEqual(storage.size('js/base.js'), 6)
+        self.assertTrue(storage.modified_time('js/base.js'))
+        self.assertEqual(self.bucket.requests, 1)
+        self.assertEqual(sorted(storage.index),
+                         ['static/css/base.css', 'static/js/base.js'])
+
+    @override_settings(TIME_ZONE='America/New_York')
+    def test_modified_time(self):
+        """
+        Modified times should be naive UTC datetimes, as they are from
+        S3BotoStorage, whether or not they come from the index and whatever
+        the local time zone.
+
+        """
+        mtime = os.stat(self.bucket.path('static/js/base.js')).st_mtime
+        expected = datetime.datetime.utcfromtimestamp(int(mtime))
+        self.assertEqual(self._storage().modified_time('js/base.js'),
+                         expected)
+        self.assertEqual(self._storage(manifest=False
+                                       ).modified_time('js/base.js'),
+                         expected)
+
+    def test_disabled(self):
+        storage = self._storage(manifest=False)
+        self.assertTrue(storage.exists('css/base.css'))
+        self.assertTrue(storage.exists('css/base.css'))
+        self.assertEqual(self.bucket.requests, 2)
+
+    def test_save_delete(self):
+        """Saving and deleting should keep the index up to date."""
+        storage = self._storage()
+        storage.save('css/new.css', ContentFile('a {}'))
+        storage.delete('css/base.css')
+        requests = self.bucket.requests
+        self.assertTrue(storage.exists('css/new.css'))
+        self.assertEqual(storage.size('css/new.css'), 4)
+        self.assertFalse(storage.exists('css/base.css'))
+        self.assertEqual(self.bucket.requests, requests)
+
+    def test_persisted(self):
+        """
+        A saved manifest should be loaded without listing the bucket, and
+        entries from other locations should be kept.
+
+        """
+        path = os.path.join(self.root, 'manifest.json')
+        with open(path, 'w') as f:
+            json.dump({'compressed/a.css': {'size': 1, 'etag': None,
+                                            'modified': '2012-01-01T00:00:00'}
+                       }, f)
+        storage = self._storage(manifest=path)
+        storage.exists('css/base.css')
+        self.assertEqual(self.bucket.requests, 0)
+        self.assertEqual(storage.index.keys(), ['compressed/a.css'])
+
+        os.remove(path)
+        storage = self._storage(manifest=path)
+        storage.exists('css/base.css')
+        storage.save_manifest()
+        self.assertEqual(self.bucket.requests, 1)
+
+        storage = self._storage(manifest=path)
+        self.assertTrue(storage.exists('js/base.js'))
+        self.assertEqual(storage.size('js/base.js'), 6)
+        self.assertEqual(self.bucket.requests, 1)
+
+
+@unittest.skipIf(SyncMixin is None, 'boto is not installed.')
+class SyncMixinTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.bucket = LocalBucket(os.path.join(self.root, 'bucket'))
+        os.makedirs(self.bucket.root)
+        self.local = os.path.join(self.root, 'local')
+        os.makedirs(self.local)
+
+    def _storage(self, manifest=False):
+        class Storage(SyncMixin, ManifestMixin, LocalS3Storage):
+            sync_multipart_threshold = 100
+            sync_part_size = 40
+        return Storage(bucket=self.bucket, location='static',
+                       manifest=manifest)
+
+    def _files(self, contents):
+        files = []
+        for name, content in sorted(contents.items()):
+            path = os.path.join(self.local, name.replace('/', '_'))
+            with open(path, 'wb') as f:
+                f.write(content)
+            files.append((name, path))
+        return files
+
+    def test_sync(self):
+        """
+        Only new or changed files should be uploaded, and large files should
+        be uploaded in parts.
+
+        """
+        files = self._files({'a.css': 'a {}', 'b.js': 'var b;',
+                             'big.bin': 'x' * 250})
+        result = self._storage().sync(files, workers=2)
+        self.assertEqual(sorted(result.uploaded), ['a.css', 'b.js', 'big.bin'])
+        self.assertEqual(result.bytes_uploaded, 260)
+        self.assertEqual(self.bucket.multipart_uploads, ['static/big.bin'])
+        self.assertEqual(self.bucket.policies['static/big.bin'],
+                         'public-read')
+
+        files = self._files({'a.css': 'a { color: red }', 'b.js': 'var b;',
+                             'big.bin': 'x' * 250})
+        result = self._storage().sync(files)
+        self.assertEqual(result.uploaded, ['a.css'])
+        self.assertEqual(sorted(result.skipped), ['b.js', 'big.bin'])
+        self.assertEqual(result.bytes_skipped, 256)
+        with open(self.bucket.path('static/a.css')) as f:
+            self.assertEqual(f.read(), 'a { color: red }')
+
+    def test_sync__manifest(self):
+        """
+        With a manifest, the ETags recorded by a sync should be used by the
+        next one without listing the bucket again.
+
+        """
+        storage = self._storage(manifest=True)
+        files = self._files({'a.css': 'a {}', 'big.bin': 'x' * 250})
+        storage.sync(files)
+        requests = self.bucket.requests
+        result = storage.sync(files)
+        self.assertEqual(sorted(result.skipped), ['a.css', 'big.bin'])
+        self.assertEqual(self.bucket.requests, requests)
+
+
+@unittest.skipIf(PrecompressMixin is None, 'boto is not installed.')
+class PrecompressMixinTestCase(unittest.TestCase):
+    css = 'body { color: red; }\n' * 50
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.bucket = LocalBucket(os.path.join(self.root, 'bucket'))
+        os.makedirs(self.bucket.root)
+
+    def _storage(self, precompress=True, manifest=False):
+        class Storage(PrecompressMixin, ManifestMixin, LocalS3Storage):
+            pass
+        return Storage(bucket=self.bucket, location='compressed',
+                       headers={'x-amz-meta-site': 'test'},
+                       precompress=precompress, manifest=manifest)
+
+    def _read_gzip(self, name):
+        gzip_file = gzip.open(self.bucket.path(name))
+        try:
+            return gzip_file.read()
+        finally:
+            gzip_file.close()
+
+    def test_save(self):
+        """
+        Saving a CSS file should also upload a gzipped, content-hashed copy
+        with the right headers, and the url should point at it.
+
+        """
+        storage = self._storage()
+        storage.save('css/output.css', ContentFile(self.css))
+        gzip_name = 'compressed/css/output.{0}.css.gz'.format(
+                                        hashlib.md5(self.css).hexdigest()[:12])
+        self.assertEqual(self._read_gzip(gzip_name), self.css)
+        self.assertEqual(self.bucket.headers[gzip_name], {
+            'x-amz-meta-site': 'test',
+            'Content-Type': 'text/css',
+            'Content-Encoding': 'gzip',
+            'Cache-Control': 'public, max-age=31536000',
+        })
+        # The original is kept as it was.
+        self.assertEqual(self.bucket.headers['compressed/css/output.css'],
+                         {'x-amz-meta-site': 'test'})
+        self.assertEqual(storage.url('css/output.css'),
+                         'http://bucket.s3.example.com/' + gzip_name)
+
+        storage.delete('css/output.css')
+        self.assertFalse(os.path.exists(self.bucket.path(gzip_name)))
+        self.assertEqual(storage.url('css/output.css'),
+                         'http://bucket.s3.example.com/'
+                         'compressed/css/output.css')
+
+    def test_other_files(self):
+        """Only CSS and JS should be precompressed, and only when enabled."""
+        self._storage().save('img/logo.png', ContentFile('png'))
+        self._storage(precompress=False).save('js/output.js',
+                                              ContentFile('var a;'))
+        self.assertEqual(sorted(self.bucket.headers),
+                         ['compressed/img/logo.png', 'compressed/js/output.js'])
+
+    def test_manifest(self):
+        """
+        With a manifest, a new storage instance should find the copy through
+        the original's ETag, and unchanged copies shouldn't be re-uploaded.
+
+        """
+        self._storage(manifest=True).save('css/output.css',
+                                          ContentFile(self.css))
+        storage = self._storage(manifest=True)
+        self.assertTrue(storage.url('css/output.css').endswith('.css.gz'))
+        requests = self.bucket.requests
+        storage.save('css/output.css', ContentFile(self.css))
+        # Only the original is uploaded again.
+        self.assertEqual(self.bucket.requests, requests + 1)
+
+    def test_s3boto(self):
+        """
+        The mixin should work with the real S3BotoStorage, uploading the
+        copy with the storage's canned ACL.
+
+        """
+        from storages.backends.s3boto import S3BotoStorage
+
+        class Storage(PrecompressMixin, S3BotoStorage):
+            pass
+        connection_class = mock.Mock()
+        bucket = connection_class.return_value.get_bucket.return_value
+        bucket.get_key.return_value = None
+        storage = Storage(bucket='bucket', access_key='key',
+                          secret_key='secret', location='compressed',
+                          default_acl='private', precompress=True,
+                          connection_class=connection_class)
+        storage.save('css/output.css', ContentFile(self.css))
+        gzip_name = 'compressed/css/output.{0}.css.gz'.format(
+                                        hashlib.md5(self.css).hexdigest()[:12])
+        bucket.new_key.assert_any_call(gzip_name)
+        key = bucket.new_key.return_value
+        self.assertEqual(key.set_contents_from_file.call_args[1]['policy'],
+                         'private')
+        args, kwargs = key.set_contents_from_string.call_args
+        self.assertEqual(kwargs['policy'], 'private')
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+
+
+@unittest.skipIf(PooledConnectionMixin is None, 'boto is not installed.')
+class S3ConnectionPoolTestCase(unittest.TestCase):
+    def _pool(self, **kwargs):
+        return S3ConnectionPool(lambda: mock.Mock(), **kwargs)
+
+    def test_reuse(self):
+        pool = self._pool()
+        connection = pool.acquire()
+        pool.release(connection)
+        self.assertTrue(pool.acquire() is connection)
+        self.assertEqual(pool.stats()['creations'], 1)
+        self.assertEqual(pool.stats()['hits'], 1)
+
+    def test_bounded(self):
+        """
+        When the pool is full, acquiring should wait for a release.
+
+        """
+        pool = self._pool(max_size=1)
+        connection = pool.acquire()
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(
+                                                            pool.acquire()))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(acquired, [])
+        pool.release(connection)
+        thread.join()
+        self.assertEqual(acquired, [connection])
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertTrue(stats['wait_time'] > 0)
+        self.assertEqual(stats['size'], 1)
+
+    def test_idle_eviction(self):
+        pool = self._pool(idle_timeout=0)
+        connection = pool.acquire()
+        pool.release(connection)
+        time.sleep(0.01)
+        self.assertFalse(pool.acquire() is connection)
+        connection.close.assert_called_once_with()
+        stats = pool.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['creations'], 2)
+        self.assertEqual(stats['size'], 1)
+
+
+@unittest.skipIf(PooledConnectionMixin is None, 'boto is not installed.')
+class PooledConnectionMixinTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(close_connection_pools)
+        self.bucket = LocalBucket(os.path.join(self.root, 'bucket'))
+        os.makedirs(self.bucket.root)
+
+    def _storage(self):
+        class Storage(PooledConnectionMixin, ManifestMixin, CachedURLMixin,
+                      LocalS3Storage):
+            connection_pool_size = 2
+        return Storage(bucket=self.bucket, location='static', manifest=False)
+
+    def test_threads(self):
+        """
+        Concurrent operations should each get their own connection, never
+        more than the pool size, and reuse them.
+
+        """
+        storage = self._storage()
+        seen = []
+        lock = threading.Lock()
+
+        def work(i):
+            for j in xrange(10):
+                storage.save('file{0}-{1}.txt'.format(i, j),
+                             ContentFile('content'))
+                with storage.borrow_connection() as connection:
+                    # The bound connection isn't handed to other threads.
+                    with lock:
+                        seen.append(connection)
+                    self.assertTrue(storage.connection is connection)
+                    self.assertTrue(storage.exists(
+                                        'file{0}-{1}.txt'.format(i, j)))
+                    time.sleep(0.001)
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(os.listdir(self.bucket.path('static'))), 40)
+        self.assertTrue(len(set(seen)) <= 2)
+        stats = storage.connection_stats()
+        self.assertTrue(stats['creations'] <= 2)
+        self.assertTrue(stats['hits'] > 0)
+        self.assertEqual(stats['idle'], stats['size'])
+
+    def test_shared(self):
+        """Storages for the same bucket should share a pool."""
+        self.assertTrue(self._storage().connection_pool is
+                        self._storage().connection_pool)
+
+    def test_outside_operations(self):
+        """
+        Outside of an operation, a new connection should be made for each
+        caller rather than using one which has gone back to the pool, and
+        nothing should be kept by the storage.
+
+        """
+        storage = self._storage()
+        connection = storage.connection
+        self.assertFalse(storage.connection is connection)
+        self.assertEqual(storage.connection_stats()['size'], 0)
+
+        storage.save('file.txt', ContentFile('content'))
+        self.assertEqual(storage.open('file.txt').read(), 'content')
+        stats = storage.connection_stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['idle'], 1)
+        with storage.borrow_connection() as borrowed:
+            self.assertTrue(storage.connection is borrowed)
+        self.assertFalse(storage.connection is borrowed)
+
+    def test_url(self):
+        """
+        Only URLs which aren't cached should borrow a connection, and only
+        if they aren't on a custom domain.
+
+        """
+        storage = self._storage()
+        with mock.patch.object(storage.connection_pool, 'acquire',
+                               wraps=storage.connection_pool.acquire
+                               ) as acquire:
+            url = storage.url('file.txt')
+            self.assertEqual(storage.url('file.txt'), url)
+            self.assertEqual(acquire.call_count, 1)
+            storage.custom_domain = 'static.example.com'
+            storage.url('other.txt')
+            self.assertEqual(acquire.call_count, 1)
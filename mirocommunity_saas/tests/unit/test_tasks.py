@@ -0,0 +1,106 @@
+import json
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+import mock
+
+from mirocommunity_saas.models import SiteTierInfo
+from mirocommunity_saas.tasks import (fleet_chunk_task, run_fleet_job,
+                                      reconcile_tiers_sweep_task)
+from mirocommunity_saas.tests import BaseTestCase
+
+
+class FleetJobTestCase(BaseTestCase):
+    def setUp(self):
+        super(FleetJobTestCase, self).setUp()
+        tier = self.create_tier()
+        self.create_tier_info(tier)
+        self.site_ids = [1]
+        for i in xrange(2, 7):
+            site = Site.objects.create(domain='site{0}.localhost'.format(i),
+                                       name='site{0}'.format(i))
+            self.create_tier_info(tier, site_id=site.pk)
+            self.site_ids.append(site.pk)
+
+    def test_run(self):
+        """
+        The job should be run once for each site, in chunks, and the results
+        should be summarized.
+
+        """
+        seen = []
+        job = mock.Mock(side_effect=lambda: seen.append(settings.SITE_ID))
+        with mock.patch.dict('mirocommunity_saas.tasks.FLEET_JOBS',
+                             {'test': job}):
+            with mock.patch.object(fleet_chunk_task, 'delay',
+                                   wraps=fleet_chunk_task.delay) as delay:
+                fleet_job = run_fleet_job('test', chunk_size=2,
+                                          concurrency=2)
+        self.assertEqual(sorted(seen), self.site_ids)
+        self.assertEqual(delay.call_count, 3)
+        self.assertEqual(fleet_job.site_count, 6)
+        self.assertEqual(fleet_job.success_count, 6)
+        self.assertEqual(fleet_job.failures, '')
+        self.assertTrue(fleet_job.finished)
+
+    def test_failures(self):
+        """
+        A failing site should be recorded without affecting the rest of its
+        chunk.
+
+        """
+        def job():
+            if settings.SITE_ID == self.site_ids[1]:
+                raise ValueError('broken')
+
+        with mock.patch.dict('mirocommunity_saas.tasks.FLEET_JOBS',
+                             {'test': job}):
+            fleet_job = run_fleet_job('test', chunk_size=4)
+        self.assertEqual(fleet_job.success_count, 5)
+        self.assertEqual(json.loads(fleet_job.failures).keys(),
+                         [unicode(self.site_ids[1])])
+
+    def test_unknown_job(self):
+        with self.assertRaises(ValueError):
+            run_fleet_job('nonexistent')
+
+    def test_lanes(self):
+        """
+        Only ``concurrency`` chunks should be dispatched up front, each with
+        the rest of its lane, and nothing should wait for them.
+
+        """
+        with mock.patch.object(fleet_chunk_task, 'delay') as delay:
+            fleet_job = run_fleet_job('reconcile_tier', chunk_size=1,
+                                      concurrency=2)
+        self.assertEqual(fleet_job.finished, None)
+        self.assertEqual(delay.call_args_list, [
+            ((fleet_job.pk, 'reconcile_tier', [self.site_ids[0]],
+              [[self.site_ids[2]], [self.site_ids[4]]]), {}),
+            ((fleet_job.pk, 'reconcile_tier', [self.site_ids[1]],
+              [[self.site_ids[3]], [self.site_ids[5]]]), {}),
+        ])
+
+    def test_no_sites(self):
+        fleet_job = run_fleet_job('reconcile_tier', site_ids=[])
+        self.assertEqual(fleet_job.site_count, 0)
+        self.assertTrue(fleet_job.finished)
+
+
+class ReconcileTiersSweepTestCase(BaseTestCase):
+    def test_sweep(self):
+        """Only sites with enforced payments should be reconciled."""
+        tier = self.create_tier()
+        self.create_tier_info(tier, enforce_payments=True)
+        site = Site.objects.create(domain='site2.localhost', name='site2')
+        self.create_tier_info(tier, site_id=site.pk)
+        with mock.patch('mirocommunity_saas.tasks.fleet_job_task.delay'
+                        ) as delay:
+            reconcile_tiers_sweep_task()
+        delay.assert_called_once_with('reconcile_tier', site_ids=[1])
+
+        SiteTierInfo.objects.update(enforce_payments=False)
+        with mock.patch('mirocommunity_saas.tasks.fleet_job_task.delay'
+                        ) as delay:
+            reconcile_tiers_sweep_task()
+        self.assertFalse(delay.called)
@@ -0,0 +1,87 @@
+"""
+Tier entitlements as bits, so that what a site may do can be kept and
+checked as a single integer, and a table of the views which need them.
+
+"""
+from functools import wraps
+
+from django.http import Http404
+
+
+CUSTOM_CSS = 1 << 0
+CUSTOM_THEMES = 1 << 1
+CUSTOM_DOMAIN = 1 << 2
+ADS_ALLOWED = 1 << 3
+
+#: (name, bit) pairs for each entitlement. The names are those of the
+#: boolean :class:`.Tier` fields they stand for.
+ENTITLEMENTS = (
+    ('custom_css', CUSTOM_CSS),
+    ('custom_themes', CUSTOM_THEMES),
+    ('custom_domain', CUSTOM_DOMAIN),
+    ('ads_allowed', ADS_ALLOWED),
+)
+
+#: Maps the names of the urls which are only available to sites with all of
+#: the given entitlements to those entitlements. The views behind them check
+#: for themselves with :func:`require_entitlement`; this table only lets
+#: :class:`.EntitlementMiddleware` turn requests away early. It can be
+#: replaced with the ``MIROCOMMUNITY_SAAS_RESTRICTED_URLS`` setting.
+RESTRICTED_URLS = {
+    'uploadtemplate-index': CUSTOM_THEMES,
+    'uploadtemplate-create': CUSTOM_THEMES,
+    'uploadtemplate-update': CUSTOM_THEMES,
+    'uploadtemplate-delete': CUSTOM_THEMES,
+    'uploadtemplate-set_default': CUSTOM_THEMES,
+    'uploadtemplate-unset_default': CUSTOM_THEMES,
+    'localtv_admin_flatpages': CUSTOM_THEMES,
+}
+
+
+def entitlement_mask(tier):
+    """Returns the bits for the entitlements the given tier allows."""
+    mask = 0
+    for name, bit in ENTITLEMENTS:
+        if getattr(tier, name):
+            mask |= bit
+    return mask
+
+
+def request_entitlements(request):
+    """
+    Returns the entitlement mask of the current site's tier. It's looked up
+    at most once per request.
+
+    """
+    try:
+        return request._entitlements
+    except AttributeError:
+        from mirocommunity_saas.models import SiteTierInfo
+        tier = SiteTierInfo.objects.get_current().tier
+        request._entitlements = tier.entitlements
+        return request._entitlements
+
+
+def has_entitlements(request, required):
+    """
+    Returns ``True`` if the current site's tier has all of the ``required``
+    entitlements.
+
+    """
+    return not required & ~request_entitlements(request)
+
+
+def require_entitlement(required):
+    """
+    Decorator for views which raise a 404 unless the current site's tier has
+    all of the ``required`` entitlements.
+
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if not has_entitlements(request, required):
+                raise Http404
+            return view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,3 +1,12 @@
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6
+    from ordereddict import OrderedDict
+
+
 MISSING = object()
 
 
@@ -17,3 +26,42 @@ class cached_property(object):
             value = self.func(instance)
             instance.__dict__[self.__name__] = value
         return value
+
+
+class LRUCache(object):
+    """
+    A small thread-safe dictionary-like cache which holds at most
+    ``max_size`` items, discarding the least recently used ones first.
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
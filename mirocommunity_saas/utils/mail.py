@@ -1,13 +1,22 @@
 import datetime
-import markdown
+from itertools import chain
+import logging
+import threading
+import uuid
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connections as db_connections
 from django.template.defaultfilters import striptags
 from django.template import Context, loader
 
+from mirocommunity_saas import __version__
 from mirocommunity_saas.models import SiteTierInfo
+from mirocommunity_saas.routers import read_database, write_database
+from mirocommunity_saas.utils.functional import LRUCache
+from mirocommunity_saas.utils.sites import current_site
 
 
 #: The minimum number of days between video limit warnings.
@@ -21,6 +30,114 @@ VIDEO_LIMIT_MIN_RATIO = .66
 VIDEO_LIMIT_MIN_CHANGE_RATIO = .5
 #: Number of days before the end of the free trial to warn the site's owners.
 FREE_TRIAL_WARNING_DAYS = 5
+#: Number of minutes after signup to wait for the site owner to come back
+#: from paypal (which sends the welcome email) before sending it anyway.
+WELCOME_EMAIL_GRACE_MINUTES = 30
+#: Sites created more than this many days ago are never sent a welcome email
+#: by the sweep.
+WELCOME_EMAIL_MAX_AGE_DAYS = 7
+#: Default number of messages rendered by each worker task when
+#: :func:`send_mail` renders on a process pool.
+MAIL_CHUNK_SIZE = 50
+#: Maximum number of rendered bodies whose HTML conversion is remembered.
+MARKDOWN_CACHE_SIZE = 128
+#: Maximum number of compiled mail templates kept, across all sites.
+MAIL_TEMPLATE_CACHE_SIZE = 512
+#: Cache key under which a stamp for the last theme change is shared between
+#: processes.
+MAIL_THEME_VERSION_CACHE_KEY = 'mirocommunity_saas.mail_templates.theme'
+#: Number of seconds the theme change stamp is cached for. When it expires,
+#: compiled templates are just thrown away once more.
+MAIL_THEME_VERSION_TIMEOUT = 24 * 60 * 60
+
+
+def get_mail_template_version():
+    """
+    Returns the version stamp for compiled mail templates: the package
+    version and the stamp of the last theme change (see
+    :func:`invalidate_mail_templates`). Deploys which change mail templates
+    without changing the package version can bump the
+    ``MIROCOMMUNITY_SAAS_MAIL_VERSION`` setting instead.
+
+    """
+    return (getattr(settings, 'MIROCOMMUNITY_SAAS_MAIL_VERSION', __version__),
+            cache.get(MAIL_THEME_VERSION_CACHE_KEY))
+
+
+def invalidate_mail_templates():
+    """
+    Makes every process compile its mail templates again the next time they
+    are used. This is called whenever a theme is changed, since themes can
+    override the mail templates.
+
+    """
+    cache.set(MAIL_THEME_VERSION_CACHE_KEY, uuid.uuid4().hex,
+              MAIL_THEME_VERSION_TIMEOUT)
+
+
+class MailTemplateRegistry(object):
+    """
+    Compiles each mail template once per site and process, so that sending
+    mail doesn't go through the template loaders (including theme storage)
+    every time. Templates are kept per site, since a site's theme can
+    override them, and only the ``max_size`` most recently used are kept.
+    The registry is emptied whenever the version stamp changes, including
+    when a theme is changed.
+
+    """
+    def __init__(self, max_size=MAIL_TEMPLATE_CACHE_SIZE):
+        self._templates = LRUCache(max_size)
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get_template(self, name):
+        version = get_mail_template_version()
+        with self._lock:
+            if version != self._version:
+                self._templates.clear()
+                self._version = version
+        key = (settings.SITE_ID, name)
+        template = self._templates.get(key)
+        if template is None:
+            template = loader.get_template(name)
+            with self._lock:
+                if self._version == version:
+                    self._templates.set(key, template)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self._version = None
+
+
+mail_templates = MailTemplateRegistry()
+
+
+_markdown = threading.local()
+_markdown_cache = LRUCache(MARKDOWN_CACHE_SIZE)
+
+
+def markdown_to_html(text):
+    """
+    Converts the given markdown to HTML. This reuses one converter per
+    thread and remembers the output for recently converted text, since many
+    messages (for example, those sent to the site managers) have identical
+    bodies.
+
+    """
+    html = _markdown_cache.get(text)
+    if html is None:
+        converter = getattr(_markdown, 'converter', None)
+        if converter is None:
+            # markdown is only imported when first needed, to keep the
+            # import cost of the mail commands down.
+            import markdown
+            converter = markdown.Markdown(output_format="html5")
+            _markdown.converter = converter
+        html = converter.reset().convert(text)
+        _markdown_cache.set(text, html)
+    return html
 
 
 def render_to_email(subject_template, body_template, context, to, from_email):
@@ -33,13 +150,119 @@ def render_to_email(subject_template, body_template, context, to, from_email):
     body = striptags(body_template.render(context))
     msg = EmailMultiAlternatives(subject, body, from_email, to)
 
-    html_body = markdown.markdown(body, output_format="html5")
+    html_body = markdown_to_html(body)
     msg.attach_alternative(html_body, "text/html")
     return msg
 
 
+def _mail_targets(to):
+    """
+    Normalizes an iterable of users and/or (name, email) tuples into a list
+    of (email, user) pairs, where ``user`` is ``None`` for tuples. Users
+    without an email address are skipped.
+
+    """
+    targets = []
+    for target in to:
+        if isinstance(target, User):
+            if not target.email:
+                continue
+            targets.append((target.email, target))
+        else:
+            targets.append((target[1], None))
+    return targets
+
+
+def _render_messages(subject_template_name, body_template_name, context,
+                     targets, from_email):
+    """
+    Renders one message per target. ``context`` is a dictionary; it is kept
+    picklable so that this can run in a worker process.
+
+    """
+    subject_template = mail_templates.get_template(subject_template_name)
+    body_template = mail_templates.get_template(body_template_name)
+    context = Context(context)
+    messages = []
+    for email, user in targets:
+        if user is not None:
+            context.push()
+            context['user'] = user
+
+        messages.append(render_to_email(subject_template, body_template,
+                                        context, [email], from_email))
+
+        if user is not None:
+            context.pop()
+    return messages
+
+
+def _render_messages_star(args):
+    # Pool.imap only passes a single argument.
+    return _render_messages(*args)
+
+
+def _init_render_worker():
+    """
+    Runs in each new render worker. The worker is forked with the parent's
+    database connections, which it mustn't use or close (closing them would
+    end the parent's sessions, and any transaction it has open); they're
+    dropped so that the worker opens its own if it needs one.
+
+    """
+    for connection in db_connections.all():
+        connection.connection = None
+
+
+class MailSendError(Exception):
+    """
+    Raised when sending over several connections fails on one or more of
+    them. ``errors`` lists the exception from each connection which failed;
+    the messages on the other connections were sent.
+
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(MailSendError, self).__init__(
+            '{0} of the mail connections failed: {1}'.format(
+                len(errors), '; '.join(repr(e) for e in errors)))
+
+
+def _send_messages(messages, connections=1, fail_silently=False):
+    """
+    Sends the messages, split over up to ``connections`` SMTP connections
+    which each run in their own thread.
+
+    """
+    connections = max(1, min(connections, len(messages)))
+    if connections == 1:
+        connection = get_connection(fail_silently=fail_silently)
+        return connection.send_messages(messages)
+
+    errors = []
+
+    def send(batch):
+        connection = get_connection(fail_silently=fail_silently)
+        try:
+            connection.send_messages(batch)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=send,
+                                args=(messages[i::connections],))
+               for i in xrange(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise MailSendError(errors)
+
+
 def send_mail(subject_template_name, body_template_name, to,
-              from_email=None, extra_context=None, fail_silently=False):
+              from_email=None, extra_context=None, fail_silently=False,
+              processes=None, chunk_size=MAIL_CHUNK_SIZE, connections=1,
+              connection=None):
     """
     Send mail to the given users (or to the site devs if no users are
     provided) rendered with the given templates.
@@ -65,52 +288,145 @@ def send_mail(subject_template_name, body_template_name, to,
                           This will override the default context.
     :param fail_silently: This has the same meaning as for django's core mail
                           functionality.
+    :param processes: If given, messages are rendered on a pool of this many
+                      worker processes instead of in the current process.
+                      Everything in the context must be picklable.
+    :param chunk_size: The number of messages each worker renders at a time.
+    :param connections: The number of mail server connections to send the
+                        rendered messages over. If any of them fail, the
+                        others still send their messages and then a
+                        :exc:`MailSendError` listing every failure is
+                        raised.
+    :param connection: An already-open mail connection to send the messages
+                       over instead; ``connections`` is ignored if this is
+                       given.
 
     """
     tier_info = SiteTierInfo.objects.get_current()
-    context = Context({
+    context = {
         'tier_info': tier_info,
         'site': tier_info.site,
         'tier': tier_info.tier
-    })
+    }
     context.update(extra_context or {})
-    subject_template = loader.get_template(subject_template_name)
-    body_template = loader.get_template(body_template_name)
     from_email = from_email or settings.DEFAULT_FROM_EMAIL
+    targets = _mail_targets(to)
+
+    if processes and len(targets) > chunk_size:
+        from multiprocessing.pool import Pool
+        # Evaluate the cached properties the templates use, so that workers
+        # don't need to query the database.
+        tier_info.subscription
+        tasks = [(subject_template_name, body_template_name, context,
+                  targets[i:i + chunk_size], from_email)
+                 for i in xrange(0, len(targets), chunk_size)]
+        pool = Pool(processes, initializer=_init_render_worker)
+        try:
+            messages = list(chain.from_iterable(
+                                pool.imap(_render_messages_star, tasks)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        messages = _render_messages(subject_template_name, body_template_name,
+                                    context, targets, from_email)
+
+    if connection is not None:
+        connection.send_messages(messages)
+    else:
+        _send_messages(messages, connections, fail_silently)
+
+
+def site_owners():
+    """
+    Returns the current site's owners, read from the replica if there is
+    one. Site owners are currently all superusers.
 
-    messages = []
+    """
+    return User.objects.using(read_database()).filter(is_superuser=True,
+                                                      is_active=True)
 
-    for target in to:
-        if isinstance(target, User):
-            if not target.email:
-                continue
-            context.push()
-            context['user'] = target
-            email = target.email
-        else:
-            email = target[1]
 
-        msg = render_to_email(subject_template, body_template, context,
-                              [email], from_email)
-        messages.append(msg)
+def _claim_welcome_email(tier_info_id, now):
+    """
+    Marks the welcome email for the given tier info as sent, unless that's
+    already happened, and returns whether it was claimed. Only whoever
+    claims a site sends its welcome email, so that a paypal return and the
+    sweep can't both send it.
 
-        if isinstance(target, User):
-            context.pop()
+    """
+    return SiteTierInfo.objects.filter(pk=tier_info_id,
+                                       welcome_email_sent__isnull=True
+                                       ).update(welcome_email_sent=now) == 1
 
-    connection = get_connection(fail_silently=fail_silently)
-    connection.send_messages(messages)
+
+def _send_welcome_email(tier_info_id, **kwargs):
+    try:
+        send_mail('mirocommunity_saas/mail/welcome/subject.txt',
+                  'mirocommunity_saas/mail/welcome/body.md',
+                  site_owners(), **kwargs)
+    except Exception:
+        # Give up the claim so that the next sweep tries again.
+        SiteTierInfo.objects.filter(pk=tier_info_id).update(
+                                                    welcome_email_sent=None)
+        raise
 
 
 def send_welcome_email():
     tier_info = SiteTierInfo.objects.get_current()
     if tier_info.welcome_email_sent:
         return
-    send_mail('mirocommunity_saas/mail/welcome/subject.txt',
-              'mirocommunity_saas/mail/welcome/body.md',
-              # site owners are currently all superusers.
-              User.objects.filter(is_superuser=True, is_active=True))
-    tier_info.welcome_email_sent = datetime.datetime.now()
-    tier_info.save()
+    now = datetime.datetime.now()
+    if not _claim_welcome_email(tier_info.pk, now):
+        return
+    tier_info.welcome_email_sent = now
+    _send_welcome_email(tier_info.pk)
+
+
+def send_pending_welcome_emails():
+    """
+    Sends the welcome email for every site which signed up more than
+    :data:`WELCOME_EMAIL_GRACE_MINUTES` ago and hasn't received it yet, over a
+    single mail connection. Each site is claimed before its email is sent, so
+    overlapping sweeps never send it twice. A site whose email can't be sent
+    is logged and left for the next sweep. Returns the ids of the sites
+    which were emailed.
+
+    """
+    now = datetime.datetime.now()
+    # This is read from the primary, since a lagging replica could still
+    # list the sites emailed by the last sweep. Only sites which signed up
+    # through ``initialize`` have payments enforced; tier info created on
+    # demand for other sites never gets a welcome email.
+    pending = SiteTierInfo.objects.using(write_database()).filter(
+        welcome_email_sent__isnull=True,
+        enforce_payments=True,
+        created__lte=now - datetime.timedelta(
+                                        minutes=WELCOME_EMAIL_GRACE_MINUTES),
+        created__gt=now - datetime.timedelta(WELCOME_EMAIL_MAX_AGE_DAYS))
+    pending = list(pending.values_list('pk', 'site'))
+    if not pending:
+        return []
+
+    sent = []
+    connection = get_connection()
+    connection.open()
+    try:
+        for tier_info_id, site_id in pending:
+            if not _claim_welcome_email(tier_info_id, now):
+                continue
+            try:
+                with current_site(site_id):
+                    _send_welcome_email(tier_info_id, connection=connection)
+            except Exception:
+                logging.error('Welcome email failed for site {0}'.format(
+                                                                    site_id),
+                              exc_info=True)
+                continue
+            sent.append(site_id)
+    finally:
+        connection.close()
+    return sent
 
 
 def send_video_limit_warning():
@@ -131,7 +447,8 @@ def send_video_limit_warning():
     # We import here so that the mail module can be imported without importing
     # localtv.models.
     from localtv.models import Video
-    video_count = Video.objects.filter(status=Video.ACTIVE,
+    video_count = Video.objects.using(read_database()
+                              ).filter(status=Video.ACTIVE,
                                        site=settings.SITE_ID).count()
     old_video_count = tier_info.video_count_when_warned
     ratio = float(video_count) / video_limit
@@ -160,8 +477,7 @@ def send_video_limit_warning():
 
     send_mail('mirocommunity_saas/mail/video_limit/subject.txt',
               'mirocommunity_saas/mail/video_limit/body.md',
-              # site owners are currently all superusers.
-              User.objects.filter(is_superuser=True, is_active=True),
+              site_owners(),
               extra_context={'ratio': ratio})
     tier_info.video_limit_warning_sent = datetime.datetime.now()
     tier_info.video_count_when_warned = video_count
@@ -187,7 +503,6 @@ def send_free_trial_ending():
 
     send_mail('mirocommunity_saas/mail/free_trial/subject.txt',
               'mirocommunity_saas/mail/free_trial/body.md',
-              # site owners are currently all superusers.
-              User.objects.filter(is_superuser=True, is_active=True))
+              site_owners())
     tier_info.free_trial_ending_sent = datetime.datetime.now()
     tier_info.save()
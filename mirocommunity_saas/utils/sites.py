@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+import uuid
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db.models import get_models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from mirocommunity_saas.models import SiteTierInfo
+
+
+def clear_manager_caches():
+    """
+    Clears the per-site caches kept in this process: the ``Site.objects``
+    cache and the caches of any manager which keeps one (such as
+    :class:`localtv.managers.SiteRelatedManager` subclasses).
+
+    """
+    Site.objects.clear_cache()
+    for model in get_models():
+        manager = model._default_manager
+        if hasattr(manager, 'clear_cache'):
+            manager.clear_cache()
+
+
+def clear_site_caches():
+    """
+    Clears every per-site cache we know about: those cleared by
+    :func:`clear_manager_caches` and the current site's cached active video
+    count.
+
+    """
+    # Imported here because the tier utilities depend on this module.
+    from mirocommunity_saas.utils.tiers import invalidate_active_video_count
+    clear_manager_caches()
+    invalidate_active_video_count()
+
+
+@contextmanager
+def current_site(site_id):
+    """
+    Makes ``site_id`` the current site (i.e. ``settings.SITE_ID``) for the
+    duration of the block, so that code which relies on ``get_current()``
+    can be run for several sites in one process. Per-site caches are cleared
+    on the way in and on the way out.
+
+    """
+    old_site_id = settings.SITE_ID
+    settings.SITE_ID = site_id
+    clear_site_caches()
+    try:
+        yield
+    finally:
+        settings.SITE_ID = old_site_id
+        clear_site_caches()
+
+
+def saas_site_ids():
+    """
+    Returns a list of the ids of every site which has tier info, in order.
+
+    """
+    return list(SiteTierInfo.objects.order_by('site'
+                                   ).values_list('site', flat=True))
+
+
+#: Cache key under which the domain to site id map is shared between
+#: processes, as a (version, map) tuple.
+DOMAIN_MAP_CACHE_KEY = 'mirocommunity_saas.domain_map'
+#: Cache key for the current version of the domain to site id map.
+DOMAIN_MAP_VERSION_CACHE_KEY = 'mirocommunity_saas.domain_map.version'
+#: Number of seconds the shared domain map and its version are cached for.
+DOMAIN_MAP_TIMEOUT = 24 * 60 * 60
+
+
+def _normalize_domain(domain):
+    return domain.split(':')[0].rstrip('.').lower()
+
+
+class DomainSiteMap(object):
+    """
+    Maps request hosts to site ids. Each process keeps its own copy of the
+    map and checks a version number in the cache before using it. When the
+    version changes (see :meth:`invalidate`), the new map is taken from the
+    cache if another process has already built it, or built from the
+    database and shared if not.
+
+    The version can change before the change that caused it is committed,
+    so a map built in between would be missing the new domain. Hosts which
+    aren't in the map are therefore looked for again in a freshly built map,
+    once per version, before they're given up on.
+
+    """
+    def __init__(self):
+        self._version = None
+        self._domains = {}
+        self._rebuilt_version = None
+
+    def _current_version(self):
+        version = cache.get(DOMAIN_MAP_VERSION_CACHE_KEY)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(DOMAIN_MAP_VERSION_CACHE_KEY, version,
+                             DOMAIN_MAP_TIMEOUT):
+                version = cache.get(DOMAIN_MAP_VERSION_CACHE_KEY, version)
+        return version
+
+    def _build(self, version):
+        domains = dict((_normalize_domain(domain), site_id)
+                       for domain, site_id
+                       in Site.objects.values_list('domain', 'pk'))
+        cache.set(DOMAIN_MAP_CACHE_KEY, (version, domains),
+                  DOMAIN_MAP_TIMEOUT)
+        self._domains, self._version = domains, version
+        return domains
+
+    def domains(self):
+        """Returns the current dictionary of domains to site ids."""
+        version = self._current_version()
+        if version != self._version:
+            shared = cache.get(DOMAIN_MAP_CACHE_KEY)
+            if shared is not None and shared[0] == version:
+                self._domains, self._version = shared[1], version
+            else:
+                self._build(version)
+        return self._domains
+
+    def resolve(self, host):
+        """
+        Returns the id of the site for the given host (which may include a
+        port), or ``None`` if there isn't one.
+
+        """
+        domain = _normalize_domain(host)
+        site_id = self.domains().get(domain)
+        if site_id is None and self._rebuilt_version != self._version:
+            self._rebuilt_version = self._version
+            site_id = self._build(self._version).get(domain)
+        return site_id
+
+    def invalidate(self):
+        """
+        Makes every process rebuild its map the next time it's used.
+
+        """
+        cache.set(DOMAIN_MAP_VERSION_CACHE_KEY, uuid.uuid4().hex,
+                  DOMAIN_MAP_TIMEOUT)
+        self._version = None
+
+
+domain_site_map = DomainSiteMap()
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def site_changed(sender, **kwargs):
+    """
+    Invalidates the domain map whenever a site is saved or deleted; this
+    includes the domain rewrite done by :func:`.enforce_tier`.
+
+    """
+    domain_site_map.invalidate()
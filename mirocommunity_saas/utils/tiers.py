@@ -2,8 +2,11 @@ import logging
 
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils.crypto import constant_time_compare, salted_hmac
+from localtv.models import Video
 from localtv.signals import pre_mark_as_active, submit_finished
 from paypal.standard.ipn.signals import (payment_was_successful,
                                          payment_was_flagged,
@@ -14,7 +17,19 @@ from paypal.standard.ipn.signals import (payment_was_successful,
 from uploadtemplate.models import Theme
 
 from mirocommunity_saas.models import SiteTierInfo, Tier
-from mirocommunity_saas.utils.mail import send_mail
+from mirocommunity_saas.routers import pin_to_primary, read_database
+from mirocommunity_saas.utils.mail import (invalidate_mail_templates,
+                                           send_mail)
+
+
+#: Number of seconds during which a site's tier reconciliation will only be
+#: queued once by :func:`queue_tier_reconciliation`.
+RECONCILIATION_QUEUE_TIMEOUT = 5 * 60
+
+#: Number of seconds for which :func:`active_video_count` caches a site's
+#: count. Saves and deletes clear it straight away; the timeout bounds how
+#: stale it can get after bulk updates which bypass the model signals.
+ACTIVE_VIDEO_COUNT_TIMEOUT = 60
 
 
 def admins_to_demote(tier):
@@ -85,6 +100,7 @@ def enforce_tier(tier):
     if deactivate_pks:
         Video.objects.filter(pk__in=deactivate_pks).update(
                                                     status=Video.UNAPPROVED)
+        invalidate_active_video_count()
 
     if (not tier.custom_domain and
         not site.domain.endswith(".mirocommunity.org")):
@@ -106,9 +122,11 @@ def enforce_tier(tier):
             theme.save()
 
 
-def make_tier_change_token(new_tier):
-    site = Site.objects.get_current()
-    tier_info = SiteTierInfo.objects.get_current()
+def make_tier_change_token(new_tier, site=None, tier_info=None):
+    if site is None:
+        site = Site.objects.get_current()
+    if tier_info is None:
+        tier_info = SiteTierInfo.objects.get_current()
     # We hash on the site domain to make sure we stay on the same site, and on
     # the tier_name/tier_changed so that the link will stop working once it's
     # used.
@@ -191,6 +209,7 @@ def set_tier(price):
         # Let errors propagate.
         tier_info.tier = tier_info.available_tiers.get(price=price)
         tier_info.save()
+        pin_to_primary()
         enforce_tier(tier_info.tier)
         # Email site managers to let them know about the change.
         send_mail('mirocommunity_saas/mail/tier_change/subject.txt',
@@ -201,6 +220,167 @@ def set_tier(price):
                   })
 
 
+def subscription_price(tier_info):
+    """
+    Returns the price being paid by the site's current subscription, or 0 if
+    there isn't one.
+
+    """
+    if tier_info.subscription is None:
+        return 0
+    return tier_info.subscription.signup_or_modify.amount3
+
+
+def tier_needs_reconciliation(tier_info):
+    """
+    Returns ``True`` if payments are enforced for the site and its tier
+    doesn't match what its subscription pays for. This doesn't change
+    anything, so it's safe to call while rendering pages.
+
+    """
+    return (tier_info.enforce_payments and
+            subscription_price(tier_info) != tier_info.tier.price)
+
+
+def reconcile_tier():
+    """
+    Brings the current site's tier in line with its subscription if
+    payments are enforced (see :func:`set_tier`). Errors finding a matching
+    tier are logged rather than raised.
+
+    """
+    tier_info = SiteTierInfo.objects.get_current()
+    if not tier_info.enforce_payments:
+        return
+    try:
+        set_tier(subscription_price(tier_info))
+    except Tier.DoesNotExist:
+        logging.error('No tier matching current subscription.',
+                      exc_info=True)
+    except Tier.MultipleObjectsReturned:
+        logging.error('Multiple tiers found matching current'
+                      'subscription.', exc_info=True)
+
+
+def queue_tier_reconciliation():
+    """
+    Queues :func:`reconcile_tier` to run in the background for the current
+    site, unless it has already been queued in the last
+    :data:`RECONCILIATION_QUEUE_TIMEOUT` seconds.
+
+    """
+    from mirocommunity_saas.tasks import reconcile_tier_task
+    key = 'mirocommunity_saas.reconcile_tier.{0}'.format(settings.SITE_ID)
+    if cache.add(key, True, RECONCILIATION_QUEUE_TIMEOUT):
+        reconcile_tier_task.delay(site_id=settings.SITE_ID)
+
+
+def _active_video_count_key(site_id):
+    return 'mirocommunity_saas.active_video_count.{0}'.format(site_id)
+
+
+def active_video_count():
+    """
+    Returns the number of active videos on the current site, cached for up
+    to :data:`ACTIVE_VIDEO_COUNT_TIMEOUT` seconds. This is meant for quota
+    checks which run on every moderation request; anything which changes
+    video statuses without saving the videos should call
+    :func:`invalidate_active_video_count` afterwards.
+
+    """
+    key = _active_video_count_key(settings.SITE_ID)
+    count = cache.get(key)
+    if count is None:
+        count = Video.objects.using(read_database()
+                            ).filter(status=Video.ACTIVE,
+                                     site=settings.SITE_ID).count()
+        cache.set(key, count, ACTIVE_VIDEO_COUNT_TIMEOUT)
+    return count
+
+
+def videos_remaining(tier):
+    """
+    Returns how many more videos the current site can approve under the
+    given tier's :attr:`video_limit` (according to
+    :func:`active_video_count`), or ``None`` if the tier has no limit.
+
+    """
+    if tier.video_limit is None:
+        return None
+    return max(tier.video_limit - active_video_count(), 0)
+
+
+def tier_usage(tier):
+    """
+    Returns a dictionary describing how much of the given tier the current
+    site is using: the tier's ``slug``, the ``limit``, ``used`` and
+    ``remaining`` counts for ``videos`` and ``admins`` (``limit`` and
+    ``remaining`` are ``None`` if unlimited) and its ``entitlements``. Only
+    the admin count is queried; the video count comes from
+    :func:`active_video_count`.
+
+    """
+    from localtv.models import SiteSettings
+    site_settings = SiteSettings.objects.get_current()
+    admin_count = site_settings.admins.using(read_database()
+                                     ).exclude(is_superuser=True
+                                     ).exclude(is_active=False
+                                     ).count()
+    usage = {
+        'tier': tier.slug,
+        'videos': {'limit': tier.video_limit, 'used': active_video_count()},
+        'admins': {'limit': tier.admin_limit, 'used': admin_count},
+        'entitlements': {
+            'custom_css': tier.custom_css,
+            'custom_themes': tier.custom_themes,
+            'custom_domain': tier.custom_domain,
+            'ads_allowed': tier.ads_allowed,
+        },
+    }
+    for counts in (usage['videos'], usage['admins']):
+        if counts['limit'] is None:
+            counts['remaining'] = None
+        else:
+            counts['remaining'] = max(counts['limit'] - counts['used'], 0)
+    return usage
+
+
+def invalidate_active_video_count(site_id=None):
+    """
+    Clears the cached active video count for the given site (or the current
+    site if none is given).
+
+    """
+    if site_id is None:
+        site_id = settings.SITE_ID
+    cache.delete(_active_video_count_key(site_id))
+
+
+@receiver(post_save, sender=Video)
+@receiver(post_delete, sender=Video)
+def video_changed(sender, instance, **kwargs):
+    """
+    Clears the cached active video count for a video's site whenever the
+    video is saved or deleted, and makes sure the rest of the request or
+    task reads the new count from the primary.
+
+    """
+    pin_to_primary()
+    invalidate_active_video_count(instance.site_id)
+
+
+@receiver(post_save, sender=Theme)
+@receiver(post_delete, sender=Theme)
+def theme_changed(sender, **kwargs):
+    """
+    Themes can override the mail templates, so compiled mail templates are
+    thrown away whenever a theme is saved (which includes making it the
+    default) or deleted.
+
+    """
+    invalidate_mail_templates()
+
+
 @receiver(payment_was_successful)
 @receiver(payment_was_flagged)
 @receiver(subscription_signup)
@@ -215,6 +395,7 @@ def record_new_ipn(sender, **kwargs):
     """
     tier_info = SiteTierInfo.objects.get_current()
     tier_info.ipn_set.add(sender)
+    pin_to_primary()
 
     if not sender.flag:
         try:
@@ -227,14 +408,4 @@ def record_new_ipn(sender, **kwargs):
         except AttributeError:
             pass
 
-        if tier_info.enforce_payments:
-            price = (0 if tier_info.subscription is None
-                     else tier_info.subscription.signup_or_modify.amount3)
-            try:
-                set_tier(price)
-            except Tier.DoesNotExist:
-                logging.error('No tier matching current subscription.',
-                              exc_info=True)
-            except Tier.MultipleObjectsReturned:
-                logging.error('Multiple tiers found matching current'
-                              'subscription.', exc_info=True)
+        reconcile_tier()
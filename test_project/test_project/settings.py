@@ -37,6 +37,9 @@ else:
         }
     }
 
+# Reads of the SaaS models go to a 'replica' database if one is configured.
+DATABASE_ROUTERS = ['mirocommunity_saas.routers.ReadReplicaRouter']
+
 # haystack search
 SEARCH = os.environ.get('SEARCH')
 if SEARCH == 'elasticsearch':
@@ -140,6 +143,8 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'mirocommunity_saas.middleware.EntitlementMiddleware',
+    'mirocommunity_saas.middleware.ReadReplicaMiddleware',
     'django.contrib.flatpages.middleware.FlatpageFallbackMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware'